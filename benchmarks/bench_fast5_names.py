@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import argparse
+import os
+import random
+import sys
+import timeit
+
+# Micro-benchmark of the shared fast5 file name parser (ont/fast5_names.py) on a directory listing of
+# mixed names: reads in each MinKNOW naming scheme, plus the other files and folders found in reads/.
+# Run from anywhere: python benchmarks/bench_fast5_names.py --names 200000
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ont import fast5_names
+
+parser = argparse.ArgumentParser(description="Time the fast5 file name parser on a synthetic listing.")
+parser.add_argument("--names", nargs='?', dest="NAMES", type=int, default=200000,
+                    help="Number of names in the synthetic listing. Default set at 200000")
+parser.add_argument("--repeat", nargs='?', dest="REPEAT", type=int, default=3,
+                    help="Number of timings to take the best of. Default set at 3")
+args = parser.parse_args()
+
+random.seed(1)
+
+
+def synthetic_name(number):
+    channel = random.randint(1, 512)
+    kind = random.random()
+    if kind < 0.45:
+        return "alex_20160913_FN_MN17734_sequencing_run_e_coli_R9_12345_ch%d_read%d_strand.fast5" % (channel, number)
+    if kind < 0.9:
+        return "minion01_20170501_FAF04109_MN17734_sequencing_run_e_coli_R9_4a3b2_read_%d_ch_%d_strand.fast5" \
+               % (number, channel)
+    if kind < 0.95:
+        return "ch%d_read%d_strand.fast5" % (channel, number)
+    # Things that are not reads: batch folders, downloads/, logs, partial transfers.
+    return random.choice(["downloads", "%d" % (1473800000 + number), "run_%d.log" % number,
+                          ".x_ch1_read%d_strand.fast5.partial" % number])
+
+
+names = [synthetic_name(number) for number in range(args.NAMES)]
+
+
+def old_split_parser():
+    # What nanonet-realtime.py used to do, made safe for non-read names.
+    for name in names:
+        try:
+            int(name.split('_')[-2].replace("read", ''))
+            name.split('_')[-3]
+        except (IndexError, ValueError):
+            pass
+
+
+def uncached():
+    fast5_names._cache.clear()
+    for name in names:
+        fast5_names.parse(name)
+
+
+def cached():
+    for name in names:
+        fast5_names.parse(name)
+
+
+uncached()  # fill the cache for the cached timing
+timings = [("old split('_') parser", old_split_parser), ("regex parser, cold cache", uncached),
+           ("regex parser, warm cache", cached)]
+if args.NAMES > fast5_names.CACHE_SIZE:
+    print("Note: %d names is more than the cache holds (%d), so the warm cache timing is partly cold.\n"
+          % (args.NAMES, fast5_names.CACHE_SIZE))
+
+for label, function in timings:
+    best = min(timeit.repeat(function, number=1, repeat=args.REPEAT))
+    print("%-28s %8.1f ms  %6.2f us/name" % (label, best * 1000, best * 1e6 / len(names)))
+
+parsed = [fast5_names.parse(name) for name in names]
+print("\nParsed %d of %d names, %d skipped" % (sum(1 for p in parsed if p), len(names),
+                                               sum(1 for p in parsed if p is None)))
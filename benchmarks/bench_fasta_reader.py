@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import argparse
+import gzip
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# Benchmark of the built-in FASTA/FASTQ reader (ont/sequences.py read_sequences) against Biopython's
+# SeqIO.parse, as onecodex-realtime.py used, on a synthetic nanopore-like file: 1D read lengths spread
+# around a few kilobases, sequence wrapped at 80 columns or on one line, plain and gzipped.
+# Run from anywhere: python benchmarks/bench_fasta_reader.py --reads 20000
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ont.sequences import read_sequences
+
+try:
+    from Bio import SeqIO
+except ImportError:
+    SeqIO = None
+
+parser = argparse.ArgumentParser(description="Time the built-in FASTA reader against Bio.SeqIO.")
+parser.add_argument("--reads", nargs='?', dest="READS", type=int, default=20000,
+                    help="Number of reads in the synthetic file. Default set at 20000")
+parser.add_argument("--median_length", nargs='?', dest="MEDIAN_LENGTH", type=int, default=4000,
+                    help="Median read length. Default set at 4000")
+parser.add_argument("--repeat", nargs='?', dest="REPEAT", type=int, default=3,
+                    help="Number of timings to take the best of. Default set at 3")
+parser.add_argument("--wrap", nargs='?', dest="WRAP", type=int, default=0,
+                    help="Line length of the sequence, 0 for one line per sequence as nanonet writes. Default set at 0")
+args = parser.parse_args()
+
+random.seed(1)
+# Reads are slices of one long random sequence: quick to make, and about as compressible as real reads.
+GENOME = "".join(random.choice("ACGT") for _ in range(1 << 20)) * 2
+directory = tempfile.mkdtemp(prefix="bench_fasta_")
+fasta_file = os.path.join(directory, "reads.fasta")
+with open(fasta_file, 'w') as fasta:
+    for number in range(args.READS):
+        length = min(max(int(random.lognormvariate(0, 0.7) * args.MEDIAN_LENGTH), 50), len(GENOME) // 2)
+        start = random.randint(0, len(GENOME) // 2)
+        sequence = GENOME[start:start + length]
+        if args.WRAP:
+            sequence = "\n".join(sequence[i:i + args.WRAP] for i in range(0, length, args.WRAP))
+        fasta.write(">minion_ch%d_read%d_strand_template length=%d\n%s\n"
+                    % (random.randint(1, 512), number, length, sequence))
+gzip_file = fasta_file + ".gz"
+with open(fasta_file, 'rb') as source:
+    with gzip.open(gzip_file, 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+print("%d reads, %.1f MB (%.1f MB gzipped)\n" % (args.READS, os.path.getsize(fasta_file) / 1e6,
+                                              os.path.getsize(gzip_file) / 1e6))
+
+
+def builtin(path, as_bytes=False):
+    def run():
+        for _ in read_sequences(path, as_bytes=as_bytes):
+            pass
+    return run
+
+
+def seqio(path):
+    def run():
+        handle = gzip.open(path, 'rt') if path.endswith(".gz") else open(path)
+        for record in SeqIO.parse(handle, 'fasta'):
+            # The same (name, sequence) pair the built-in reader hands back.
+            _ = record.id, str(record.seq)
+        handle.close()
+    return run
+
+
+timings = [("read_sequences", builtin(fasta_file)), ("read_sequences, bytes", builtin(fasta_file, True)),
+           ("read_sequences, gzip", builtin(gzip_file))]
+if SeqIO:
+    timings[1:1] = [("Bio.SeqIO.parse", seqio(fasta_file))]
+    timings.append(("Bio.SeqIO.parse, gzip", seqio(gzip_file)))
+else:
+    print("Biopython is not installed, so only the built-in reader is timed.\n")
+
+try:
+    for label, function in timings:
+        best = min(timeit.repeat(function, number=1, repeat=args.REPEAT))
+        print("%-24s %8.1f ms  %7.1f MB/s" % (label, best * 1000, os.path.getsize(fasta_file) / 1e6 / best))
+finally:
+    shutil.rmtree(directory)
+
+# Start up cost: a fresh interpreter importing each reader.
+for label, module in [("import ont.sequences", "ont.sequences"), ("import Bio.SeqIO", "Bio.SeqIO")]:
+    if module == "Bio.SeqIO" and not SeqIO:
+        continue
+    command = [sys.executable, "-c", "import time; s = time.time(); import %s; print(time.time() - s)" % module]
+    seconds = min(float(subprocess.check_output(command, cwd=os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), os.pardir))) for _ in range(args.REPEAT))
+    print("%-24s %8.1f ms" % (label, seconds * 1000))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+# End to end benchmark of the realtime scripts on a synthetic run, without a flowcell, nanonet or One Codex.
+# A writer thread plays MinKNOW, putting fast5 files named as MinKNOW names them into a reads directory at
+# --rate reads a second. realtime-pipeline.py (or, with --mode scripts, fast5-transfer-realtime.py,
+# nanonet-realtime.py and onecodex-realtime.py side by side) moves, basecalls with the stub basecaller and
+# classifies them against a stand-in for the One Codex API served from this script.
+# The stub's sequence for a read depends only on its file name, so every search that reaches the stand-in
+# is matched back to the fast5 file it came from, giving the seconds from the file appearing to the read
+# being classified. The stage latencies come from each script's --metrics_file.
+# Run from anywhere: python benchmarks/bench_realtime.py --reads 2000 --rate 50
+# --output writes the results as JSON, and --baseline compares against an earlier --output, exiting with
+# status 1 if throughput or latency is more than --tolerance worse, so it can be run before merging a change.
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+from ont.basecall_service import StubBackend
+from ont.checksum import partial_name
+
+try:
+    import h5py
+    import numpy
+except ImportError:
+    h5py = None
+
+parser = argparse.ArgumentParser(description="Time the realtime scripts end to end on a synthetic run.")
+parser.add_argument("--reads", nargs='?', dest="READS", type=int, default=2000,
+                    help="Number of reads in the synthetic run. Default set at 2000")
+parser.add_argument("--rate", nargs='?', dest="RATE", type=float, default=50,
+                    help="Reads written a second. A MinION gives around 10 to 100. Default set at 50")
+parser.add_argument("--channels", nargs='?', dest="CHANNELS", type=int, default=512,
+                    help="Channels the reads are spread over. Default set at 512")
+parser.add_argument("--mean_samples", nargs='?', dest="MEAN_SAMPLES", type=int, default=20000,
+                    help="Mean raw signal samples in a read, 2 bytes each. Default set at 20000")
+parser.add_argument("--mode", nargs='?', dest="MODE", type=str, default="pipeline", choices=["pipeline", "scripts"],
+                    help="'pipeline' runs realtime-pipeline.py, 'scripts' the three separate scripts. " +
+                         "Default set at pipeline")
+parser.add_argument("--search_delay", nargs='?', dest="SEARCH_DELAY", type=float, default=0.05,
+                    help="Seconds the stand-in One Codex API takes to answer a search. Default set at 0.05")
+parser.add_argument("--port", nargs='?', dest="PORT", type=int, default=8765,
+                    help="Port for the stand-in One Codex API. Default set at 8765")
+parser.add_argument("--watch", nargs='?', dest="WATCH", type=int, default=10,
+                    help="--watch given to the scripts: seconds with no new reads before they finish. " +
+                         "Default set at 10")
+parser.add_argument("--timeout", nargs='?', dest="TIMEOUT", type=int, default=600,
+                    help="Seconds after the last read is written before giving up on the rest. Default set at 600")
+parser.add_argument("--directory", nargs='?', dest="DIRECTORY", type=str,
+                    help="Where the synthetic run is made. Default set at a temporary directory, removed afterwards")
+parser.add_argument("--output", nargs='?', dest="OUTPUT", type=str,
+                    help="Write the results to this JSON file.")
+parser.add_argument("--baseline", nargs='?', dest="BASELINE", type=str,
+                    help="Results JSON file from an earlier --output to compare against.")
+parser.add_argument("--tolerance", nargs='?', dest="TOLERANCE", type=float, default=0.2,
+                    help="Fraction worse than the baseline taken as a regression. Default set at 0.2")
+parser.add_argument("--seed", nargs='?', dest="SEED", type=int, default=1,
+                    help="Seed for the read lengths. Default set at 1")
+parser.add_argument("script_args", nargs=argparse.REMAINDER,
+                    help="Anything after -- is passed on to realtime-pipeline.py, or with --mode scripts to " +
+                         "nanonet-realtime.py, e.g. -- --threads 8 --batch_age 1")
+args = parser.parse_args()
+
+RUN_NAME = "bench"
+RUN_ID = "12345"
+SAMPLING_RATE = 4000.0
+SAMPLES_PER_EVENT = 9
+SCRIPTS_BATCH_AGE = 5  # as realtime-pipeline.py, rather than nanonet-realtime.py's 30
+SCRIPT_ARGS = [arg for arg in args.script_args if arg != "--"]
+
+random.seed(args.SEED)
+if h5py is not None:
+    numpy.random.seed(args.SEED)
+stub = StubBackend()
+
+
+def read_name(channel, number):
+    return "bench_%s_FN_MN00000_sequencing_run_%s_%s_ch%d_read%d_strand.fast5" \
+           % (time.strftime("%Y%m%d"), RUN_NAME, RUN_ID, channel, number)
+
+
+def write_read(directory, name, channel, number, samples):
+    # Written under a partial name and renamed, as a file MinKNOW has finished, so no script sees half a read.
+    temporary = os.path.join(directory, partial_name(name))
+    if h5py is None:
+        with open(temporary, 'wb') as handle:
+            handle.write(os.urandom(samples * 2))
+    else:
+        with h5py.File(temporary, 'w') as handle:
+            attributes = handle.create_group("UniqueGlobalKey/channel_id").attrs
+            attributes["channel_number"] = numpy.bytes_(str(channel))
+            attributes["sampling_rate"] = SAMPLING_RATE
+            start_time = int(time.time() * SAMPLING_RATE)
+            for group, dataset, data in [
+                    ("Raw/Reads/Read_%d" % number, "Signal",
+                     numpy.random.randint(300, 700, samples).astype(numpy.int16)),
+                    ("Analyses/EventDetection_000/Reads/Read_%d" % number, "Events",
+                     numpy.zeros(samples // SAMPLES_PER_EVENT, dtype=[("mean", "f8"), ("start", "i8"),
+                                                                      ("length", "i8"), ("stdv", "f8")]))]:
+                read = handle.create_group(group)
+                read.attrs.update(read_number=number, start_mux=1, start_time=start_time, duration=samples)
+                read.create_dataset(dataset, data=data)
+    os.rename(temporary, os.path.join(directory, name))
+
+
+created = {}  # stub sequence: (fast5 name, time written)
+classified = {}  # fast5 name: time searched
+unmatched = [0]
+lock = threading.Lock()
+
+
+def write_run(directory):
+    start = time.time()
+    read_numbers = [0] * (args.CHANNELS + 1)
+    for index in range(args.READS):
+        delay = start + index / args.RATE - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        channel = random.randint(1, args.CHANNELS)
+        read_numbers[channel] += 1
+        name = read_name(channel, read_numbers[channel])
+        samples = max(1, int(random.expovariate(1.0 / args.MEAN_SAMPLES)))
+        with lock:
+            created[stub.sequence(name)] = (name, time.time())
+        write_read(directory, name, channel, read_numbers[channel], samples)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        sequence = parse_qs(self.rfile.read(length).decode("utf-8")).get("sequence", [""])[0]
+        time.sleep(args.SEARCH_DELAY)
+        with lock:
+            entry = created.get(sequence)
+            if entry is None:
+                unmatched[0] += 1
+            elif entry[0] not in classified:
+                classified[entry[0]] = time.time()
+        data = json.dumps({"tax_id": 562}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *arguments):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def script(name):
+    return [sys.executable, os.path.join(REPOSITORY_DIRECTORY, name)]
+
+
+def commands(directory, api_url):
+    reads_directory = os.path.join(directory, "minknow")
+    server_directory = os.path.join(directory, "server")
+    run_directory = os.path.join(server_directory, RUN_NAME)
+    watch = ["--watch", str(args.WATCH)]
+    if args.MODE == "pipeline":
+        return [script("realtime-pipeline.py") +
+                ["--run_name", RUN_NAME, "--reads_directory", reads_directory, "--server_directory", server_directory,
+                 "--run_directory", run_directory, "--basecaller", "stub", "--api_url", api_url, "--cache", "none",
+                 "--metrics_file", os.path.join(directory, "pipeline.metrics.json")] + watch + SCRIPT_ARGS]
+    return [script("fast5-transfer-realtime.py") +
+            ["--run_name", RUN_NAME, "--reads_directory", reads_directory, "--server_directory", server_directory,
+             "--run_directory", run_directory, "--metrics_file", os.path.join(directory, "transfer.metrics.json")]
+            + watch,
+            script("nanonet-realtime.py") +
+            ["--run_name", RUN_NAME, "--working_directory", run_directory, "--basecaller", "stub",
+             "--batch_age", str(SCRIPTS_BATCH_AGE), "--metrics_file", os.path.join(directory, "basecall.metrics.json")]
+            + watch + SCRIPT_ARGS,
+            # No fasta file appears until the first batch is called, so onecodex-realtime.py waits that much longer.
+            script("onecodex-realtime.py") +
+            ["--run_name", RUN_NAME, "--run_directory", run_directory, "--api_url", api_url, "--cache", "none",
+             "--metrics_file", os.path.join(directory, "classify.metrics.json"),
+             "--watch", str(args.WATCH + SCRIPTS_BATCH_AGE)]]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def stage_metrics(directory):
+    metrics = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".metrics.json"):
+            with open(os.path.join(directory, name)) as handle:
+                metrics.update(json.load(handle)["metrics"])
+    return dict((name, value) for name, value in metrics.items() if isinstance(value, dict) and value["count"])
+
+
+def compare(results, baseline):
+    # (label, key, True if bigger is better)
+    regressions = []
+    print("\nAgainst %s:" % args.BASELINE)
+    for key in ["mode", "reads", "rate", "mean_samples", "search_delay", "script_args"]:
+        if baseline.get(key) != results.get(key):
+            print("  Note, the baseline was run with %s %s rather than %s" % (key, baseline.get(key), results.get(key)))
+    for label, key, bigger_is_better in [("throughput", "reads_per_second", True),
+                                         ("latency p50", "latency_p50", False),
+                                         ("latency p90", "latency_p90", False),
+                                         ("latency p99", "latency_p99", False)]:
+        old, new = baseline.get(key), results.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if bigger_is_better else change
+        flag = "  REGRESSION" if worse > args.TOLERANCE else ""
+        if flag:
+            regressions.append(label)
+        print("  %-12s %10.3f -> %10.3f  %+6.1f%%%s" % (label, old, new, change * 100, flag))
+    return regressions
+
+
+directory = args.DIRECTORY or tempfile.mkdtemp(prefix="bench_realtime_")
+for folder in ["minknow", "server", os.path.join("server", RUN_NAME, "dump"),
+               os.path.join("server", RUN_NAME, "fasta")]:
+    if not os.path.isdir(os.path.join(directory, folder)):
+        os.makedirs(os.path.join(directory, folder))
+if h5py is None:
+    print("h5py or numpy is not installed, so the reads are random bytes rather than HDF5.")
+
+server = ThreadingServer(("127.0.0.1", args.PORT), SearchHandler)
+server_thread = threading.Thread(target=server.serve_forever)
+server_thread.daemon = True
+server_thread.start()
+
+environment = dict(os.environ, ONECODEX_API_KEY="benchmark",
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPOSITORY_DIRECTORY, os.environ.get("PYTHONPATH")])))
+log = open(os.path.join(directory, "scripts.log"), 'a+')
+processes = [subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=environment)
+             for command in commands(directory, "http://127.0.0.1:%d/api/v0/search" % args.PORT)]
+
+print("Writing %d reads at %g a second to %s, %s mode" % (args.READS, args.RATE, directory, args.MODE))
+start = time.time()
+writer = threading.Thread(target=write_run, args=(os.path.join(directory, "minknow"),))
+writer.start()
+writer.join()
+written = time.time()
+print("Written in %.1f seconds, waiting for them to be classified" % (written - start))
+
+while len(classified) < args.READS and time.time() - written < args.TIMEOUT:
+    if all(process.poll() is not None for process in processes):
+        break
+    time.sleep(0.2)
+finished = time.time()
+# The scripts stop once they have seen no reads for --watch seconds, which leaves their final metrics.
+for process in processes:
+    while process.poll() is None and time.time() - finished < args.WATCH * 3 + 30:
+        time.sleep(0.2)
+    if process.poll() is None:
+        process.terminate()
+    process.wait()
+log.close()
+server.shutdown()
+
+with lock:
+    times = dict((name, when) for name, when in created.values())
+    latencies = sorted(classified[name] - times[name] for name in classified)
+    last = max(classified.values()) if classified else start
+
+results = {"mode": args.MODE, "reads": args.READS, "rate": args.RATE, "mean_samples": args.MEAN_SAMPLES,
+           "search_delay": args.SEARCH_DELAY, "script_args": SCRIPT_ARGS, "classified": len(classified),
+           "unmatched_searches": unmatched[0], "seconds": round(last - start, 3),
+           "reads_per_second": round(len(classified) / (last - start), 3) if classified else 0,
+           "stages": stage_metrics(directory)}
+for fraction in (0.5, 0.9, 0.99, 1):
+    key = "latency_max" if fraction == 1 else "latency_p%d" % (fraction * 100)
+    results[key] = round(percentile(latencies, fraction), 3) if latencies else None
+
+print("\nClassified %d of %d reads in %.1f seconds, %.1f reads a second"
+      % (len(classified), args.READS, results["seconds"], results["reads_per_second"]))
+if latencies:
+    print("Seconds from fast5 written to read classified: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f"
+          % (results["latency_p50"], results["latency_p90"], results["latency_p99"], results["latency_max"]))
+if unmatched[0]:
+    print("%d searches did not match a read written by this benchmark" % unmatched[0])
+print("\n%-34s %8s %9s %9s %9s %9s" % ("stage (seconds)", "count", "mean", "p50", "p90", "p99"))
+for name, value in sorted(results["stages"].items()):
+    print("%-34s %8d %9.3f %9s %9s %9s"
+          % (name, value["count"], value["mean"], value["p50"], value["p90"], value["p99"]))
+print("(p50, p90 and p99 are the upper bounds of the metrics' histogram buckets)")
+
+if args.OUTPUT:
+    with open(args.OUTPUT, 'w') as handle:
+        json.dump(results, handle, indent=1, sort_keys=True)
+        handle.write("\n")
+
+regressions = []
+if args.BASELINE:
+    with open(args.BASELINE) as handle:
+        regressions = compare(results, json.load(handle))
+
+if args.DIRECTORY:
+    print("\nThe run, the scripts' logs and their output are in %s" % directory)
+else:
+    shutil.rmtree(directory)
+
+if len(classified) < args.READS or regressions:
+    sys.exit(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+# Stand-in for the One Codex search API, for testing onecodex-realtime.py without using (or paying for) the
+# real one. Answers POST /api/v0/search with a tax_id made up from the sequence, after --delay seconds.
+# More than --rate_limit requests in a second get a 429 with a Retry-After, as the real API does when busy.
+# python benchmarks/mock_onecodex_server.py --port 8765 &
+# onecodex-realtime.py --api_url http://localhost:8765/api/v0/search ...
+
+parser = argparse.ArgumentParser(description="Local stand-in for the One Codex search API.")
+parser.add_argument("--port", nargs='?', dest="PORT", type=int, default=8765,
+                    help="Port to listen on. Default set at 8765")
+parser.add_argument("--delay", nargs='?', dest="DELAY", type=float, default=0.05,
+                    help="Seconds taken to answer each search. Default set at 0.05")
+parser.add_argument("--rate_limit", nargs='?', dest="RATE_LIMIT", type=int, default=0,
+                    help="Requests allowed per second before answering 429. Default set at 0 (no limit)")
+parser.add_argument("--unclassified", nargs='?', dest="UNCLASSIFIED", type=float, default=0.3,
+                    help="Fraction of sequences given tax_id 0. Default set at 0.3")
+args = parser.parse_args()
+
+TAX_IDS = [562, 1280, 1773, 287, 573, 1352, 470, 90371]  # E. coli, S. aureus, M. tuberculosis, ...
+
+lock = threading.Lock()
+window = [0, 0]  # second, requests in that second
+counts = {"searches": 0, "rate_limited": 0}
+
+
+def tax_id(sequence):
+    digest = bytearray(hashlib.md5(sequence.encode("utf-8")).digest())
+    if digest[0] / 256.0 < args.UNCLASSIFIED:
+        return 0
+    return TAX_IDS[digest[1] % len(TAX_IDS)]
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real API
+    wbufsize = -1  # headers and body in one send, or every reply waits on a delayed ack
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if not self.path.endswith("/search"):
+            return self.reply(404, {"message": "Not found"})
+        if not self.headers.get("Authorization"):
+            return self.reply(400, {"message": "No API key"})
+        if args.RATE_LIMIT:
+            with lock:
+                now = int(time.time())
+                if window[0] != now:
+                    window[0], window[1] = now, 0
+                window[1] += 1
+                limited = window[1] > args.RATE_LIMIT
+                if limited:
+                    counts["rate_limited"] += 1
+            if limited:
+                return self.reply(429, {"message": "Rate limited"}, [("Retry-After", "1")])
+        time.sleep(args.DELAY)
+        with lock:
+            counts["searches"] += 1
+        self.reply(200, {"tax_id": tax_id(form.get("sequence", [""])[0])})
+
+    def log_message(self, *arguments):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+server = ThreadingServer(("127.0.0.1", args.PORT), SearchHandler)
+print("Mock One Codex search API on http://127.0.0.1:%d/api/v0/search" % args.PORT)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print("%(searches)d searches answered, %(rate_limited)d rate limited" % counts)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import paramiko
+except ImportError:
+    sys.exit("Error: the SFTP stand-in needs the paramiko module (pip install paramiko)")
+
+# Stand-in for an ssh server, for testing fast5-transfer-realtime.py --transport sftp without an sshd.
+# An SFTP server runs in this process on --port, over the paramiko library the transfers themselves use,
+# serving --root as the server's filesystem. It makes a host key and a login key, writes the host key to a
+# known_hosts file in --keys and prints the fast5-transfer-realtime.py options that use them.
+# python benchmarks/mock_sftp_server.py --port 2222 --root /tmp/sftp_root &
+# With --smoke it instead runs fast5-transfer-realtime.py through it on a synthetic run, once sending each
+# read as it is and once in bundles, checks every read arrived intact and exits with status 1 if not.
+# python benchmarks/mock_sftp_server.py --smoke
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+from ont.bundle import is_bundle, unpack_bundle
+from ont.checksum import PARTIAL_SUFFIX, file_checksum
+
+parser = argparse.ArgumentParser(description="Local stand-in for an ssh server, serving SFTP only.")
+parser.add_argument("--port", nargs='?', dest="PORT", type=int, default=2222,
+                    help="Port to listen on. Default set at 2222")
+parser.add_argument("--root", nargs='?', dest="ROOT", type=str,
+                    help="Directory served as the server's /. Default set at a temporary directory")
+parser.add_argument("--keys", nargs='?', dest="KEYS", type=str,
+                    help="Directory the login key and known_hosts file are written to. Default set at a " +
+                         "temporary directory")
+parser.add_argument("--smoke", action="store_true", dest="SMOKE",
+                    help="Run fast5-transfer-realtime.py through the stand-in on a synthetic run and check the reads.")
+parser.add_argument("--reads", nargs='?', dest="READS", type=int, default=40,
+                    help="Number of reads in each --smoke run. Default set at 40")
+args = parser.parse_args()
+
+# paramiko logs every client that closes its connection without saying goodbye as an error.
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+RUN_NAME = "smoke"
+USER = "minion"
+WATCH = 3
+
+
+class StubServer(paramiko.ServerInterface):
+    # Anyone with the login key may open sessions, and the sessions may only run the sftp subsystem.
+
+    def __init__(self, login_key):
+        self.login_key = login_key
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() == self.login_key.get_base64():
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    # Every path is taken as relative to the root directory.
+    root = None
+
+    def _local(self, path):
+        return self.root + self.canonicalize(path)
+
+    def _attempt(self, function, *arguments):
+        try:
+            function(*arguments)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        path = self._local(path)
+        try:
+            listing = []
+            for name in os.listdir(path):
+                attributes = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attributes.filename = name
+                listing.append(attributes)
+            return listing
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attr):
+        path = self._local(path)
+        try:
+            descriptor = os.open(path, flags | getattr(os, "O_BINARY", 0), getattr(attr, "st_mode", None) or 0o666)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        return self._attempt(os.remove, self._local(path))
+
+    def rename(self, oldpath, newpath):
+        # SFTP's own rename fails if the new path exists.
+        if os.path.exists(self._local(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self._attempt(os.rename, self._local(oldpath), self._local(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._attempt(os.rename, self._local(oldpath), self._local(newpath))
+
+    def mkdir(self, path, attr):
+        return self._attempt(os.mkdir, self._local(path))
+
+    def rmdir(self, path):
+        return self._attempt(os.rmdir, self._local(path))
+
+    def chattr(self, path, attr):
+        return self._attempt(paramiko.SFTPServer.set_file_attr, self._local(path), attr)
+
+
+def serve(listener, host_key, login_key):
+    # Each connection gets its own paramiko transport thread, as an sshd would fork.
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except socket.error:
+            return
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, StubSFTPServer)
+        transport.start_server(server=StubServer(login_key))
+
+
+def start(root, keys, port):
+    # Returns the options fast5-transfer-realtime.py needs to reach the stand-in, which runs on a daemon thread.
+    StubSFTPServer.root = os.path.abspath(root).rstrip("/")
+    host_key = paramiko.RSAKey.generate(2048)
+    login_key = paramiko.RSAKey.generate(2048)
+    login_key_file = os.path.join(keys, "login_key")
+    login_key.write_private_key_file(login_key_file)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(16)
+    port = listener.getsockname()[1]
+    known_hosts_file = os.path.join(keys, "known_hosts")
+    known_hosts = paramiko.HostKeys()
+    known_hosts.add("[127.0.0.1]:%d" % port, host_key.get_name(), host_key)
+    known_hosts.save(known_hosts_file)
+    thread = threading.Thread(target=serve, args=(listener, host_key, login_key))
+    thread.daemon = True
+    thread.start()
+    return ["--transport", "sftp", "--sftp_host", "127.0.0.1", "--sftp_port", str(port), "--sftp_user", USER,
+            "--sftp_key", login_key_file, "--sftp_known_hosts", known_hosts_file]
+
+
+def read_name(channel, number):
+    return "smoke_%s_FN_MN00000_sequencing_run_%s_12345_ch%d_read%d_strand.fast5" \
+           % (time.strftime("%Y%m%d"), RUN_NAME, channel, number)
+
+
+def smoke_run(directory, root, options, label, extra):
+    # Send a synthetic run with fast5-transfer-realtime.py and return the problems found with what arrived.
+    reads_directory = os.path.join(directory, label, "reads")
+    os.makedirs(reads_directory)
+    run_directory = "/" + label
+    os.makedirs(root + run_directory)
+    checksums = {}
+    for number in range(args.READS):
+        name = read_name(number % 7 + 1, number + 1)
+        with open(os.path.join(reads_directory, name), 'wb') as handle:
+            handle.write(os.urandom(1000 + number * 997))
+        checksums[name] = file_checksum(os.path.join(reads_directory, name), "crc32")
+    command = [sys.executable, os.path.join(REPOSITORY_DIRECTORY, "fast5-transfer-realtime.py"),
+               "--run_name", RUN_NAME, "--reads_directory", reads_directory, "--server_directory", "/",
+               "--run_directory", run_directory, "--watch", str(WATCH)] + options + extra
+    with open(os.path.join(directory, label, "script.log"), 'w') as log:
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=directory)
+    problems = []
+    if status:
+        problems.append("fast5-transfer-realtime.py exited with status %d, see %s"
+                        % (status, os.path.join(directory, label, "script.log")))
+    dump = root + run_directory + "/dump"
+    unpacked = os.path.join(directory, label, "unpacked")
+    os.makedirs(unpacked)
+    for name in os.listdir(dump) if os.path.isdir(dump) else []:
+        if name.endswith(PARTIAL_SUFFIX):
+            problems.append("%s left on the server" % name)
+        elif is_bundle(name):
+            unpack_bundle(os.path.join(dump, name), unpacked, remove=False)
+        elif name.endswith(".fast5"):
+            shutil.copy(os.path.join(dump, name), unpacked)
+    arrived = dict((name, file_checksum(os.path.join(unpacked, name), "crc32")) for name in os.listdir(unpacked))
+    for name, checksum in sorted(checksums.items()):
+        if name not in arrived:
+            problems.append("%s did not arrive" % name)
+        elif arrived[name] != checksum:
+            problems.append("%s arrived as %s, sent as %s" % (name, arrived[name], checksum))
+    left = [name for name in os.listdir(reads_directory) if name.endswith(".fast5")]
+    if left:
+        problems.append("%d reads left on the laptop" % len(left))
+    print("%-8s %d reads sent, %d arrived intact, %d problems"
+          % (label, len(checksums), sum(arrived.get(name) == checksum for name, checksum in checksums.items()),
+             len(problems)))
+    return problems
+
+
+directory = tempfile.mkdtemp(prefix="mock_sftp_")
+root = args.ROOT or os.path.join(directory, "root")
+keys = args.KEYS or os.path.join(directory, "keys")
+for folder in (root, keys):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+options = start(root, keys, 0 if args.SMOKE else args.PORT)
+
+if not args.SMOKE:
+    print("Serving %s over SFTP. Use fast5-transfer-realtime.py with --server_directory / %s"
+          % (root, " ".join(options)))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+problems = smoke_run(directory, root, options, "reads", [])
+problems += smoke_run(directory, root, options, "bundles", ["--bundle_reads", "8", "--bundle_age", "1"])
+for problem in problems:
+    print("  " + problem)
+if problems:
+    print("The runs are in %s" % directory)
+    sys.exit(1)
+shutil.rmtree(directory)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import sys
+import time
+from collections import deque
+
+from ont.checksum import PARTIAL_PREFIX, PARTIAL_SUFFIX
+from ont.fast5_names import parse
+from ont.multi_fast5 import PACK_MARKER, extract_read, is_pack, packed_reads, read_index, unpack, write_pack
+from ont.watcher import DirectoryWatcher
+
+# A run leaves hundreds of thousands of single read fast5 files in the dump and reads folders, which are then
+# slow to list, back up and delete. This script packs them, as they arrive, into multi-read fast5 files of a
+# few thousand reads each, and with --unpack writes single reads back out for anything that needs them.
+
+help_descriptor = "This script packs single read fast5 files into multi-read fast5 files, each with an index " + \
+                  "of the reads in it, and removes the single read files once they are safely packed. " + \
+                  "It watches the directory like the other realtime scripts. With --unpack it does the reverse."
+
+parser = argparse.ArgumentParser(description=help_descriptor)
+parser.add_argument('--version', action='version', version="%(prog)s 1.0")
+parser.add_argument("--run_name", nargs='?', dest="RUN_NAME", type=str,
+                    help="The run name, used to name the packed files.", required=True)
+parser.add_argument("--directory", nargs='?', dest="DIRECTORY", type=str,
+                    help="The directory of fast5 files to pack, or of packed files to unpack. Do not pack a " +
+                         "directory that another program is still reading single reads from, such as the dump " +
+                         "folder while nanonet-realtime.py is running, or the reads folder before metrichor " +
+                         "has uploaded it.", required=True)
+parser.add_argument("--reads_per_pack", nargs='?', dest="READS_PER_PACK", type=int,
+                    help="Number of reads in each packed file. Default set at 4000")
+parser.add_argument("--min_age", nargs='?', dest="MIN_AGE", type=int,
+                    help="Time (seconds) a read must have been in the directory before it is packed. Default " +
+                         "set at 60")
+parser.add_argument("--watch", nargs='?', dest="WATCH", type=int,
+                    help="The time (seconds) allowed with no new fast5 files entering the directory before " +
+                         "packing what is left and exiting. Default set at 800")
+parser.add_argument("--poll", action="store_true", dest="POLL",
+                    help="Poll the directory instead of using inotify. Use this if the directory is mounted from " +
+                         "another machine, where inotify does not see changes.")
+parser.add_argument("--unpack", action="store_true", dest="UNPACK",
+                    help="Write the reads in the packed files in the directory back out as single read files.")
+parser.add_argument("--reads", nargs='*', dest="READS", type=str,
+                    help="With --unpack, only these reads (read ids or fast5 file names). Needs " +
+                         "--output_directory, as the packs they come from are kept.")
+parser.add_argument("--output_directory", nargs='?', dest="OUTPUT_DIRECTORY", type=str,
+                    help="With --unpack, where the single read files are written. If not specified, the " +
+                         "directory itself, in which case the packed files are removed once unpacked.")
+parser.add_argument("--logfile", nargs='?', dest="LOGFILE", type=str,
+                    help="This is the file that some general notes are printed to. If not specified," +
+                         "the file will be <directory>/../log/<run_name>.pack.log")
+args = parser.parse_args()
+
+RUN_NAME = args.RUN_NAME
+DIRECTORY = args.DIRECTORY
+READS_PER_PACK = args.READS_PER_PACK
+MIN_AGE = args.MIN_AGE
+WATCH = args.WATCH
+POLL = args.POLL
+UNPACK = args.UNPACK
+READS = args.READS
+OUTPUT_DIRECTORY = args.OUTPUT_DIRECTORY
+LOGFILE = args.LOGFILE
+
+# Defaults
+READS_PER_PACK_DEFAULT = 4000
+MIN_AGE_DEFAULT = 60
+WATCH_DEFAULT = 800
+date = time.strftime("%Y_%m_%d")
+
+if not os.path.isdir(DIRECTORY):
+    error_message = "Error: cannot locate or find directory %s" % DIRECTORY
+    sys.exit(error_message)
+DIRECTORY = os.path.abspath(DIRECTORY) + "/"
+
+if not READS_PER_PACK:
+    READS_PER_PACK = READS_PER_PACK_DEFAULT
+    general_message = "Reads per pack not defined. Using %d" % READS_PER_PACK_DEFAULT
+    print(general_message)
+
+if MIN_AGE is None:
+    MIN_AGE = MIN_AGE_DEFAULT
+
+if not WATCH:
+    WATCH = WATCH_DEFAULT
+
+if LOGFILE:
+    if not os.path.isfile(LOGFILE):
+        error_message = "Log file specifed but does not exist."
+        sys.exit(error_message)
+else:
+    log_directory = os.path.dirname(DIRECTORY.rstrip("/")) + "/log/"
+    if not os.path.isdir(log_directory):
+        os.makedirs(log_directory)
+    LOGFILE = log_directory + date + "_" + RUN_NAME + ".pack.log"
+    general_message = "Log file not defined, using %s" % LOGFILE
+    print(general_message)
+
+start_time = time.time()
+
+if UNPACK:
+    if OUTPUT_DIRECTORY:
+        if not os.path.isdir(OUTPUT_DIRECTORY):
+            error_message = "Error: cannot locate or find output directory %s" % OUTPUT_DIRECTORY
+            sys.exit(error_message)
+    else:
+        OUTPUT_DIRECTORY = DIRECTORY
+    # The packs are kept when only some reads are unpacked, and the next run that packs the directory would
+    # take their reads for ones it packed before stopping, and remove them.
+    if READS and os.path.samefile(OUTPUT_DIRECTORY, DIRECTORY):
+        sys.exit("Error: --reads cannot be unpacked into %s, the directory they were packed from. Use "
+                 "--output_directory" % DIRECTORY)
+    reads_unpacked = 0
+    try:
+        if READS:
+            # The indexes say which pack each read is in, so only those packs are opened.
+            packs = packed_reads(DIRECTORY)
+            for pack_path in set(packs.values()):
+                packs.update((entry[0], pack_path) for entry in read_index(pack_path))
+            for read in READS:
+                pack_path = packs.get(read)
+                if not pack_path:
+                    print("Warning, %s is not in any packed file in %s" % (read, DIRECTORY))
+                    continue
+                extract_read(pack_path, read, OUTPUT_DIRECTORY)
+                reads_unpacked += 1
+        else:
+            for name in sorted(os.listdir(DIRECTORY)):
+                if is_pack(name):
+                    reads_unpacked += len(unpack(DIRECTORY + name, OUTPUT_DIRECTORY,
+                                                 remove=os.path.samefile(OUTPUT_DIRECTORY, DIRECTORY)))
+    except ImportError as error:
+        sys.exit("Error: %s" % error)
+    logger = open(LOGFILE, 'a+')
+    logger.write("Unpacked %d reads from %s into %s in %d seconds\n" % (reads_unpacked, DIRECTORY, OUTPUT_DIRECTORY,
+                                                                        time.time() - start_time))
+    logger.close()
+    sys.exit(0)
+
+# A pack being written when the script last stopped is started again, and single reads that made it into a
+# pack before the script stopped are removed now.
+for name in os.listdir(DIRECTORY):
+    if name.startswith(PARTIAL_PREFIX) and name.endswith(PARTIAL_SUFFIX) and PACK_MARKER in name:
+        os.remove(DIRECTORY + name)
+already_packed = packed_reads(DIRECTORY)
+for name in os.listdir(DIRECTORY):
+    if name in already_packed:
+        os.remove(DIRECTORY + name)
+
+logger = open(LOGFILE, 'a+')
+logger.write("The time is %s\n" % time.strftime("%c"))
+logger.write("Packing fast5 files in %s, %d reads to a file. %d reads already packed\n"
+             % (DIRECTORY, READS_PER_PACK, len(already_packed)))
+logger.close()
+
+# Reads waiting to be packed, oldest first, with the time each was first seen.
+waiting = deque()
+seen = set()
+packs_written = 0
+reads_packed = 0
+
+
+def is_single_read(name):
+    return parse(name) is not None and not is_pack(name)
+
+
+def pack(count):
+    global packs_written, reads_packed
+    names = [waiting.popleft()[1] for _ in range(count)]
+    paths = [DIRECTORY + name for name in names if os.path.isfile(DIRECTORY + name)]
+    if paths:
+        pack_path, entries = write_pack(paths, DIRECTORY, RUN_NAME)
+        # Only removed once the pack and its index are on disk.
+        packed = set(entry[2] for entry in entries)
+        for path in paths:
+            if os.path.basename(path) in packed:
+                os.remove(path)
+            else:
+                print("Warning, %s could not be read as a fast5 file and was left unpacked" % path)
+        if pack_path:
+            packs_written += 1
+            reads_packed += len(entries)
+    seen.difference_update(names)
+
+
+def log_idle(idle_seconds, remaining_seconds):
+    abstinence_message = "No fast5 files found in the last %d seconds.\n" % idle_seconds
+    sleeping_message = "Waiting for new reads, breaking in %d if no more reads created.\n" % remaining_seconds
+    print(abstinence_message)
+    print(sleeping_message)
+
+
+watcher = DirectoryWatcher(DIRECTORY, match=is_single_read, watch=WATCH, on_idle=log_idle, use_inotify=not POLL,
+                           tick=MIN_AGE or None)
+try:
+    for new_files in watcher.batches():
+        now = time.time()
+        for name in sorted(new_files):
+            if name not in seen:
+                seen.add(name)
+                waiting.append((now, name))
+        # Whole packs of reads that have been here at least min_age seconds.
+        settled = 0
+        for first_seen, name in waiting:
+            if now - first_seen < MIN_AGE:
+                break
+            settled += 1
+        while settled >= READS_PER_PACK:
+            pack(READS_PER_PACK)
+            settled -= READS_PER_PACK
+    # And whatever is left at the end of the run.
+    while waiting:
+        pack(min(len(waiting), READS_PER_PACK))
+except ImportError as error:
+    sys.exit("Error: %s" % error)
+
+logger = open(LOGFILE, 'a+')
+logger.write("No fast5 files found for %d seconds\n" % WATCH)
+logger.write("Packed %d reads into %d files in %d seconds\n" % (reads_packed, packs_written, time.time() - start_time))
+logger.close()
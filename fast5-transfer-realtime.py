@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 import os
-import shutil
 import time
 import argparse
 import sys
 
+from ont.bundle import Bundler, bundle_name
+from ont.checksum import algorithms
+from ont.disk_space import TransferScheduler
+from ont.fast5_info import Fast5InfoCache, is_short
+from ont.fast5_names import is_run_read
+from ont.manifest import TransferManifest
+from ont.metrics import REGISTRY, MetricsExporters
+from ont.scanner import RETRY_DELAY, FileBacklog
+from ont.transfer import TransferPool
+from ont.transport import LocalTransport, SFTPTransport
+from ont.watcher import DirectoryWatcher
+
 # This script is designed to transfer data from the output on the laptop produced by MinKNOW to a server.
 # This script will be required to be run from a computer that has access to both the laptop and the server.
 # Hence it is possible to run this script on the laptop concurrently with MinKNOW if it can see the server.
@@ -14,8 +25,8 @@ version = "%(prog)s 1.0"
 
 # Configure arguments
 help_descriptor = "This is a script designed to remove fast5 files from a laptop onto a server." + \
-                  "There is not currently any support for FTP or for scp commands. This script only" + \
-                  "works in circumstances where you can map the network drive. You only need three arguments" + \
+                  "The server may be a mapped network drive or, with --transport sftp, reached over ssh." + \
+                  " You only need three arguments" + \
                   "for this command to run. 1 - Run name, 2 - Reads directory, 3 - Server directory. The reads" + \
                   "will then placed into a folder YYYY_MM_DD_<RUN_NAME>/dump in the server directory."
 
@@ -42,6 +53,88 @@ parser.add_argument("--dump_directory", nargs='?', dest="DUMP_DIRECTORY", type=s
 parser.add_argument("--watch", nargs='?', dest="WATCH", type=int,
                     help="This time (seconds) allowed with no new fast5 files" +
                          "entering the reads folder before exiting the script. Default set at 800")
+parser.add_argument("--poll", action="store_true", dest="POLL",
+                    help="Poll the reads directory instead of using inotify. Use this if the reads directory " +
+                         "is itself on a network drive, where inotify does not see changes.")
+parser.add_argument("--transfer_threads", nargs='?', dest="TRANSFER_THREADS", type=int,
+                    help="Number of files transferred at once. Default set at 4")
+parser.add_argument("--queue_size", nargs='?', dest="QUEUE_SIZE", type=int,
+                    help="Maximum number of files waiting to be transferred before the scan waits for the " +
+                         "server to catch up. Default set at 256")
+parser.add_argument("--checksum", nargs='?', dest="CHECKSUM", type=str, choices=algorithms() + ["none"],
+                    help="Checksum used to verify each read is intact on the server before it is deleted from " +
+                         "the laptop. 'none' moves files without checking. Default set at crc32")
+parser.add_argument("--no_read_back", action="store_false", dest="READ_BACK",
+                    help="Do not read each copy back from the server to compare its checksum before the read is " +
+                         "deleted from the laptop, only its size. Reading back doubles the traffic to the " +
+                         "server, but without it a read corrupted on its way to the server is still deleted " +
+                         "from the laptop. Only for --transport local.")
+parser.add_argument("--transport", nargs='?', dest="TRANSPORT", type=str, choices=["local", "sftp"],
+                    help="How to reach the server. 'local' for a mapped network drive, 'sftp' to send files " +
+                         "over ssh, in which case the server directory is a path on the server. Default set at local")
+parser.add_argument("--sftp_host", nargs='?', dest="SFTP_HOST", type=str,
+                    help="The server to send files to when using the sftp transport. The host key must already " +
+                         "be in your known_hosts file, or in --sftp_known_hosts.")
+parser.add_argument("--sftp_port", nargs='?', dest="SFTP_PORT", type=int, default=22,
+                    help="The ssh port on the server. Default set at 22")
+parser.add_argument("--sftp_user", nargs='?', dest="SFTP_USER", type=str,
+                    help="The user to log in to the server as. If not specified, your current user name.")
+parser.add_argument("--sftp_key", nargs='?', dest="SFTP_KEY", type=str,
+                    help="Private key used to log in to the server. If not specified, your ssh agent and " +
+                         "default keys are tried.")
+parser.add_argument("--sftp_known_hosts", nargs='?', dest="SFTP_KNOWN_HOSTS", type=str,
+                    help="A known_hosts file holding the server's host key, trusted as well as your own " +
+                         "known_hosts file.")
+parser.add_argument("--bundle_reads", nargs='?', dest="BUNDLE_READS", type=int, default=0,
+                    help="Send reads in tar bundles of up to this many reads rather than one file at a time. " +
+                         "Much faster over high latency links. Bundles are unpacked by nanonet-realtime.py. " +
+                         "Default set at 0 (no bundling)")
+parser.add_argument("--bundle_megabytes", nargs='?', dest="BUNDLE_MEGABYTES", type=int, default=64,
+                    help="Maximum size of a bundle in megabytes. Default set at 64")
+parser.add_argument("--bundle_age", nargs='?', dest="BUNDLE_AGE", type=int, default=10,
+                    help="Seconds a read may wait for its bundle to fill before the bundle is sent anyway. " +
+                         "Default set at 10")
+parser.add_argument("--bundle_compression", nargs='?', dest="BUNDLE_COMPRESSION", type=str, default="none",
+                    choices=["none", "gz"],
+                    help="Compress bundles. Only worthwhile when the link, not the laptop, is the bottleneck. " +
+                         "Default set at none")
+parser.add_argument("--min_events", nargs='?', dest="MIN_EVENTS", type=int,
+                    help="Reads with fewer events than this, or no signal at all, are sent after the other reads " +
+                         "found with them, as nanonet will not call them. Each read is opened to count its events, " +
+                         "which needs h5py. Default set at 0 (reads are not opened)")
+parser.add_argument("--adaptive", action="store_true", dest="ADAPTIVE",
+                    help="Set the number of files transferred at once from the free space on the laptop: up to " +
+                         "--max_transfer_threads when space is low, and down to --min_transfer_threads while " +
+                         "MinKNOW is writing and space is plentiful, to leave the disk to MinKNOW. Bundles are " +
+                         "made twice as large while space is low. Without it the free space and the time until the " +
+                         "laptop is full are only written to the log.")
+parser.add_argument("--min_transfer_threads", nargs='?', dest="MIN_TRANSFER_THREADS", type=int,
+                    help="With --adaptive, the files transferred at once while giving way to MinKNOW. " +
+                         "Default set at 1")
+parser.add_argument("--max_transfer_threads", nargs='?', dest="MAX_TRANSFER_THREADS", type=int,
+                    help="With --adaptive, the files transferred at once while space is low. Default set at " +
+                         "twice --transfer_threads")
+parser.add_argument("--low_space", nargs='?', dest="LOW_SPACE", type=float,
+                    help="Percentage of the laptop's disk free below which space is low. Space is also low if " +
+                         "the disk will be full within the hour at the rate it is filling. Default set at 20")
+parser.add_argument("--high_space", nargs='?', dest="HIGH_SPACE", type=float,
+                    help="Percentage of the laptop's disk free above which transfers give way to MinKNOW " +
+                         "while it is writing. Default set at 50")
+parser.add_argument("--server_reserve", nargs='?', dest="SERVER_RESERVE", type=float,
+                    help="Megabytes to keep free on the server. Transfers pause while it has less than this free, " +
+                         "with or without --adaptive, and carry on once it has twice this. Not checked over sftp. " +
+                         "0 turns it off. Default set at 1000")
+parser.add_argument("--metrics_port", nargs='?', dest="METRICS_PORT", type=int,
+                    help="Serve counters, rates and latencies for each stage at http://localhost:<port>/metrics, in " +
+                         "the Prometheus text format, while the script runs. Default set at 0 (off)")
+parser.add_argument("--metrics_file", nargs='?', dest="METRICS_FILE", type=str,
+                    help="Write the same metrics, and the rate of each counter, as JSON to this file every " +
+                         "--metrics_interval seconds. Default set at none")
+parser.add_argument("--metrics_interval", nargs='?', dest="METRICS_INTERVAL", type=int, default=10,
+                    help="How often (seconds) the metrics file is written. Default set at 10")
+parser.add_argument("--manifest", nargs='?', dest="MANIFEST", type=str,
+                    help="This is the file recording every read transferred, used to resume after a restart." +
+                         " If not specified, the file will be RUN_DIRECTORY/log/<run_name>.transfer.manifest")
 parser.add_argument("--logfile", nargs='?', dest="LOGFILE", type=str,
                     help="This is the file that some general notes are printed to. If not specified," +
                          "the file will be RUN_DIRECTORY/log/<run_name>.move.log")
@@ -55,9 +148,42 @@ RUN_DIRECTORY = args.RUN_DIRECTORY
 DUMP_DIRECTORY = args.DUMP_DIRECTORY
 WATCH = args.WATCH
 LOGFILE = args.LOGFILE
+POLL = args.POLL
+TRANSFER_THREADS = args.TRANSFER_THREADS
+QUEUE_SIZE = args.QUEUE_SIZE
+MANIFEST = args.MANIFEST
+CHECKSUM = args.CHECKSUM
+READ_BACK = args.READ_BACK
+TRANSPORT = args.TRANSPORT or "local"
+SFTP_HOST = args.SFTP_HOST
+SFTP_PORT = args.SFTP_PORT
+SFTP_USER = args.SFTP_USER
+SFTP_KEY = args.SFTP_KEY
+SFTP_KNOWN_HOSTS = args.SFTP_KNOWN_HOSTS
+BUNDLE_READS = args.BUNDLE_READS
+BUNDLE_MEGABYTES = args.BUNDLE_MEGABYTES
+BUNDLE_AGE = args.BUNDLE_AGE
+BUNDLE_COMPRESSION = args.BUNDLE_COMPRESSION
+MIN_EVENTS = args.MIN_EVENTS
+ADAPTIVE = args.ADAPTIVE
+MIN_TRANSFER_THREADS = args.MIN_TRANSFER_THREADS
+MAX_TRANSFER_THREADS = args.MAX_TRANSFER_THREADS
+LOW_SPACE = args.LOW_SPACE
+HIGH_SPACE = args.HIGH_SPACE
+SERVER_RESERVE = args.SERVER_RESERVE
+METRICS_PORT = args.METRICS_PORT
+METRICS_FILE = args.METRICS_FILE
+METRICS_INTERVAL = args.METRICS_INTERVAL
 
 # Defaults
 WATCH_DEFAULT = 800
+TRANSFER_THREADS_DEFAULT = 4
+MIN_TRANSFER_THREADS_DEFAULT = 1
+LOW_SPACE_DEFAULT = 20
+HIGH_SPACE_DEFAULT = 50
+SERVER_RESERVE_DEFAULT = 1000
+QUEUE_SIZE_DEFAULT = 256
+CHECKSUM_DEFAULT = "crc32"
 INVALID_SYMBOLS = "~`!@#$%^&*()-+={}[]:>;',</?*-+"
 
 # Set the time
@@ -77,116 +203,303 @@ if not os.path.isdir(READS_DIRECTORY):
     sys.exit(error_message)
 READS_DIRECTORY = os.path.abspath(READS_DIRECTORY) + "/"
 
+if not CHECKSUM:
+    CHECKSUM = CHECKSUM_DEFAULT
+    general_message = "Checksum not defined. Using %s" % CHECKSUM_DEFAULT
+    print(general_message)
+
+if not TRANSFER_THREADS:
+    TRANSFER_THREADS = TRANSFER_THREADS_DEFAULT
+    general_message = "Transfer threads not defined. Using %s" % TRANSFER_THREADS_DEFAULT
+    print(general_message)
+
+if not MIN_TRANSFER_THREADS:
+    MIN_TRANSFER_THREADS = MIN_TRANSFER_THREADS_DEFAULT
+if not MAX_TRANSFER_THREADS:
+    MAX_TRANSFER_THREADS = 2 * TRANSFER_THREADS
+if LOW_SPACE is None:
+    LOW_SPACE = LOW_SPACE_DEFAULT
+if HIGH_SPACE is None:
+    HIGH_SPACE = HIGH_SPACE_DEFAULT
+if SERVER_RESERVE is None:
+    SERVER_RESERVE = SERVER_RESERVE_DEFAULT
+if not MIN_TRANSFER_THREADS <= TRANSFER_THREADS <= MAX_TRANSFER_THREADS:
+    error_message = "Error: --min_transfer_threads, --transfer_threads and --max_transfer_threads must be in order"
+    sys.exit(error_message)
+if not 0 <= LOW_SPACE <= HIGH_SPACE <= 100:
+    error_message = "Error: --low_space and --high_space must be percentages with --low_space the lower"
+    sys.exit(error_message)
+# Threads for the most files ever transferred at once. Those not allowed to work wait.
+pool_threads = MAX_TRANSFER_THREADS if ADAPTIVE else TRANSFER_THREADS
+
+# Set up the connection to the server. The server, run and dump directories are paths on the server.
+if TRANSPORT == "sftp":
+    if not SFTP_HOST:
+        error_message = "Error: --sftp_host must be specified when using the sftp transport"
+        sys.exit(error_message)
+    try:
+        transport = SFTPTransport(SFTP_HOST, port=SFTP_PORT, username=SFTP_USER, key_filename=SFTP_KEY,
+                                  connections=pool_threads, checksum=CHECKSUM, known_hosts=SFTP_KNOWN_HOSTS)
+    except ImportError as error:
+        sys.exit("Error: %s" % error)
+else:
+    transport = LocalTransport(checksum=CHECKSUM, read_back=READ_BACK)
+
 # Checking to ensure that the server directory exists
-if not os.path.isdir(SERVER_DIRECTORY):
+if not transport.isdir(SERVER_DIRECTORY):
     error_message = "Error: cannot locate or find server directory %s" % SERVER_DIRECTORY
     sys.exit(error_message)
-SERVER_DIRECTORY = os.path.abspath(SERVER_DIRECTORY) + "/"
+SERVER_DIRECTORY = transport.abspath(SERVER_DIRECTORY) + "/"
 
 # Checking to ensure that the run directory exists.
 if RUN_DIRECTORY:
-    if not os.path.isdir(RUN_DIRECTORY):
+    if not transport.isdir(RUN_DIRECTORY):
         error_message = "Error: run directory specified but does not exist %s" % RUN_DIRECTORY
         sys.exit(error_message)
+    RUN_DIRECTORY = transport.abspath(RUN_DIRECTORY) + "/"
 else:
     RUN_DIRECTORY = SERVER_DIRECTORY + date + "_" + RUN_NAME + "/"
     general_message = "Run directory not specified. Using %s" % RUN_DIRECTORY
     print(general_message)
-    if not os.path.isdir(RUN_DIRECTORY):
-        os.mkdir(RUN_DIRECTORY)
+    transport.makedirs(RUN_DIRECTORY)
 
 # Checking to ensure that the dump directory exists.
 if DUMP_DIRECTORY:
-    if not os.path.isdir(DUMP_DIRECTORY):
+    if not transport.isdir(DUMP_DIRECTORY):
         error_message = "Error: dump directory specified but does not exist %s" % DUMP_DIRECTORY
+        sys.exit(error_message)
+    DUMP_DIRECTORY = transport.abspath(DUMP_DIRECTORY) + "/"
 else:
     DUMP_DIRECTORY = RUN_DIRECTORY + "dump/"
     general_message = "Dump directory not defined. Using %s" % DUMP_DIRECTORY
     print(general_message)
-    if not os.path.isdir(DUMP_DIRECTORY):
-        os.mkdir(DUMP_DIRECTORY)
+    transport.makedirs(DUMP_DIRECTORY)
+
+# The log and manifest are kept next to the run directory on a mapped drive,
+# or next to the reads directory on the laptop when sending over sftp.
+if TRANSPORT == "sftp":
+    local_log_directory = os.path.dirname(READS_DIRECTORY.rstrip("/")) + "/log/"
+else:
+    local_log_directory = RUN_DIRECTORY + "log/"
 
 if not WATCH:
     WATCH = WATCH_DEFAULT
     general_message = "Watch option not defined. Using %s" % WATCH_DEFAULT
     print(general_message)
 
+if not QUEUE_SIZE:
+    QUEUE_SIZE = QUEUE_SIZE_DEFAULT
+
+# Short and empty reads are only looked for when asked, as each read must then be opened.
+fast5_info = None
+if MIN_EVENTS:
+    try:
+        fast5_info = Fast5InfoCache()
+    except ImportError as error:
+        sys.exit("Error: %s" % error)
+
 # Create the log file
 if LOGFILE:
     if not os.path.isfile(LOGFILE):
         error_message = "Log file specifed but does not exist."
         sys.exit(error_message)
 else:
-    log_directory = RUN_DIRECTORY + "log/"
+    log_directory = local_log_directory
     if not os.path.isdir(log_directory):
         os.makedirs(log_directory)
     LOGFILE = log_directory + date + "_" + RUN_NAME + ".transfer.log"
     general_message = "Log file not defined, using %s" % LOGFILE
     print(general_message)
+
+# Load the manifest of reads already transferred, so that a restart carries on where it left off.
+if not MANIFEST:
+    manifest_directory = local_log_directory
+    if not os.path.isdir(manifest_directory):
+        os.makedirs(manifest_directory)
+    MANIFEST = manifest_directory + RUN_NAME + ".transfer.manifest"
+manifest = TransferManifest(MANIFEST)
+if manifest.existed:
+    general_message = "Resuming from manifest %s, %d reads already transferred" % (MANIFEST, len(manifest))
+else:
+    # Reads moved before there was a manifest only need listing once.
+    manifest.seed(entry for entry in transport.list_files(DUMP_DIRECTORY) if entry[0].endswith('.fast5'))
+    general_message = "Manifest not found, created %s" % MANIFEST
+print(general_message)
+
 # We now begin the process of moving reads across from the read_directory to the server directory
 # to prevent the computer from filling up.
 # We want to be careful to ensure that reads do not get moved across twice
 # and that only fast5 files are moved across.
 
+# Rates and latencies while the run goes, for seeing which stage is holding the others up.
+try:
+    metrics_exporters = MetricsExporters(REGISTRY, port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_INTERVAL)
+except IOError as error:
+    sys.exit("Error: %s" % error)
+
 logger = open(LOGFILE, 'a+')
 logger.write("The time is %s:\n" % time.strftime("%c"))
 logger.write("Commencing transfer of reads from %s to %s" % (READS_DIRECTORY, DUMP_DIRECTORY))
 logger.close()
 start_time = time.time()
 
-fast5_files = []
-run_exhausted = False
-files_moved = 0
-patience_counter = 0
-
 os.chdir(READS_DIRECTORY)
-os.chmod(RUN_DIRECTORY, 777)
-
-while not run_exhausted:
-    while len(fast5_files) == 0:
-        # Create an array of all the fast5 files in the directory the MinION is writing to.
-        run_string = "sequencing_run_%s" % RUN_NAME
-        fast5_files = [fast5 for fast5 in os.listdir(READS_DIRECTORY) if fast5.endswith('.fast5') and run_string in fast5]
-       
-        # Important to transfer the oldest files first.
-        fast5_files.sort(key=lambda x: os.path.getmtime(x)) 
-        
-        # Did we pick anything up?
-        if len(fast5_files) != 0:
-            break
-        
-        # Didn't pick anything up...
-        # Have we exceeded the number of mini-sleeps?
-        if patience_counter > WATCH:
-            run_exhausted = True
-            break
-            
-        # No? Take a minute sleep.
-        if patience_counter != 0:            
-            abstinence_message = "No fast5 files found in the last %d seconds.\n" % patience_counter
-            sleeping_message = "Waiting 60 seconds, breaking in %d if no more reads created.\n" \
-                               % (WATCH - patience_counter)
-            logger = open(LOGFILE, 'a+')
-            print(abstinence_message)
-            print(sleeping_message)
-            logger.write(abstinence_message + "\n")
-            logger.write(sleeping_message + "\n")
-
-        time.sleep(60)
-        patience_counter += 60
-    
-    # Out of the while loop, either fast5 files have been found or run is exhausted.
-    patience_counter = 0  # Must be consecutive minute sleeps to exhaust the run.
-    
-    # Move the files from the MinION directory to the server directory
-    for read in fast5_files:
-        if not os.path.isfile(DUMP_DIRECTORY + read):
-            shutil.move(READS_DIRECTORY + read, DUMP_DIRECTORY)
-            files_moved += 1
-        else:
-            print "Warning, %s already exists in dump directory. Deleting from laptop." % read
-            os.remove(READS_DIRECTORY + read)
-    fast5_files = []  # To pass into the inner while loop
+if TRANSPORT == "local":
+    os.chmod(RUN_DIRECTORY, 777)
+
+def is_run_fast5(filename):
+    return is_run_read(filename, RUN_NAME)
+
+
+def log_idle(idle_seconds, remaining_seconds):
+    abstinence_message = "No fast5 files found in the last %d seconds.\n" % idle_seconds
+    sleeping_message = "Waiting for new reads, breaking in %d if no more reads created.\n" % remaining_seconds
+    print(abstinence_message)
+    print(sleeping_message)
+    logger = open(LOGFILE, 'a+')
+    logger.write(abstinence_message + "\n")
+    logger.write(sleeping_message + "\n")
+    logger.close()
+
+
+# Each read is stat-ed once, when first seen, and kept in an oldest-first backlog until it has been moved.
+backlog = FileBacklog(READS_DIRECTORY, match=is_run_fast5)
+files_found = REGISTRY.counter("transfer_files_found_total", "Reads found in the reads directory")
+REGISTRY.gauge("transfer_backlog_files", "Reads found but not yet queued for transfer", function=lambda: len(backlog))
+
+# New files are picked up as MinKNOW finishes writing them, rather than once a minute. The watcher also wakes
+# every few seconds while nothing arrives, to try again any reads that failed to move.
+watcher = DirectoryWatcher(READS_DIRECTORY, match=is_run_fast5, watch=WATCH, on_idle=log_idle,
+                           use_inotify=not POLL, listing=backlog.scan, tick=RETRY_DELAY)
+
+
+def already_transferred(path):
+    # Duplicates are checked against the manifest rather than with a stat on the server.
+    read = os.path.basename(path)
+    if read not in manifest:
+        return False
+    print("Warning, %s already exists in dump directory. Deleting from laptop." % read)
+    os.remove(path)
+    backlog.forget(read)
+    return True
+
+
+def transfer_read(path):
+    read = os.path.basename(path)
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None  # picked up twice, already moved
+    if already_transferred(path):
+        return None
+    # The read only appears in dump under its own name once the server has all of it, and only
+    # then is it removed from the laptop.
+    checksum = transport.move(path, DUMP_DIRECTORY)
+    manifest.record(read, status.st_size, status.st_mtime, checksum)
+    backlog.forget(read)
+    return 1, status.st_size
+
+
+def transfer_bundle(paths):
+    # Reads still to be sent go to the server as a single tar bundle, unpacked there by nanonet-realtime.py.
+    sources = []
+    for path in paths:
+        if not os.path.isfile(path):
+            backlog.forget(os.path.basename(path))
+        elif not already_transferred(path):
+            sources.append(path)
+    if not sources:
+        return None
+    name = bundle_name(RUN_NAME, BUNDLE_COMPRESSION)
+    checksum, entries = transport.move_bundle(sources, DUMP_DIRECTORY, name, BUNDLE_COMPRESSION)
+    bundle_bytes = 0
+    for read, offset, size, mtime, read_checksum in entries:
+        manifest.record(read, size, mtime, read_checksum)
+        backlog.forget(read)
+        bundle_bytes += size
+    return len(entries), bundle_bytes
+
+
+def log_transfer_error(item, error):
+    # The reads are tried again after a delay, as no new event will bring them back to the watcher.
+    paths = item if isinstance(item, tuple) else (item,)
+    for path in paths:
+        backlog.retry(os.path.basename(path))
+    error_message = "Error transferring %s: %s. Trying again later\n" % (", ".join(paths), error)
+    print(error_message)
+    logger = open(LOGFILE, 'a+')
+    logger.write(error_message)
+    logger.close()
+
+
+# Several files are moved at once, as a single stream over a mapped drive can be slower than MinKNOW.
+# The queue is bounded so that a slow server holds back the scan rather than growing the backlog.
+transfer_pool = TransferPool(transfer_bundle if BUNDLE_READS else transfer_read, workers=pool_threads,
+                             queue_size=QUEUE_SIZE, on_error=log_transfer_error, name="transfer",
+                             limit=TRANSFER_THREADS)
+
+# In bundle mode reads are gathered into batches first, each batch being one file on the server.
+bundler = None
+if BUNDLE_READS:
+    bundler = Bundler(transfer_pool.submit, max_reads=BUNDLE_READS, max_bytes=BUNDLE_MEGABYTES * 1024 * 1024,
+                      max_age=BUNDLE_AGE)
+
+
+def log_pace(message):
+    print(message)
+    logger = open(LOGFILE, 'a+')
+    logger.write("%s: %s\n" % (time.strftime("%c"), message))
+    logger.close()
+
+
+# The free space on the laptop and server is checked every few seconds and, with --adaptive, sets how many
+# files are moved at once, so that MinKNOW is neither left without disk nor kept waiting for it. Transfers
+# are paused while the server has less than --server_reserve free.
+scheduler = TransferScheduler(transfer_pool, READS_DIRECTORY,
+                              destination_free_space=lambda: transport.free_space(DUMP_DIRECTORY),
+                              workers=TRANSFER_THREADS, min_workers=MIN_TRANSFER_THREADS,
+                              max_workers=MAX_TRANSFER_THREADS, low_fraction=LOW_SPACE / 100.0,
+                              high_fraction=HIGH_SPACE / 100.0, destination_reserve=SERVER_RESERVE * 1000000,
+                              bundler=bundler, adapt=ADAPTIVE, report=log_pace)
+
+
+def send(read, size, mtime):
+    if bundler:
+        bundler.add(READS_DIRECTORY + read, size, mtime)
+    else:
+        transfer_pool.submit(READS_DIRECTORY + read, mtime=mtime)
+
+
+short_reads_deferred = 0
+for fast5_files in watcher.batches():
+    # Only reads not already in the backlog are stat-ed.
+    backlog.add(fast5_files)
+    files_found.inc(len(fast5_files))
+    # Reads waiting to be tried again are still reads on the laptop, so they keep the run going.
+    if backlog.requeue():
+        watcher.touch()
+
+    # Move the files from the MinION directory to the server directory, oldest first.
+    # Short reads are sent after the others found in this scan, but keep their own mtime, so they are never
+    # held back behind reads found in a later scan.
+    short_reads = []
+    for mtime, read, size in backlog.drain():
+        if fast5_info and is_short(fast5_info.get(READS_DIRECTORY + read), MIN_EVENTS):
+            short_reads.append((read, size, mtime))
+            continue
+        send(read, size, mtime)
+    for read, size, mtime in short_reads:
+        send(read, size, mtime)
+    short_reads_deferred += len(short_reads)
+
+if bundler:
+    bundler.close()
+transfer_pool.close()
+scheduler.close()
+transport.close()
+manifest.close()
+files_moved = transfer_pool.files_moved()
+metrics_exporters.close()
 
 # Run has been exhausted
 end_time = time.time()
@@ -194,6 +507,12 @@ end_time = time.time()
 logger = open(LOGFILE, 'a+')
 logger.write("No fast5 files found for %d seconds\n" % WATCH)
 logger.write("Moved %d files\n" % files_moved)
+if fast5_info:
+    logger.write("Sent %d short reads after the rest of their scan. Fast5 files inspected: %s\n"
+                 % (short_reads_deferred, fast5_info.summary()))
+for worker_stats in transfer_pool.stats:
+    logger.write("%s\n" % worker_stats)
+logger.write("%s\n" % scheduler.summary())
 logger.write("Process completed in %d seconds.\n" % (end_time - start_time))
 logger.write("Exiting\n")
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import sys
+import time
+
+from ont.kmer_classifier import K_DEFAULT, build_index
+
+# Builds the k-mer index used by onecodex-realtime.py --classifier kmer, for classifying reads without
+# sending them to One Codex (for example where the sequencing computer has no internet connection).
+
+help_descriptor = "This script builds a k-mer index from reference fasta files, for offline classification by " + \
+                  "onecodex-realtime.py --classifier kmer. The references are listed in a tab-separated file " + \
+                  "of fasta file <tab> tax_id, one reference per line. Fasta files may be gzipped."
+
+parser = argparse.ArgumentParser(description=help_descriptor)
+parser.add_argument('--version', action='version', version="%(prog)s 1.0")
+parser.add_argument("--references", nargs='?', dest="REFERENCES", type=str,
+                    help="Tab-separated file of reference fasta file and tax_id. Relative paths are relative to " +
+                         "this file.", required=True)
+parser.add_argument("--index_directory", nargs='?', dest="INDEX_DIRECTORY", type=str,
+                    help="The directory the index is written to.", required=True)
+parser.add_argument("--k", nargs='?', dest="K", type=int,
+                    help="k-mer length, at most 31. Default set at %d" % K_DEFAULT)
+args = parser.parse_args()
+
+REFERENCES = args.REFERENCES
+INDEX_DIRECTORY = args.INDEX_DIRECTORY
+K = args.K
+
+if not K:
+    K = K_DEFAULT
+    general_message = "k not defined. Using %d" % K_DEFAULT
+    print(general_message)
+
+if not os.path.isfile(REFERENCES):
+    error_message = "Error: cannot locate or find references file %s" % REFERENCES
+    sys.exit(error_message)
+
+references = []
+references_directory = os.path.dirname(os.path.abspath(REFERENCES))
+with open(REFERENCES) as references_file:
+    for line_number, line in enumerate(references_file, 1):
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 2 or not fields[1].strip().isdigit():
+            sys.exit("Error: line %d of %s is not fasta file <tab> tax_id" % (line_number, REFERENCES))
+        fasta_file = os.path.join(references_directory, fields[0])
+        if not os.path.isfile(fasta_file):
+            sys.exit("Error: cannot locate or find reference fasta file %s" % fasta_file)
+        references.append((fasta_file, int(fields[1])))
+
+
+def log_reference(message):
+    print(message)
+
+
+start_time = time.time()
+try:
+    kmers = build_index(references, INDEX_DIRECTORY, k=K, log=log_reference)
+except (ImportError, ValueError) as error:
+    sys.exit("Error: %s" % error)
+print("Indexed %d k-mers from %d references in %d seconds, written to %s"
+      % (kmers, len(references), time.time() - start_time, INDEX_DIRECTORY))
@@ -1,9 +1,21 @@
 #!/usr/bin/env python
 import os
 import time
-import shutil
 import argparse
 import sys
+import threading
+
+from ont.basecall_service import BasecallError, ServicePool
+from ont.bundle import Bundler, is_bundle, unpack_bundle
+from ont.fast5_info import Fast5InfoCache, is_short
+from ont.fast5_names import parse
+from ont.metrics import REGISTRY, MetricsExporters
+from ont.multi_fast5 import packed_reads
+from ont.read_index import ChannelIndex
+from ont.sequences import RecordParser, RollingWriter
+from ont.staging import Stager, publish, remove_batches
+from ont.transfer import TransferPool
+from ont.watcher import DirectoryWatcher
 
 # This script is designed to copy fast5 files from the 'dump' folder.
 # Perform a rapid 1D analysis on the files using nanonet and then place them in the reads folder.
@@ -37,10 +49,61 @@ parser.add_argument("--fasta_directory", nargs="?", dest="FASTA_DIRECTORY", type
                          "If not specified, will be created within the working directory.")
 parser.add_argument("--threads", nargs='?', dest="THREAD_COUNT", type=int,
                     help="Number of processors used during nanonet command. Defaults to 4.")
-
+parser.add_argument("--workers", nargs='?', dest="WORKERS", type=int,
+                    help="Number of nanonetcall processes run at once, sharing the threads between them. " +
+                         "Defaults to 2, or 1 if only one thread is used.")
+parser.add_argument("--batch_reads", nargs='?', dest="BATCH_READS", type=int,
+                    help="Maximum number of reads basecalled in one batch. Defaults to 200.")
+parser.add_argument("--batch_age", nargs='?', dest="BATCH_AGE", type=int,
+                    help="Maximum time (seconds) a read waits for its batch to fill before the batch is " +
+                         "basecalled anyway. Defaults to 30.")
+
+parser.add_argument("--staging", nargs='?', dest="STAGING", type=str, default="auto",
+                    choices=["auto", "reflink", "hardlink", "copy"],
+                    help="How reads are put in the tmp directory for nanonet. 'auto' uses a reflink if the " +
+                         "filesystem supports them, then a hardlink, and only copies the file if neither works. " +
+                         "Use 'copy' if anything edits the fast5 files in the reads directory in place, as a " +
+                         "hardlinked read would change the copy in dump too. Defaults to auto.")
+parser.add_argument("--basecaller", nargs='?', dest="BASECALLER", type=str, default="service",
+                    choices=["service", "command", "stub"],
+                    help="'service' keeps one nanonet process per worker running for the whole run and sends it " +
+                         "each batch, so python, numpy and nanonet are only started once (nanonet still " +
+                         "loads its model for each batch). 'command' runs nanonetcall " +
+                         "for every batch, as older versions of this script did. 'stub' writes a made up " +
+                         "sequence for each read instead of calling it, for testing without nanonet. " +
+                         "Defaults to service, falling back to command if nanonet cannot be imported.")
+parser.add_argument("--output", nargs='?', dest="OUTPUT", type=str, default="rolling",
+                    choices=["rolling", "batch"],
+                    help="'rolling' writes each read to the current fasta file as soon as it is called, starting " +
+                         "a new file every --roll_megabytes or --roll_age seconds. Each file has a .fai index of " +
+                         "the reads written so far and gets a .done file once it is complete. 'batch' writes " +
+                         "one fasta file per batch. Defaults to rolling.")
+parser.add_argument("--fastq", action="store_true", dest="FASTQ",
+                    help="Write fastq rather than fasta.")
+parser.add_argument("--roll_megabytes", nargs='?', dest="ROLL_MEGABYTES", type=int,
+                    help="Size (MB) at which a rolling fasta file is finished and a new one started. Defaults to 16.")
+parser.add_argument("--roll_age", nargs='?', dest="ROLL_AGE", type=int,
+                    help="Time (seconds) after which a rolling fasta file is finished and a new one started. " +
+                         "Defaults to 60.")
+parser.add_argument("--min_events", nargs='?', dest="MIN_EVENTS", type=int,
+                    help="Reads with fewer events than this, or no signal at all, are put straight into the reads " +
+                         "directory without being basecalled. nanonet itself skips reads under 500 events. Each " +
+                         "read is opened to count its events, which needs h5py. Defaults to 0 (every read is " +
+                         "basecalled).")
+parser.add_argument("--metrics_port", nargs='?', dest="METRICS_PORT", type=int,
+                    help="Serve counters, rates and latencies for each stage at http://localhost:<port>/metrics, in " +
+                         "the Prometheus text format, while the script runs. Defaults to 0 (off).")
+parser.add_argument("--metrics_file", nargs='?', dest="METRICS_FILE", type=str,
+                    help="Write the same metrics, and the rate of each counter, as JSON to this file every " +
+                         "--metrics_interval seconds. Defaults to none.")
+parser.add_argument("--metrics_interval", nargs='?', dest="METRICS_INTERVAL", type=int, default=10,
+                    help="How often (seconds) the metrics file is written. Defaults to 10.")
 parser.add_argument("--watch", nargs='?', dest="WATCH", type=int,
                     help="The time (seconds) allowed with no new fast5 files" +
                          "entering the dump directory before exiting the script. Default set at 800")
+parser.add_argument("--poll", action="store_true", dest="POLL",
+                    help="Poll the dump directory instead of using inotify. Use this if the dump directory " +
+                         "is mounted from another machine, where inotify does not see changes.")
 args = parser.parse_args()
 
 # Assign inputs
@@ -50,10 +113,29 @@ DUMP_DIRECTORY = args.DUMP_DIRECTORY
 READS_DIRECTORY = args.READS_DIRECTORY
 FASTA_DIRECTORY = args.FASTA_DIRECTORY
 THREAD_COUNT = args.THREAD_COUNT
+WORKERS = args.WORKERS
+BATCH_READS = args.BATCH_READS
+BATCH_AGE = args.BATCH_AGE
+STAGING = args.STAGING
+BASECALLER = args.BASECALLER
+OUTPUT = args.OUTPUT
+FASTQ = args.FASTQ
+ROLL_MEGABYTES = args.ROLL_MEGABYTES
+ROLL_AGE = args.ROLL_AGE
+MIN_EVENTS = args.MIN_EVENTS
+METRICS_PORT = args.METRICS_PORT
+METRICS_FILE = args.METRICS_FILE
+METRICS_INTERVAL = args.METRICS_INTERVAL
 WATCH = args.WATCH
+POLL = args.POLL
 
 # Defaults
 THREAD_COUNT_DEFAULT = 4  # number of cores when basecalling
+WORKERS_DEFAULT = 2  # number of nanonetcall processes at once
+BATCH_READS_DEFAULT = 200  # reads per basecalling batch
+BATCH_AGE_DEFAULT = 30  # seconds a read waits for its batch to fill
+ROLL_MEGABYTES_DEFAULT = 16  # size of a rolling fasta file
+ROLL_AGE_DEFAULT = 60  # seconds a rolling fasta file stays open
 WATCH_DEFAULT = 800  # number of seconds of no new reads before exiting
 WORKING_DIRECTORY_DEFAULT = os.getcwd()
 INVALID_SYMBOLS = "~`!@#$%^&*()-+={}[]:>;',</?*-+"
@@ -120,91 +202,221 @@ if not THREAD_COUNT:
     general_message = "Thread count has not been specified. Using %s \n" % THREAD_COUNT_DEFAULT
     print(general_message)
 
+if not WORKERS:
+    WORKERS = min(WORKERS_DEFAULT, THREAD_COUNT)
+    general_message = "Workers have not been specified. Using %s \n" % WORKERS
+    print(general_message)
+THREADS_PER_WORKER = max(THREAD_COUNT // WORKERS, 1)
+
+if not BATCH_READS:
+    BATCH_READS = BATCH_READS_DEFAULT
+
+if not BATCH_AGE:
+    BATCH_AGE = BATCH_AGE_DEFAULT
+
+if not ROLL_MEGABYTES:
+    ROLL_MEGABYTES = ROLL_MEGABYTES_DEFAULT
+
+if not ROLL_AGE:
+    ROLL_AGE = ROLL_AGE_DEFAULT
+
+OUTPUT_EXTENSION = "fastq" if FASTQ else "fasta"
+
+fast5_info = None
+if MIN_EVENTS:
+    try:
+        fast5_info = Fast5InfoCache()
+    except ImportError as error:
+        sys.exit("Error: %s" % error)
+
 if not WATCH:
     WATCH = WATCH_DEFAULT
     general_message = "Watch has not been specified. Using %s \n" % WATCH_DEFAULT
     print(general_message)
 
-# Initialise the directory dictionary: keeps track of files in much less time
-channel_numbers = range(1, 513)
-channel_list = []
-
-for number in channel_numbers:
-    channel_list.append("ch" + str(number))
-
-d = {channel: 0 for channel in channel_list}
-
-# Need to check for files in the read directory: Say if this script needs to be restarted
-# Dictionary updated or left at zero if nothing in the reads directory
-
-for fast5_file in os.listdir(READS_DIRECTORY):
-    channel = fast5_file.split('_')[-3]
-    read = fast5_file.split('_')[-2]
-    read_number = int(read.replace("read", ''))
-    if read_number > d[channel]:
-        d[channel] = read_number
-
-update_d = d.copy()
-# While loop initialisers
-new_fast5_files = []
-run_exhausted = False
-patience_counter = 0
-
-while not run_exhausted:
-    while len(new_fast5_files) == 0:
-
-        # Get new fast5 files list.
-        for fast5_file in os.listdir(DUMP_DIRECTORY):
-            channel = fast5_file.split('_')[-3]
-            read = fast5_file.split('_')[-2]
-            read_number = int(read.replace("read", ''))
-            if d[channel] < read_number:
-                new_fast5_files.append(fast5_file)
-                if update_d[channel] < read_number:
-                    update_d[channel] = read_number
-        d = update_d.copy()
-        # Break if one or more fast5 files were found
-        if len(new_fast5_files) != 0:
-            break
-
-        # Didn't pick anything up...
-        # Have we exceeded the number of mini-sleeps?
-        if patience_counter > WATCH:
-            run_exhausted = True
-            break
-
-        # No? Take a minute sleep.
-        if patience_counter != 0:
-            print "No fast5 files found in the last %d seconds.\n" % patience_counter
-            print "Waiting 60 seconds, breaking in %d if no more reads created.\n" % (WATCH - patience_counter)
-        time.sleep(60)
-        patience_counter += 60
-
-    # Out of while loop, fast5 files found or run is exhausted.
-    patience_counter = 0  # must be consistent absence of reads
-
-    # Create a tmp_directory to call fast5 files in
-    time_of_command = round(time.time())
-    tmp_nanonet_directory = "%s/%d" % (READS_DIRECTORY, time_of_command)
-    os.makedirs(tmp_nanonet_directory)  # there shouldn't be any need to check...
-
-    fasta_file = "%s/%s_1D_%d.fasta" % (FASTA_DIRECTORY, RUN_NAME, time_of_command)
-    for read in new_fast5_files:
-        shutil.copy2(DUMP_DIRECTORY + "/" + read, tmp_nanonet_directory)
-
-        # Run nanonet command on tmp_nanonet_directory
-    nanonet_command = "nanonetcall --jobs %d %s > %s" % (THREAD_COUNT, tmp_nanonet_directory, fasta_file)
-    os.system(nanonet_command)
-
-    # Move reads to main reads directory for metrichor to read
+# The read numbers seen on each channel tell new reads from those already called, even when they arrive out
+# of order. They are saved after every batch so that a restart does not need to re-parse the reads directory.
+# The .channel_index of older versions, which only kept the highest read number, is not used.
+log_directory = WORKING_DIRECTORY + "log/"
+if not os.path.isdir(log_directory):
+    os.makedirs(log_directory)
+channel_index_file = log_directory + RUN_NAME + ".called_reads"
+
+if os.path.isfile(channel_index_file):
+    channel_index = ChannelIndex.load(channel_index_file)
+    general_message = "Resuming from channel index %s \n" % channel_index_file
+else:
+    # Need to check for files in the read directory: Say if this script needs to be restarted
+    channel_index = ChannelIndex()
+    channel_index.add_existing(os.listdir(READS_DIRECTORY))
+    # Including reads packed by fast5-pack.py, listed in the packs' indexes.
+    channel_index.add_existing(packed_reads(READS_DIRECTORY))
+    general_message = "Channel index not found, built from %s \n" % READS_DIRECTORY
+print(general_message)
+
+
+def batch_fasta_file(number):
+    return "%s/%s_1D_%d.%s" % (FASTA_DIRECTORY, RUN_NAME, number, OUTPUT_EXTENSION)
+
+
+def prepare_batch(new_fast5_files, oldest_time):
+    # Stage a batch into its own tmp directory while earlier batches are still being called. Reflinked or
+    # hardlinked from dump where possible, so no data is copied. See --staging.
+    tmp_nanonet_directory, number = stager.stage_batch([DUMP_DIRECTORY + read for read in new_fast5_files],
+                                                       READS_DIRECTORY,
+                                                       taken=lambda batch: os.path.isfile(batch_fasta_file(batch)))
+    fasta_file = batch_fasta_file(number)
+
+    # Waits here if every basecaller is busy and a batch is already queued.
+    basecall_pool.submit((tmp_nanonet_directory, fasta_file, tuple(new_fast5_files)), mtime=oldest_time)
+
+
+def basecall_batch(batch):
+    tmp_nanonet_directory, fasta_file, new_fast5_files = batch
+
+    # Run nanonet on tmp_nanonet_directory, in this worker's basecall service if there is one.
+    if BASECALLER == "command":
+        # Rolling output is fed from a hidden file, as nanonetcall only writes to stdout.
+        output_file = fasta_file if OUTPUT == "batch" else \
+            "%s/.%s.partial" % (FASTA_DIRECTORY, os.path.basename(fasta_file))
+        nanonet_command = "nanonetcall --jobs %d %s%s > %s" % (THREADS_PER_WORKER, "--fastq " if FASTQ else "",
+                                                              tmp_nanonet_directory, output_file)
+        os.system(nanonet_command)
+        if OUTPUT == "rolling":
+            records = RecordParser(rolling_writer.write)
+            with open(output_file) as output:
+                for line in output:
+                    records.write(line)
+            records.close()
+            os.remove(output_file)
+    elif OUTPUT == "batch":
+        basecall_services.call(tmp_nanonet_directory, fasta_file, jobs=THREADS_PER_WORKER, fastq=FASTQ)
+    else:
+        # Each read is in the rolling fasta file as soon as it is called.
+        basecall_services.call(tmp_nanonet_directory, jobs=THREADS_PER_WORKER, fastq=FASTQ,
+                               on_record=rolling_writer.write)
+
+    # Move reads to main reads directory for metrichor to read. The tmp directory is inside the reads
+    # directory, so this is a rename only.
     for read in os.listdir(tmp_nanonet_directory):
-        shutil.move(tmp_nanonet_directory + "/" + read, READS_DIRECTORY)
+        publish(tmp_nanonet_directory + "/" + read, READS_DIRECTORY)
 
-        # Remove nanonet directory
+    # Remove nanonet directory
     os.rmdir(tmp_nanonet_directory)
 
-    # reset while loop parameters
-    new_fast5_files = []
-
-print "No fast5 files dumped to server in the last %d seconds\n" % WATCH
-print "Exiting\n"
+    # Only reads that have been called are saved to the index, so a restart repeats unfinished batches.
+    with called_index_lock:
+        called_index.add_existing(new_fast5_files)
+        called_index.save(channel_index_file)
+    return len(new_fast5_files), 0
+
+
+def skip_basecalling(read):
+    # A read too short to call is put in the reads directory as it is, for metrichor.
+    if not os.path.exists(os.path.join(READS_DIRECTORY, read)):
+        stager.stage(DUMP_DIRECTORY + read, READS_DIRECTORY)
+    with called_index_lock:
+        called_index.add_existing([read])
+        called_index.save(channel_index_file)
+
+
+def log_basecall_error(batch, error):
+    print("Error basecalling %s: %s\n" % (batch[0], error))
+
+
+def log_service_restart(message):
+    print("%s\n" % message)
+
+
+# A basecall service imports nanonet once and is then sent batch after batch, rather than starting nanonetcall
+# (and python and numpy) again for every batch. nanonet still loads its model for each batch. Each worker has
+# its own service; the first is started here so that a missing nanonet is found before any reads are staged.
+# A service that dies part way through a batch is replaced and the batch called again.
+basecall_services = None
+if BASECALLER != "command":
+    try:
+        basecall_services = ServicePool("stub" if BASECALLER == "stub" else "nanonet", report=log_service_restart)
+    except BasecallError as error:
+        if BASECALLER == "stub":
+            sys.exit("Error: %s" % error)
+        BASECALLER = "command"
+        general_message = "%s. Running nanonetcall for each batch instead. \n" % error
+        print(general_message)
+
+# Several nanonetcall processes run at once, each with a share of the threads, so that cores are not left
+# idle while a batch is copied or while one process finishes its last few reads.
+stager = Stager(STAGING)
+if OUTPUT == "rolling":
+    rolling_writer = RollingWriter(FASTA_DIRECTORY, RUN_NAME + "_1D", fastq=FASTQ,
+                                   max_bytes=ROLL_MEGABYTES * 1024 * 1024, max_age=ROLL_AGE)
+basecall_pool = TransferPool(basecall_batch, workers=WORKERS, queue_size=1, on_error=log_basecall_error,
+                             name="basecall")
+called_index = channel_index.copy()
+called_index_lock = threading.Lock()
+
+# Batch directories left by a run that stopped part way through. Their reads were not saved as called, as
+# each read is only saved once its own batch is done (however far later batches got), so they are still new
+# in dump and are called again.
+remove_batches(READS_DIRECTORY)
+
+# Reads are called in batches of at most --batch_reads, and no read waits more than --batch_age seconds
+# for its batch to fill.
+batcher = Bundler(prepare_batch, max_reads=BATCH_READS, max_bytes=float("inf"), max_age=BATCH_AGE)
+
+
+# Rates and latencies while the run goes, for seeing which stage is holding the others up.
+try:
+    metrics_exporters = MetricsExporters(REGISTRY, port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_INTERVAL)
+except IOError as error:
+    sys.exit("Error: %s" % error)
+files_found = REGISTRY.counter("basecall_files_found_total", "New reads found in the dump directory")
+short_reads_total = REGISTRY.counter("basecall_short_reads_total",
+                                     "Reads put in the reads directory without basecalling")
+
+
+def log_idle(idle_seconds, remaining_seconds):
+    print("No fast5 files found in the last %d seconds.\n" % idle_seconds)
+    print("Waiting for new reads, breaking in %d if no more reads created.\n" % remaining_seconds)
+
+
+# New files are picked up as soon as they are written into the dump directory, rather than once a minute.
+# Anything that is neither a read nor a bundle is ignored.
+watcher = DirectoryWatcher(DUMP_DIRECTORY, match=lambda name: parse(name) is not None or is_bundle(name),
+                           watch=WATCH, on_idle=log_idle, use_inotify=not POLL)
+
+short_reads = 0
+for dumped_files in watcher.batches():
+    # Unpack any bundles sent by fast5-transfer-realtime.py --bundle_reads into the dump directory.
+    for bundle in [name for name in dumped_files if is_bundle(name)]:
+        dumped_files.remove(bundle)
+        if os.path.isfile(DUMP_DIRECTORY + bundle):
+            dumped_files.extend(unpack_bundle(DUMP_DIRECTORY + bundle, DUMP_DIRECTORY))
+
+    # Get new fast5 files list. These join the batch being formed, which is sent off once it is full or old.
+    new_reads = channel_index.new_reads(dumped_files)
+    files_found.inc(len(new_reads))
+    for read in new_reads:
+        if fast5_info and is_short(fast5_info.get(DUMP_DIRECTORY + read), MIN_EVENTS):
+            skip_basecalling(read)
+            short_reads += 1
+            short_reads_total.inc()
+            continue
+        batcher.add(read, 0, time.time())
+
+# Call whatever is left and wait for the basecallers to finish.
+batcher.close()
+basecall_pool.close()
+if basecall_services:
+    basecall_services.close()
+metrics_exporters.close()
+if OUTPUT == "rolling":
+    rolling_writer.close()
+    print("Reads written to %d %s files\n" % (len(rolling_writer.finished), OUTPUT_EXTENSION))
+for worker_stats in basecall_pool.stats:
+    print("%s: %d reads basecalled in %d seconds\n" % (worker_stats.name, worker_stats.files, worker_stats.seconds))
+print("Reads staged: %s\n" % (stager.summary() or "none"))
+if fast5_info:
+    print("%d reads too short to basecall. Fast5 files inspected: %s\n" % (short_reads, fast5_info.summary()))
+
+print("No fast5 files dumped to server in the last %d seconds\n" % WATCH)
+print("Exiting\n")
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 
-import requests
 import os
-from Bio import SeqIO
-import json
 import argparse
 import time
 import sys
+from collections import deque
+from itertools import islice
+
+from ont.abundance import AbundanceTable
+from ont.checkpoint import ClassificationCheckpoint
+from ont.kmer_classifier import MIN_HITS_DEFAULT, KmerClassifier
+from ont.metrics import REGISTRY, MetricsExporters
+from ont.onecodex import SEARCH_URL, OneCodexAuthError, OneCodexClient
+from ont.result_cache import MEMORY_ENTRIES, ResultCache
+from ont.sequences import (DONE_SUFFIX, INDEX_SUFFIX, is_done, read_index, read_numbered, read_records,
+                           read_sequences)
+from ont.watcher import DirectoryWatcher
 
 help_descriptor = "This is a wrapper for using one_codex on fasta files." + \
                   "This script takes a fasta file and uploads it to onecodex for it to be analysed." + \
@@ -28,6 +37,54 @@ parser.add_argument("--fasta_directory", nargs="?", dest="FASTA_DIRECTORY", type
 parser.add_argument("--watch", nargs='?', dest="WATCH", type=int,
                     help="The time (seconds) allowed with no new fasta files" +
                          "entering the fasta directory before exiting the script. Default set at 800")
+parser.add_argument("--poll", action="store_true", dest="POLL",
+                    help="Poll the fasta directory instead of using inotify. Use this if the fasta directory " +
+                         "is mounted from another machine, where inotify does not see changes.")
+parser.add_argument("--tail_interval", nargs='?', dest="TAIL_INTERVAL", type=int,
+                    help="How often (seconds) fasta files still being written by nanonet-realtime.py are checked " +
+                         "for new reads. Default set at 5")
+parser.add_argument("--classifier", nargs='?', dest="CLASSIFIER", type=str, default="onecodex",
+                    choices=["onecodex", "kmer"],
+                    help="'onecodex' searches each read with the One Codex API. 'kmer' classifies reads on this " +
+                         "computer against a k-mer index made by kmer-index-build.py (see --kmer_index), with " +
+                         "no internet connection needed. Default set at onecodex")
+parser.add_argument("--kmer_index", nargs='?', dest="KMER_INDEX", type=str,
+                    help="Directory of the k-mer index, for --classifier kmer.")
+parser.add_argument("--kmer_min_hits", nargs='?', dest="KMER_MIN_HITS", type=int,
+                    help="Number of k-mers a read must share with a tax_id to be classified as it, for " +
+                         "--classifier kmer. Default set at %d" % MIN_HITS_DEFAULT)
+parser.add_argument("--processes", nargs='?', dest="PROCESSES", type=int,
+                    help="Number of processes classifying reads, for --classifier kmer. Default set at the " +
+                         "number of processors")
+parser.add_argument("--api_url", nargs='?', dest="API_URL", type=str,
+                    help="The One Codex search API. Point this at a local server to test without using the " +
+                         "real API. Default set at %s" % SEARCH_URL)
+parser.add_argument("--concurrency", nargs='?', dest="CONCURRENCY", type=int,
+                    help="Number of sequences being searched at once. Default set at 8")
+parser.add_argument("--retries", nargs='?', dest="RETRIES", type=int,
+                    help="Number of times a sequence is retried when One Codex is busy (or rate limiting) or " +
+                         "cannot be reached, before it is skipped. Default set at 5")
+parser.add_argument("--cache", nargs='?', dest="CACHE", type=str,
+                    help="sqlite file of the tax_id found for each sequence, shared between runs, so that repeated " +
+                         "reads (control strands, spike-ins, abundant organisms) are not searched again. Use " +
+                         "'none' to search every read. Default set at ~/.onecodex_cache.sqlite")
+parser.add_argument("--cache_entries", nargs='?', dest="CACHE_ENTRIES", type=int,
+                    help="Number of results also kept in memory. Default set at %d" % MEMORY_ENTRIES)
+parser.add_argument("--abundance_interval", nargs='?', dest="ABUNDANCE_INTERVAL", type=int,
+                    help="How often (seconds) the reads and bases found so far for each tax_id are written to " +
+                         "RUN_DIRECTORY/one_codex/<run_name>.abundance.json and .tsv. Default set at 30")
+parser.add_argument("--checkpoint", nargs='?', dest="CHECKPOINT", type=str,
+                    help="File recording how far through each fasta file the run has got, so that a restarted " +
+                         "script carries on from there. Default set at " +
+                         "RUN_DIRECTORY/log/<run_name>.onecodex.checkpoint")
+parser.add_argument("--metrics_port", nargs='?', dest="METRICS_PORT", type=int,
+                    help="Serve counters, rates and latencies for each stage at http://localhost:<port>/metrics, in " +
+                         "the Prometheus text format, while the script runs. Default set at 0 (off)")
+parser.add_argument("--metrics_file", nargs='?', dest="METRICS_FILE", type=str,
+                    help="Write the same metrics, and the rate of each counter, as JSON to this file every " +
+                         "--metrics_interval seconds. Default set at none")
+parser.add_argument("--metrics_interval", nargs='?', dest="METRICS_INTERVAL", type=int, default=10,
+                    help="How often (seconds) the metrics file is written. Default set at 10")
 parser.add_argument("--logfile", nargs='?', dest="LOGFILE", type=str,
                     help="This is the file that some general notes are printed to. If not specified," +
                          "the file will be RUN_DIRECTORY/log/<run_name>.onecodex.log")
@@ -38,11 +95,35 @@ RUN_DIRECTORY = args.RUN_DIRECTORY
 FASTA_DIRECTORY = args.FASTA_DIRECTORY
 WATCH = args.WATCH
 LOGFILE = args.LOGFILE
+POLL = args.POLL
+TAIL_INTERVAL = args.TAIL_INTERVAL
+API_URL = args.API_URL
+CONCURRENCY = args.CONCURRENCY
+RETRIES = args.RETRIES
+CHECKPOINT = args.CHECKPOINT
+CLASSIFIER = args.CLASSIFIER
+ABUNDANCE_INTERVAL = args.ABUNDANCE_INTERVAL
+KMER_INDEX = args.KMER_INDEX
+KMER_MIN_HITS = args.KMER_MIN_HITS
+PROCESSES = args.PROCESSES
+CACHE = args.CACHE
+CACHE_ENTRIES = args.CACHE_ENTRIES
+METRICS_PORT = args.METRICS_PORT
+METRICS_FILE = args.METRICS_FILE
+METRICS_INTERVAL = args.METRICS_INTERVAL
 
 # Defaults
 WATCH_DEFAULT = 800
+TAIL_INTERVAL_DEFAULT = 5
+CONCURRENCY_DEFAULT = 8
+RETRIES_DEFAULT = 5
+CHECKPOINT_RECORDS = 100  # records classified between checkpoints
+ABUNDANCE_INTERVAL_DEFAULT = 30
+CACHE_DEFAULT = os.path.expanduser("~/.onecodex_cache.sqlite")
+FASTA_SUFFIXES = (".fa", ".fasta", ".fna")
+FASTQ_SUFFIXES = (".fq", ".fastq")
+SEQUENCE_SUFFIXES = tuple(suffix + gzipped for suffix in FASTA_SUFFIXES + FASTQ_SUFFIXES for gzipped in ("", ".gz"))
 date = time.strftime("%Y_%m_%d")
-GOOD_ONECODEX_STATUS = 200
 
 # Checking to ensure that the run directory exists
 if not os.path.isdir(RUN_DIRECTORY):
@@ -64,6 +145,38 @@ if not WATCH:
     general_message = "Watch option not defined. Using %s" % WATCH_DEFAULT
     print(general_message)
 
+if not TAIL_INTERVAL:
+    TAIL_INTERVAL = TAIL_INTERVAL_DEFAULT
+
+if not API_URL:
+    API_URL = SEARCH_URL
+
+if not CONCURRENCY:
+    CONCURRENCY = CONCURRENCY_DEFAULT
+
+if RETRIES is None:
+    RETRIES = RETRIES_DEFAULT
+
+if CLASSIFIER == "kmer":
+    if not KMER_INDEX or not os.path.isdir(KMER_INDEX):
+        error_message = "Error: --classifier kmer needs the directory of a k-mer index, given by --kmer_index"
+        sys.exit(error_message)
+    if not KMER_MIN_HITS:
+        KMER_MIN_HITS = MIN_HITS_DEFAULT
+    # Results are not cached: the index is quicker than the cache, and the two classifiers disagree.
+    CACHE = "none"
+
+if not CACHE:
+    CACHE = CACHE_DEFAULT
+    general_message = "Cache not defined, using %s" % CACHE_DEFAULT
+    print(general_message)
+
+if not CACHE_ENTRIES:
+    CACHE_ENTRIES = MEMORY_ENTRIES
+
+if not ABUNDANCE_INTERVAL:
+    ABUNDANCE_INTERVAL = ABUNDANCE_INTERVAL_DEFAULT
+
 # Create the log file
 if LOGFILE:
     if not os.path.isfile(LOGFILE):
@@ -78,18 +191,27 @@ else:
     print(general_message)
 
 # Prime run
-run_exhausted = 0
 fasta_files_old = []
-fasta_files = []
+# Rolling fasta files still being written, and how many of their reads have been classified so far.
+fasta_files_following = {}
 sequences_read = 0
 sequences_classified = 0
-patience_counter = 0
+sequences_failed = 0
 
 # One Codex admin stuff
-ONECODEX_SEARCH_HTML = "https://app.onecodex.com/api/v0/search"
 ONECODEX_API_KEY = os.environ.get("ONECODEX_API_KEY")
-auth = requests.auth.HTTPBasicAuth(ONECODEX_API_KEY, "")
 timeout = 20
+# Identical reads are only searched once, in this run or any before it.
+cache = None if CACHE == "none" else ResultCache(CACHE, memory_entries=CACHE_ENTRIES, source=API_URL)
+# Connections are kept open and shared between requests, and several sequences are searched at once.
+try:
+    if CLASSIFIER == "kmer":
+        client = KmerClassifier(KMER_INDEX, processes=PROCESSES, min_hits=KMER_MIN_HITS)
+    else:
+        client = OneCodexClient(ONECODEX_API_KEY, url=API_URL, concurrency=CONCURRENCY, timeout=timeout,
+                                retries=RETRIES, cache=cache)
+except (ImportError, IOError, OSError) as error:
+    sys.exit("Error: %s" % error)
 
 
 one_codex_directory = RUN_DIRECTORY + "one_codex/"
@@ -98,68 +220,192 @@ if not os.path.isdir(one_codex_directory):
 
 output_file = one_codex_directory + date + "_" + RUN_NAME + ".onecodex"
 
+# Reads already classified by an earlier run of this script are not sent again.
+if not CHECKPOINT:
+    if not os.path.isdir(RUN_DIRECTORY + "log/"):
+        os.makedirs(RUN_DIRECTORY + "log/")
+    CHECKPOINT = RUN_DIRECTORY + "log/" + RUN_NAME + ".onecodex.checkpoint"
+checkpoint = ClassificationCheckpoint(CHECKPOINT)
+# Results written after the last checkpoint are removed, as those reads will be classified again.
+unchecked_bytes = checkpoint.restore_outputs()
+
 start_time = time.time()
 logger = open(LOGFILE, 'a+')
 logger.write("The time is %s\n" % time.strftime("%c"))
 logger.write("Reading fasta files from %s \n" % FASTA_DIRECTORY)
 logger.write("Writing to: %s\n" % output_file)
+# What is in the sample so far, kept up to date for anything that wants to show it during the run.
+# The counts are written into each checkpoint with the records they came from, so a resumed run carries on
+# from exactly the same point.
+abundance = AbundanceTable(one_codex_directory + RUN_NAME + ".abundance", RUN_NAME, interval=ABUNDANCE_INTERVAL)
+if checkpoint.files:
+    if checkpoint.counts is None:
+        # Checkpoint from an older version, without counts: carry on from the last snapshot instead.
+        abundance.load()
+        checkpoint.record_counts(abundance.counts())
+    abundance.restore(checkpoint.counts)
+    logger.write("Resuming from %s: %d fasta files started, %d bytes of unchecked results removed\n"
+                 % (CHECKPOINT, len(checkpoint.files), unchecked_bytes))
 logger.close()
 
-# Create for loop, searching for created 1D fasta files.
-while not run_exhausted:
-    while len(fasta_files) == 0:
-        fasta_files = [FASTA_DIRECTORY + filename for filename in os.listdir(FASTA_DIRECTORY)
-                       if filename.endswith((".fa", ".fasta", ".fna")) and filename not in fasta_files_old]
-        if len(fasta_files) != 0:
-            break
-
-        if WATCH < patience_counter:
-            run_exhausted = True
-            break
-        # No? Take a minute sleep.
-        if patience_counter != 0:
-            abstinence_message = "No fast5 files found in the last %d seconds.\n" % patience_counter
-            sleeping_message = "Waiting 60 seconds, breaking in {0:d} if no more reads created.\n" \
-                .format(WATCH - patience_counter)
-            logger = open(LOGFILE, 'a+')
-            print(abstinence_message)
-            print(sleeping_message)
-            logger.write(abstinence_message + "\n")
-            logger.write(sleeping_message + "\n")
-        time.sleep(60)
-        patience_counter += 60
-
-    # Out of the while loop, either fast5 files have been found or run is exhausted.
-    patience_counter = 0  # Must be consecutive minute sleeps to exhaust the run.
+# Rates and latencies while the run goes, for seeing which stage is holding the others up.
+try:
+    metrics_exporters = MetricsExporters(REGISTRY, port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_INTERVAL)
+except IOError as error:
+    sys.exit("Error: %s" % error)
+reads_total = REGISTRY.counter("classify_reads_total", "Reads classified, including those given no tax_id")
+bases_total = REGISTRY.counter("classify_bases_total", "Bases in the reads classified")
+classified_total = REGISTRY.counter("classify_classified_total", "Reads given a tax_id")
+failed_total = REGISTRY.counter("classify_failed_total", "Reads that could not be classified")
+
+
+def log_idle(idle_seconds, remaining_seconds):
+    abstinence_message = "No fasta files found in the last %d seconds.\n" % idle_seconds
+    sleeping_message = "Waiting for new fasta files, breaking in {0:d} if no more reads created.\n" \
+        .format(remaining_seconds)
+    print(abstinence_message)
+    print(sleeping_message)
+    logger = open(LOGFILE, 'a+')
+    logger.write(abstinence_message + "\n")
+    logger.write(sleeping_message + "\n")
+    logger.close()
+
+
+def record_result(fasta_file, name, tax_id, length, output):
+    # Count a read given a result, and write it out if that is a tax_id.
+    global sequences_read, sequences_classified
+    sequences_read += 1
+    reads_total.inc()
+    bases_total.inc(length)
+    abundance.add(tax_id, length, fasta_file)
+    if tax_id != 0:
+        sequences_classified += 1
+        classified_total.inc()
+        output.write(name + "\t" + str(tax_id) + "\n")
+
+
+def classify(fasta_file, records, start, finished):
+    # records are (name, sequence), following the first start records of fasta_file. Results come back in
+    # the same order, however many are in flight. finished is whether these are the last in the file.
+    global sequences_failed
+    output = open(output_file, 'a+')
+    position = start
+    # Read lengths, oldest first, for the abundance table; the results come back in the same order.
+    lengths = deque()
+    # Numbers of the reads that could not be searched since the last checkpoint, kept in it for retry_failed().
+    failed = []
+
+    def measured(records):
+        for name, sequence in records:
+            lengths.append(len(sequence))
+            yield name, sequence
+
+    try:
+        for name, tax_id in client.classify_all(measured(records)):
+            position += 1
+            length = lengths.popleft()
+            if tax_id is None:
+                sequences_failed += 1
+                failed_total.inc()
+                failed.append(position - 1)
+            else:
+                record_result(fasta_file, name, tax_id, length, output)
+            if position % CHECKPOINT_RECORDS == 0:
+                checkpoint.commit(fasta_file, position, False, output, abundance.take_uncommitted(fasta_file),
+                                  failed=failed)
+                failed = []
+                abundance.save_if_due()
+    except OneCodexAuthError as error:
+        sys.exit(str(error))
+    checkpoint.commit(fasta_file, position, finished, output, abundance.take_uncommitted(fasta_file), failed=failed)
+    abundance.save_if_due()
+    output.close()
+    return position - start
+
+
+def retry_failed(fasta_file):
+    # Search again the reads of fasta_file that could not be searched when they were first read. Returns the
+    # number that now have been.
+    numbers = deque()
+
+    def failed_records():
+        for number, name, sequence in read_numbered(fasta_file, checkpoint.failed_records(fasta_file)):
+            numbers.append((number, len(sequence)))
+            yield name, sequence
+
+    output = open(output_file, 'a+')
+    retried = []
+    try:
+        for name, tax_id in client.classify_all(failed_records()):
+            number, length = numbers.popleft()
+            if tax_id is not None:
+                record_result(fasta_file, name, tax_id, length, output)
+                retried.append(number)
+    except OneCodexAuthError as error:
+        sys.exit(str(error))
+    checkpoint.commit(fasta_file, checkpoint.records_done(fasta_file), checkpoint.is_finished(fasta_file), output,
+                      abundance.take_uncommitted(fasta_file), retried=retried)
+    output.close()
+    return len(retried)
+
+
+def is_sequence_file(filename):
+    if filename.endswith(DONE_SUFFIX):
+        filename = filename[:-len(DONE_SUFFIX)]
+    return filename.endswith(SEQUENCE_SUFFIXES)
+
+
+# New fasta files are picked up as soon as nanonet finishes writing them, rather than once a minute.
+# Files from nanonet-realtime.py --output rolling are followed while they are written, every tail_interval.
+watcher = DirectoryWatcher(FASTA_DIRECTORY, match=is_sequence_file, watch=WATCH, on_idle=log_idle,
+                           use_inotify=not POLL, tick=TAIL_INTERVAL)
+
+for new_fasta_files in watcher.batches():
+    fasta_files = []
+    for filename in new_fasta_files:
+        if filename.endswith(DONE_SUFFIX):
+            filename = filename[:-len(DONE_SUFFIX)]
+        fasta_file = FASTA_DIRECTORY + filename
+        if fasta_file in fasta_files_old or fasta_file in fasta_files_following or fasta_file in fasta_files:
+            continue
+        if checkpoint.is_finished(fasta_file):
+            fasta_files_old.append(fasta_file)
+        elif os.path.isfile(fasta_file + INDEX_SUFFIX):
+            # Rolling output: its index says which reads are completely written.
+            fasta_files_following[fasta_file] = checkpoint.records_done(fasta_file)
+        else:
+            fasta_files.append(fasta_file)
 
     # Run one codex on the set of fasta files.
     for fasta_file in fasta_files:
-        fasta_sequences = SeqIO.parse(open(fasta_file), 'fasta')
-        output = open(output_file, 'a+')
-        for fasta in fasta_sequences:
-            name, sequence = fasta.id, str(fasta.seq)
-            payload = {'sequence':sequence}
-            r = requests.post(ONECODEX_SEARCH_HTML, payload, auth=auth, timeout=timeout)
-            if r.status_code != GOOD_ONECODEX_STATUS:
-                if r.status_code == 400:
-                    sys.exit('The One Codex API key was not provided')
-                elif r.status_code == 401:
-                    sys.exit('The One Codex API key provided was invalid')
-                else:
-                  continue
-
-            result = json.loads(r.text)
-            tax_id = result['tax_id']
-            sequences_read += 1
-            if tax_id != 0:
-                sequences_classified += 1
-                output.write(name + "\t" + str(tax_id) + "\n")
+        # fasta or fastq, gzipped or not.
+        start = checkpoint.records_done(fasta_file)
+        classify(fasta_file, islice(read_sequences(fasta_file), start, None), start, True)
         fasta_files_old.append(fasta_file)
-        output.close()
-    # Re-enter for loop
-    fasta_files = []
-# Run has been exhausted.
-output.close()
+
+    # And on any reads added to the rolling fasta files since last time.
+    for fasta_file in sorted(fasta_files_following):
+        # Checked before the index is read, so the last reads of a file are not missed.
+        finished = is_done(fasta_file)
+        entries = read_index(fasta_file, start=fasta_files_following[fasta_file])
+        if entries or finished:
+            classify(fasta_file, ((name, sequence) for name, sequence, quality in read_records(fasta_file, entries)),
+                     fasta_files_following[fasta_file], finished)
+            fasta_files_following[fasta_file] += len(entries)
+            # A file still growing counts as activity, as new files do.
+            watcher.touch()
+        if finished:
+            del fasta_files_following[fasta_file]
+            fasta_files_old.append(fasta_file)
+# Run has been exhausted. Reads that could not be searched are tried once more, as they are whenever the script
+# is run again, rather than being skipped for good.
+sequences_retried = 0
+for fasta_file in sorted(checkpoint.failed):
+    if os.path.isfile(fasta_file):
+        sequences_retried += retry_failed(fasta_file)
+sequences_unsearched = sum(len(checkpoint.failed_records(fasta_file)) for fasta_file in checkpoint.failed)
+abundance.save()
+metrics_exporters.close()
 
 logger = open(LOGFILE, 'a+')
 end_time = time.time()
@@ -167,3 +413,14 @@ run_time = end_time - start_time
 logger.write("Finished one codex analysis in %d seconds.\n" % run_time)
 logger.write("Analysed %d sequences\n" % sequences_read)
 logger.write("Classified %d sequences\n" % sequences_classified)
+logger.write("Skipped %d sequences that could not be searched\n" % sequences_failed)
+logger.write("Searched %d sequences skipped earlier. %d are still to be searched, when the script is next run\n"
+             % (sequences_retried, sequences_unsearched))
+logger.write("%s\n" % client.summary())
+if cache:
+    logger.write("Cache: %s\n" % cache.summary())
+logger.close()
+client.close()
+if cache:
+    cache.close()
+checkpoint.close()
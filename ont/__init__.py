@@ -0,0 +1,2 @@
+# Shared helpers for the realtime scripts in the top level of this repository.
+# The scripts add their own directory to sys.path when run, so 'import ont' works without installing anything.
@@ -0,0 +1,101 @@
+"""Running read and base counts for each tax_id, saved as a small snapshot for dashboards to read."""
+import json
+import os
+import threading
+import time
+
+UNCLASSIFIED = 0
+
+
+class AbundanceTable(object):
+    """Reads and bases per tax_id, updated as each read is classified.
+
+    On save(), or save_if_due() once interval seconds have passed, <path>.json and <path>.tsv are
+    replaced, by rename, with the current table: one entry per tax_id, most reads first, so reading
+    what is in the sample takes time in proportion to the number of taxa rather than of reads.
+    Unclassified reads are counted under tax_id 0.
+    Counts added from a source are also kept until take_uncommitted(source), to be written in the
+    checkpoint along with the records they came from. A resumed run restore()s the totals from there.
+    """
+
+    def __init__(self, path, run_name, interval=30):
+        self.path = path
+        self.run_name = run_name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reads = {}
+        self.bases = {}
+        self.uncommitted = {}
+        self.saved = time.time()
+
+    def load(self):
+        # Carry on from the last snapshot, when resuming from a checkpoint that has no counts.
+        if not os.path.isfile(self.path + ".json"):
+            return False
+        with open(self.path + ".json") as snapshot:
+            taxa = json.load(snapshot)["taxa"]
+        with self.lock:
+            for taxon in taxa:
+                self.reads[taxon["tax_id"]] = taxon["reads"]
+                self.bases[taxon["tax_id"]] = taxon["bases"]
+        return True
+
+    def restore(self, counts):
+        # counts are {tax_id: (reads, bases)}, as kept by the checkpoint.
+        with self.lock:
+            for tax_id, (reads, bases) in counts.items():
+                self.reads[tax_id] = reads
+                self.bases[tax_id] = bases
+
+    def counts(self):
+        with self.lock:
+            return dict((tax_id, (reads, self.bases[tax_id])) for tax_id, reads in self.reads.items())
+
+    def add(self, tax_id, length, source=None):
+        with self.lock:
+            self.reads[tax_id] = self.reads.get(tax_id, 0) + 1
+            self.bases[tax_id] = self.bases.get(tax_id, 0) + length
+            if source is not None:
+                counts = self.uncommitted.setdefault(source, {}).setdefault(tax_id, [0, 0])
+                counts[0] += 1
+                counts[1] += length
+
+    def take_uncommitted(self, source):
+        # The counts added from source since the last call, for its next checkpoint.
+        with self.lock:
+            return self.uncommitted.pop(source, {})
+
+    def save_if_due(self):
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def snapshot(self):
+        with self.lock:
+            total = sum(self.reads.values())
+            classified = total - self.reads.get(UNCLASSIFIED, 0)
+            taxa = [{"tax_id": tax_id, "reads": reads, "bases": self.bases[tax_id],
+                     "fraction": float(reads) / classified if classified and tax_id != UNCLASSIFIED else 0.0}
+                    for tax_id, reads in self.reads.items()]
+        taxa.sort(key=lambda taxon: (-taxon["reads"], taxon["tax_id"]))
+        return {"run_name": self.run_name, "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "reads": total, "classified": classified, "taxa": taxa}
+
+    def save(self):
+        snapshot = self.snapshot()
+        self.saved = time.time()
+        _replace(self.path + ".json", json.dumps(snapshot, indent=1) + "\n")
+        lines = ["tax_id\treads\tbases\tfraction\n"]
+        lines.extend("%d\t%d\t%d\t%.6f\n" % (taxon["tax_id"], taxon["reads"], taxon["bases"], taxon["fraction"])
+                     for taxon in snapshot["taxa"])
+        _replace(self.path + ".tsv", "".join(lines))
+        return snapshot
+
+
+def _replace(path, text):
+    # Readers see the old file or the new one, never half of one.
+    temporary = path + ".tmp"
+    with open(temporary, 'w') as handle:
+        handle.write(text)
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
@@ -0,0 +1,281 @@
+"""A long-lived basecaller process that takes batches over a pipe.
+
+Starting nanonetcall for every batch pays for the interpreter and for importing numpy and nanonet each
+time, which for small realtime batches can cost more than the calling. The service imports the backend
+once and then calls each batch in the same process.
+
+The nanonet model is not kept loaded between batches. nanonet has no call that takes an already loaded
+network: its per-read function, process_read, is given the model file and loads it itself, and
+nanonetcall.main() does the same for each batch. So only the start up and imports are saved.
+
+Run as 'python -m ont.basecall_service --backend nanonet|stub'. Requests and replies are JSON, one per
+line: {"input": <directory of fast5 files>, "output": <fasta file>, "jobs": <threads>, "fastq": <bool>}
+gets back {"ok": true, "reads": <records written>, "seconds": <time taken>} or {"ok": false, "error": <message>}.
+If output is null, each record is sent back as soon as it is called, as {"record": [name, sequence, quality]},
+before the final reply. BasecallService starts and talks to one of these processes.
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from ont.sequences import RecordParser
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASES = "ACGT"
+
+
+class NanonetBackend(object):
+    """Runs nanonetcall's own command line entry point inside this process, which loads the model each time."""
+
+    name = "nanonet"
+
+    def __init__(self):
+        # Imported once for the life of the service: this is the start up cost being saved. The model is
+        # still loaded by nanonetcall.main() for every batch.
+        from nanonet import nanonetcall
+        self.nanonetcall = nanonetcall
+
+    def call_batch(self, directory, output, jobs, fastq=False):
+        # output is a file-like object the called reads are written to as FASTA or FASTQ text.
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv = ["nanonetcall", "--jobs", str(jobs)] + (["--fastq"] if fastq else []) + [directory]
+        sys.stdout = output
+        try:
+            self.nanonetcall.main()
+        except SystemExit as exit_status:
+            if exit_status.code:
+                raise RuntimeError("nanonetcall exited with status %s" % exit_status.code)
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+
+
+class StubBackend(object):
+    """Writes a made up sequence for every fast5 file, so the pipeline can be run without nanonet.
+
+    The sequence depends only on the file name. delay seconds are spent on each read to imitate calling.
+    """
+
+    name = "stub"
+
+    def __init__(self, length=200, delay=0.0):
+        self.length = length
+        self.delay = delay
+
+    def sequence(self, name):
+        seed = hashlib.md5(name.encode("utf-8")).digest()
+        bases = []
+        while len(bases) < self.length:
+            seed = hashlib.md5(seed).digest()
+            bases.extend(BASES[byte % 4] for byte in bytearray(seed))
+        return "".join(bases[:self.length])
+
+    def call_batch(self, directory, output, jobs, fastq=False):
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".fast5"):
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            sequence = self.sequence(name)
+            if fastq:
+                quality = "".join(chr(33 + ord(base) % 31) for base in sequence)
+                output.write("@%s\n%s\n+\n%s\n" % (name[:-len(".fast5")], sequence, quality))
+            else:
+                output.write(">%s\n%s\n" % (name[:-len(".fast5")], sequence))
+
+
+BACKENDS = {"nanonet": NanonetBackend, "stub": StubBackend}
+
+
+class _Tee(object):
+    # Writes to a file while counting the records in what is written.
+
+    def __init__(self, handle, parser):
+        self.handle = handle
+        self.parser = parser
+
+    def write(self, text):
+        self.handle.write(text)
+        self.parser.write(text)
+
+    def flush(self):
+        self.handle.flush()
+
+
+def _send(protocol, message):
+    protocol.write(json.dumps(message) + "\n")
+    protocol.flush()
+
+
+def serve(backend):
+    # The protocol gets its own copy of stdout; anything else the backend prints goes to stderr.
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    _send(protocol, {"ok": True, "backend": backend.name})
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        start = time.time()
+        fastq = request.get("fastq", False)
+        try:
+            if request.get("output"):
+                with open(request["output"], 'w') as output:
+                    parser = RecordParser(lambda name, sequence, quality: None)
+                    backend.call_batch(request["input"], _Tee(output, parser), request.get("jobs", 1), fastq)
+            else:
+                parser = RecordParser(lambda name, sequence, quality: _send(protocol, {
+                    "record": [name, sequence, quality]}))
+                backend.call_batch(request["input"], parser, request.get("jobs", 1), fastq)
+            parser.close()
+            reply = {"ok": True, "reads": parser.records, "seconds": time.time() - start}
+        except Exception as error:
+            reply = {"ok": False, "error": "%s: %s" % (type(error).__name__, error)}
+        _send(protocol, reply)
+
+
+class BasecallError(RuntimeError):
+    pass
+
+
+class BasecallService(object):
+    """Client for one service process. Calls are serialised; use one service per worker thread."""
+
+    def __init__(self, backend="nanonet", stub_length=200, stub_delay=0.0):
+        command = [sys.executable, "-m", "ont.basecall_service", "--backend", backend,
+                   "--stub_length", str(stub_length), "--stub_delay", str(stub_delay)]
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(
+            [REPOSITORY_DIRECTORY] + [path for path in [environment.get("PYTHONPATH")] if path])
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env=environment, universal_newlines=True)
+        self.lock = threading.Lock()
+        ready = self._reply()
+        if not ready.get("ok"):
+            self.close()
+            raise BasecallError("Basecall service failed to start: %s" % ready.get("error"))
+
+    def _reply(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise BasecallError("Basecall service exited with status %s" % self.process.wait())
+        return json.loads(line)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, directory, output=None, jobs=1, fastq=False, on_record=None):
+        # Basecall every fast5 file in directory into the file output, or pass each record to
+        # on_record(name, sequence, quality) as it is called if output is None. Returns the number of reads.
+        with self.lock:
+            request = {"input": directory, "output": output, "jobs": jobs, "fastq": fastq}
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+            except (IOError, OSError):
+                raise BasecallError("Basecall service exited with status %s" % self.process.wait())
+            reply = self._reply()
+            while "record" in reply:
+                on_record(*reply["record"])
+                reply = self._reply()
+        if not reply.get("ok"):
+            raise BasecallError(reply.get("error"))
+        return reply["reads"]
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class ServicePool(object):
+    """A BasecallService for each basecall worker thread, started the first time the thread asks for one.
+
+    The first service is started here, so a backend that cannot start is found (as a BasecallError) before any
+    reads are staged, and is handed to the first thread to ask. A service whose process has died is replaced
+    by call(), and report(message), if given, is told.
+    """
+
+    def __init__(self, backend="nanonet", stub_length=200, stub_delay=0.0, report=None):
+        self.options = (backend, stub_length, stub_delay)
+        self.report = report
+        self.services = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spare = [self._start()]
+
+    def _start(self):
+        service = BasecallService(*self.options)
+        with self.lock:
+            self.services.append(service)
+        return service
+
+    def service(self):
+        # This thread's own service, so that calls from different workers are not serialised.
+        if not hasattr(self.local, "service"):
+            with self.lock:
+                spare = self.spare.pop() if self.spare else None
+            self.local.service = spare or self._start()
+        return self.local.service
+
+    def _replace(self, dead):
+        with self.lock:
+            self.services.remove(dead)
+        dead.close()
+        del self.local.service
+        return self.service()
+
+    def call(self, directory, output=None, jobs=1, fastq=False, on_record=None):
+        """Call a batch in this thread's service, as BasecallService.call does.
+
+        If the service process dies during the batch, a new one is started and the batch is called once
+        more. Records already passed to on_record are not passed again. A batch the backend itself fails
+        on, or that a second service also dies on, raises BasecallError.
+        """
+        passed = set()
+
+        def record(name, sequence, quality):
+            if name not in passed:
+                passed.add(name)
+                on_record(name, sequence, quality)
+
+        receiver = record if on_record else None
+        service = self.service()
+        try:
+            return service.call(directory, output, jobs, fastq, receiver)
+        except BasecallError as error:
+            if service.alive():
+                raise
+            if self.report:
+                self.report("%s while calling %s. Starting another and calling the batch again" % (error, directory))
+            service = self._replace(service)
+        return service.call(directory, output, jobs, fastq, receiver)
+
+    def close(self):
+        for service in self.services:
+            service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived basecaller taking batches as JSON lines on stdin.")
+    parser.add_argument("--backend", nargs='?', dest="BACKEND", type=str, default="nanonet",
+                        choices=sorted(BACKENDS))
+    parser.add_argument("--stub_length", nargs='?', dest="STUB_LENGTH", type=int, default=200)
+    parser.add_argument("--stub_delay", nargs='?', dest="STUB_DELAY", type=float, default=0.0)
+    args = parser.parse_args()
+    try:
+        if args.BACKEND == "stub":
+            backend = StubBackend(length=args.STUB_LENGTH, delay=args.STUB_DELAY)
+        else:
+            backend = BACKENDS[args.BACKEND]()
+    except Exception as error:
+        sys.stdout.write(json.dumps({"ok": False, "error": "%s: %s" % (type(error).__name__, error)}) + "\n")
+        sys.stdout.flush()
+        sys.exit(1)
+    serve(backend)
+
+
+if __name__ == "__main__":
+    main()
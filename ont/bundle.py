@@ -0,0 +1,191 @@
+"""Pack batches of small reads into tar bundles for transfer, and unpack them again on the server.
+
+Each bundle <name>.tar (or .tar.gz) has a sidecar <name>.tar.index listing, for every read, its offset and
+size within the uncompressed tar, its mtime and checksum. The index is put in place before the bundle,
+so a bundle that is visible always has a complete index.
+"""
+import itertools
+import os
+import tarfile
+import threading
+import time
+
+from ont.checksum import HashingReader, new_hasher, partial_name
+
+BUNDLE_SUFFIXES = (".tar", ".tar.gz")
+INDEX_SUFFIX = ".index"
+COMPRESSION_MODES = {"none": "w|", "gz": "w|gz"}
+
+
+def is_bundle(name):
+    return name.endswith(BUNDLE_SUFFIXES) and not name.startswith(".")
+
+
+def index_name(bundle_name):
+    return bundle_name + INDEX_SUFFIX
+
+
+_bundle_counter = itertools.count(1)
+
+
+def bundle_name(run_name, compression="none"):
+    suffix = ".tar.gz" if compression == "gz" else ".tar"
+    return "%s_bundle_%s_%d_%06d%s" % (run_name, time.strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                      next(_bundle_counter), suffix)
+
+
+def write_bundle(fileobj, paths, compression="none", checksum="crc32"):
+    """Stream the files in paths into a tar written to fileobj. Returns the index as a list of
+    (name, offset, size, mtime, checksum) tuples."""
+    entries = []
+    tar = tarfile.open(fileobj=fileobj, mode=COMPRESSION_MODES[compression])
+    try:
+        for path in paths:
+            tarinfo = tar.gettarinfo(path, arcname=os.path.basename(path))
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ""
+            header_size = len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+            offset = tar.offset + header_size
+            hasher = None if checksum == "none" else new_hasher(checksum)
+            with open(path, 'rb') as handle:
+                tar.addfile(tarinfo, HashingReader(handle, hasher))
+            read_checksum = None if hasher is None else "%s:%s" % (checksum, hasher.hexdigest())
+            entries.append((tarinfo.name, offset, tarinfo.size, tarinfo.mtime, read_checksum))
+    finally:
+        tar.close()
+    return entries
+
+
+def format_index(entries):
+    return "".join("%s\t%d\t%d\t%d\t%s\n" % (name, offset, size, mtime, checksum or "-")
+                   for name, offset, size, mtime, checksum in entries)
+
+
+def read_index(path):
+    entries = []
+    with open(path) as index:
+        for line in index:
+            name, offset, size, mtime, checksum = line.rstrip("\n").split("\t")
+            entries.append((name, int(offset), int(size), int(mtime), checksum))
+    return entries
+
+
+def extract_read(bundle_path, name, destination_directory):
+    # Pull a single read out of a bundle. Uncompressed bundles are read by seeking to the index offset.
+    destination = os.path.join(destination_directory, name)
+    temporary = os.path.join(destination_directory, partial_name(name))
+    for entry_name, offset, size, mtime, _ in read_index(bundle_path + INDEX_SUFFIX):
+        if entry_name != name:
+            continue
+        if bundle_path.endswith(".tar"):
+            with open(bundle_path, 'rb') as bundle:
+                bundle.seek(offset)
+                with open(temporary, 'wb') as output:
+                    output.write(bundle.read(size))
+        else:
+            with tarfile.open(bundle_path, 'r|*') as tar:
+                for member in tar:
+                    if member.name == name:
+                        with open(temporary, 'wb') as output:
+                            output.write(tar.extractfile(member).read())
+                        break
+        os.utime(temporary, (mtime, mtime))
+        os.rename(temporary, destination)
+        return destination
+    raise KeyError("%s is not in bundle %s" % (name, bundle_path))
+
+
+def unpack_bundle(bundle_path, destination_directory, remove=True):
+    """Extract every read in a bundle into destination_directory, each appearing under its own name only
+    once complete. The bundle and its index are removed afterwards unless remove is False.
+    Returns the names of the reads extracted."""
+    names = []
+    with tarfile.open(bundle_path, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            temporary = os.path.join(destination_directory, partial_name(name))
+            source = tar.extractfile(member)
+            with open(temporary, 'wb') as output:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    output.write(chunk)
+            os.utime(temporary, (member.mtime, member.mtime))
+            os.rename(temporary, os.path.join(destination_directory, name))
+            names.append(name)
+    if remove:
+        os.remove(bundle_path)
+        if os.path.isfile(bundle_path + INDEX_SUFFIX):
+            os.remove(bundle_path + INDEX_SUFFIX)
+    return names
+
+
+class Bundler(object):
+    """Collect reads into batches of at most max_reads reads or max_bytes bytes.
+
+    A batch is passed to submit(paths, oldest_mtime) once it is full, or once its oldest read has waited
+    max_age seconds, so a slow trickle of reads is not held back indefinitely.
+    """
+
+    def __init__(self, submit, max_reads=100, max_bytes=64 * 1024 * 1024, max_age=10):
+        self.submit = submit
+        self.max_reads = max_reads
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.condition = threading.Condition()
+        self.paths = []
+        self.bytes = 0
+        self.oldest_mtime = None
+        self.started = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._flush_when_old, name="bundler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path, size, mtime):
+        with self.condition:
+            if self.paths and self.bytes + size > self.max_bytes:
+                self._flush()
+            if not self.paths:
+                self.started = time.time()
+                self.oldest_mtime = mtime
+                self.condition.notify()
+            self.paths.append(path)
+            self.bytes += size
+            if len(self.paths) >= self.max_reads or self.bytes >= self.max_bytes:
+                self._flush()
+
+    def resize(self, max_reads, max_bytes):
+        # For batches from now on; a batch already over the new size goes with the next read added.
+        with self.condition:
+            self.max_reads = max_reads
+            self.max_bytes = max_bytes
+
+    def _flush(self):
+        # Called with the condition held.
+        if not self.paths:
+            return
+        paths, oldest_mtime = tuple(self.paths), self.oldest_mtime
+        self.paths = []
+        self.bytes = 0
+        self.started = None
+        self.submit(paths, oldest_mtime)
+
+    def _flush_when_old(self):
+        with self.condition:
+            while not self.closed:
+                if self.started is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.started + self.max_age - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self._flush()
+
+    def close(self):
+        with self.condition:
+            self._flush()
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,147 @@
+"""How far through each fasta file classification has got, kept on disk so a restart carries on from there."""
+import json
+import os
+import threading
+
+NO_COUNTS = "-"  # in place of the counts on a line with failed records, in a log that does not keep counts
+
+
+class ClassificationCheckpoint(object):
+    """Append-only log of (fasta file, records done, finished, output file, output size, counts, failed).
+
+    A line is written after the output for those records has been flushed to disk, so the two always agree
+    up to the last line. Output written after the last line (by a run that then crashed) is cut off again by
+    restore_outputs(), and those records are classified again rather than appearing twice.
+    counts are the reads and bases given each tax_id since the file's previous line, in the same line, so
+    the totals in counts always match the records checkpointed. They are None for a log written before
+    counts were kept, until record_counts() is given the totals to carry on from.
+    failed are the numbers, counting from 0, of the file's records done that could not be classified, so they
+    can be tried again. Each line has all of the file's failed records, and is left off if there are none.
+    The log is rewritten with only the latest line for each file, and the totals, whenever it is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.outputs = {}
+        self.counts = {}
+        self.failed = {}
+        if os.path.isfile(path):
+            self._load()
+            self._compact()
+        self.handle = open(path, 'a')
+
+    def _load(self):
+        counted = False
+        with open(self.path) as checkpoint:
+            for line in checkpoint:
+                if not line.endswith("\n"):
+                    break  # partially written last line
+                fields = line.rstrip("\n").split("\t")
+                failed = json.loads(fields.pop()) if len(fields) == 7 else []
+                if len(fields) == 6:
+                    counts = fields.pop()
+                    if counts != NO_COUNTS:
+                        counted = True
+                        _add_counts(self.counts, json.loads(counts))
+                if len(fields) != 5:
+                    continue
+                fasta_file, records, finished, output_file, output_size = fields
+                self.files[fasta_file] = (int(records), finished == "1", output_file)
+                self.outputs[output_file] = int(output_size)
+                self._set_failed(fasta_file, failed)
+        if self.files and not counted:
+            self.counts = None
+
+    def _compact(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, 'w') as checkpoint:
+            for number, (fasta_file, (records, finished, output_file)) in enumerate(sorted(self.files.items())):
+                # The totals go on the first line, and add up to the same when the log is next loaded.
+                checkpoint.write(self._line(fasta_file, records, finished, output_file, self.outputs[output_file],
+                                            self.counts if number == 0 else {}))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temporary, self.path)
+
+    def restore_outputs(self):
+        # Cut each output file back to its size at the last checkpoint. Returns the number of bytes removed.
+        removed = 0
+        for output_file, output_size in self.outputs.items():
+            if os.path.isfile(output_file) and os.path.getsize(output_file) > output_size:
+                removed += os.path.getsize(output_file) - output_size
+                with open(output_file, 'r+') as output:
+                    output.truncate(output_size)
+        return removed
+
+    def records_done(self, fasta_file):
+        return self.files.get(fasta_file, (0, False, None))[0]
+
+    def is_finished(self, fasta_file):
+        return self.files.get(fasta_file, (0, False, None))[1]
+
+    def failed_records(self, fasta_file):
+        return sorted(self.failed.get(fasta_file, ()))
+
+    def _set_failed(self, fasta_file, failed):
+        if failed:
+            self.failed[fasta_file] = set(failed)
+        else:
+            self.failed.pop(fasta_file, None)
+
+    def _line(self, fasta_file, records, finished, output_file, output_size, counts):
+        line = "%s\t%d\t%d\t%s\t%d" % (fasta_file, records, finished, output_file, output_size)
+        failed = self.failed.get(fasta_file)
+        if self.counts is not None or failed:
+            line += "\t" + (NO_COUNTS if self.counts is None else _format_counts(counts))
+        if failed:
+            line += "\t" + json.dumps(sorted(failed), separators=(",", ":"))
+        return line + "\n"
+
+    def commit(self, fasta_file, records, finished, output, counts=None, failed=(), retried=()):
+        """Record that the first records of fasta_file are classified, with their results in output.
+
+        output is the open output file; it is flushed and synced to disk first. counts are the reads and
+        bases given each tax_id, {tax_id: (reads, bases)}, since the last commit for fasta_file. failed are
+        the numbers of records since then that could not be classified, and retried those of earlier failed
+        records that now have been.
+        """
+        output.flush()
+        os.fsync(output.fileno())
+        output_size = os.fstat(output.fileno()).st_size
+        with self.lock:
+            self.files[fasta_file] = (records, finished, output.name)
+            self.outputs[output.name] = output_size
+            self._set_failed(fasta_file, self.failed.get(fasta_file, set()).union(failed).difference(retried))
+            if self.counts is not None:
+                _add_counts(self.counts, counts or {})
+            self.handle.write(self._line(fasta_file, records, finished, output.name, output_size, counts or {}))
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+
+    def record_counts(self, counts):
+        # Carry on a log from an older version from these totals, such as those in the last abundance snapshot.
+        with self.lock:
+            self.counts = {}
+            _add_counts(self.counts, counts)
+            self.handle.close()
+            self._compact()
+            self.handle = open(self.path, 'a')
+
+    def close(self):
+        self.handle.close()
+
+
+def _add_counts(totals, counts):
+    for tax_id, (reads, bases) in counts.items():
+        total = totals.setdefault(int(tax_id), [0, 0])
+        total[0] += reads
+        total[1] += bases
+
+
+def _format_counts(counts):
+    return json.dumps(dict((str(tax_id), list(value)) for tax_id, value in counts.items()), separators=(",", ":"),
+                      sort_keys=True)
@@ -0,0 +1,150 @@
+"""Streaming checksums and a verified copy that only ever exposes complete files under their real name."""
+import hashlib
+import os
+import shutil
+import zlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PARTIAL_PREFIX = "."
+PARTIAL_SUFFIX = ".partial"
+
+
+class ChecksumError(IOError):
+    pass
+
+
+class _Crc32(object):
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+
+class HashingReader(object):
+    """File-like wrapper hashing everything read through it. hasher may be None."""
+
+    def __init__(self, handle, hasher):
+        self.handle = handle
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+
+class HashingWriter(object):
+    """File-like wrapper hashing and counting everything written through it. hasher may be None."""
+
+    def __init__(self, handle, hasher):
+        self.handle = handle
+        self.hasher = hasher
+        self.bytes = 0
+
+    def write(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.bytes += len(data)
+        self.handle.write(data)
+
+    def flush(self):
+        self.handle.flush()
+
+
+def algorithms():
+    available = ["crc32", "md5"]
+    if xxhash is not None:
+        available.insert(0, "xxhash")
+    return available
+
+
+def new_hasher(algorithm):
+    if algorithm == "crc32":
+        return _Crc32()
+    if algorithm == "md5":
+        return hashlib.md5()
+    if algorithm == "xxhash":
+        if xxhash is None:
+            raise ValueError("xxhash checksums need the xxhash module (pip install xxhash)")
+        return xxhash.xxh64()
+    raise ValueError("Unknown checksum algorithm %s" % algorithm)
+
+
+def file_checksum(path, algorithm, chunk_size=CHUNK_SIZE):
+    hasher = new_hasher(algorithm)
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            hasher.update(chunk)
+    return "%s:%s" % (algorithm, hasher.hexdigest())
+
+
+def partial_name(name):
+    # Hidden and without the .fast5 suffix, so no downstream scan will pick it up.
+    return PARTIAL_PREFIX + name + PARTIAL_SUFFIX
+
+
+def _fsync_directory(directory):
+    if not hasattr(os, "O_DIRECTORY"):
+        return  # windows, or a filesystem where directories cannot be opened
+    try:
+        descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def copy_verified(source, destination_directory, algorithm="crc32", chunk_size=CHUNK_SIZE, read_back=True):
+    """Copy source into destination_directory and return its checksum, e.g. 'crc32:1a2b3c4d'.
+
+    The source is hashed on the way through and the copy written under a temporary name and fsynced, then
+    read back in full and hashed again. Only if the checksums match is it renamed into place, so the caller
+    can remove the source once this returns. Reading back doubles the traffic to a network drive; with
+    read_back False only the copy's size is checked against the bytes read. The source is left untouched.
+    """
+    name = os.path.basename(source)
+    temporary = os.path.join(destination_directory, partial_name(name))
+    destination = os.path.join(destination_directory, name)
+    hasher = new_hasher(algorithm)
+    copied = 0
+    try:
+        with open(source, 'rb') as reader:
+            with open(temporary, 'wb') as writer:
+                for chunk in iter(lambda: reader.read(chunk_size), b""):
+                    hasher.update(chunk)
+                    writer.write(chunk)
+                    copied += len(chunk)
+                writer.flush()
+                os.fsync(writer.fileno())
+        checksum = "%s:%s" % (algorithm, hasher.hexdigest())
+        copied_size = os.path.getsize(temporary)
+        if copied_size != copied:
+            raise ChecksumError("Size mismatch copying %s: %d on the laptop, %d on the server"
+                                % (source, copied, copied_size))
+        if read_back:
+            copied_checksum = file_checksum(temporary, algorithm, chunk_size)
+            if copied_checksum != checksum:
+                raise ChecksumError("Checksum mismatch copying %s: %s on the laptop, %s on the server"
+                                    % (source, checksum, copied_checksum))
+        shutil.copystat(source, temporary)
+        os.rename(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    _fsync_directory(destination_directory)
+    return checksum
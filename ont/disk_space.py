@@ -0,0 +1,252 @@
+"""Free space on the laptop and the server, and a scheduler that sets the pace of transfers from it.
+
+MinKNOW stops writing reads when the laptop's disk is full, so when space is short the reads must leave
+faster than they arrive. When there is plenty of space the transfers can instead give way to MinKNOW,
+which needs the same disk to write its reads, since every read moved is also read back off that disk.
+When the server itself is nearly full the transfers stop altogether until space is freed there, rather
+than leaving half written copies on it.
+"""
+import os
+import shutil
+import threading
+import time
+
+from ont.metrics import REGISTRY
+
+SAMPLE_INTERVAL = 5
+REPORT_INTERVAL = 600
+LOW_SECONDS = 60 * 60  # full within this long at the current rate counts as low space, however much is free
+HYSTERESIS = 0.05  # extra fraction free needed to leave low space, so the pace does not flap at the threshold
+IDLE_WRITE_RATE = 10000  # bytes a second written to the laptop's disk below which MinKNOW is taken to be idle
+SMOOTHING = 0.3  # weight of the newest sample in the rates
+
+LOW_SPACE = "low space"
+NORMAL = "normal"
+GIVING_WAY = "giving way to MinKNOW"
+SERVER_FULL = "server nearly full"
+
+
+def disk_usage(path):
+    """Return (total bytes, free bytes) for the filesystem holding path, or None if that cannot be told."""
+    try:
+        if hasattr(shutil, "disk_usage"):
+            usage = shutil.disk_usage(path)
+            return usage.total, usage.free
+        if hasattr(os, "statvfs"):  # python 2
+            status = os.statvfs(path)
+            return status.f_blocks * status.f_frsize, status.f_bavail * status.f_frsize
+    except OSError:
+        pass
+    return None
+
+
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1000:
+            return "%.1f %s" % (value, unit)
+        value /= 1000.0
+    return "%.1f TB" % value
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "never"
+    if seconds >= 2 * 24 * 60 * 60:
+        return "%.1f days" % (seconds / (24 * 60 * 60.0))
+    return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+def _smooth(previous, value):
+    return value if previous is None else SMOOTHING * value + (1 - SMOOTHING) * previous
+
+
+def _known(value):
+    return float("nan") if value is None else value
+
+
+class TransferScheduler(object):
+    """Every interval seconds, measure the free space on the laptop (the filesystem holding source) and on
+    the server (destination_free_space(), if given, returns bytes or None), and how fast MinKNOW is writing,
+    then set the pace of the transfer pool:
+
+    low space       under low_fraction free, or full within LOW_SECONDS at the current rate: max_workers
+                    threads, and bundles (if there is a bundler) twice the size, to empty the disk fastest
+    giving way      over high_fraction free while MinKNOW is writing: min_workers threads
+    normal          anything else: workers threads
+    server full     under destination_reserve bytes free on the server: no threads, until twice that is free
+
+    MinKNOW's writing is taken from the disk rather than from the reads found: what the laptop's free space
+    fell by, plus what the pool moved off it. So it is still seen while the pool is held back, and a backlog
+    found when the script starts is not mistaken for it.
+    With adapt False the pool is left as it is, and the pace is only measured and reported, except that
+    transfers are still paused while the server is nearly full.
+    report(message) is called when the pace changes and every REPORT_INTERVAL seconds.
+    """
+
+    def __init__(self, pool, source, destination_free_space=None, workers=4, min_workers=1, max_workers=8,
+                 low_fraction=0.2, high_fraction=0.5, destination_reserve=0, bundler=None, adapt=True,
+                 report=None, interval=SAMPLE_INTERVAL):
+        self.pool = pool
+        self.source = source
+        self.destination_free_space = destination_free_space
+        self.workers = {LOW_SPACE: max_workers, NORMAL: workers, GIVING_WAY: min_workers, SERVER_FULL: 0}
+        self.low_fraction = low_fraction
+        self.high_fraction = high_fraction
+        self.destination_reserve = destination_reserve
+        self.paused_limit = None  # the pool's limit before it was paused, with adapt False
+        self.bundler = bundler
+        self.bundle_size = (bundler.max_reads, bundler.max_bytes) if bundler else None
+        self.adapt = adapt
+        self.report = report
+        self.interval = interval
+        self.last = None  # (time, source free, bytes moved) at the last sample
+        self.write_rate = self.transfer_rate = self.fill_rate = None
+        self.source_total = self.source_free = self.destination_free = None
+        self.lowest_fraction = None
+        self.pace = NORMAL
+        self.pace_since = time.time()
+        self.pace_seconds = {}
+        self.changes = 0
+        self.last_report = time.time()
+        REGISTRY.gauge("transfer_source_free_bytes", "Bytes free on the laptop's disk",
+                       function=lambda: _known(self.source_free))
+        REGISTRY.gauge("transfer_source_seconds_to_full", "Seconds until the laptop's disk is full at the current "
+                       "rate, NaN if it is not filling", function=lambda: _known(self.seconds_to_full()))
+        REGISTRY.gauge("transfer_destination_free_bytes", "Bytes free on the server, NaN if unknown",
+                       function=lambda: _known(self.destination_free))
+        REGISTRY.gauge("transfer_minknow_write_bytes_per_second", "Bytes a second written to the laptop's disk, "
+                       "other than by transfers",
+                       function=lambda: _known(self.write_rate))
+        REGISTRY.gauge("transfer_workers_allowed", "Transfer workers the scheduler allows at once",
+                       function=lambda: self.pool.limit)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._sample_every_interval, name="transfer-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def free_fraction(self):
+        if not self.source_total:
+            return None
+        return self.source_free / float(self.source_total)
+
+    def seconds_to_full(self):
+        # At the rate the laptop's free space has been falling, or None if it is not falling.
+        if self.source_free is None or not self.fill_rate or self.fill_rate <= 0:
+            return None
+        return self.source_free / self.fill_rate
+
+    def destination_seconds_to_full(self):
+        # At the rate reads are being moved onto it.
+        if self.destination_free is None or not self.transfer_rate or self.transfer_rate <= 0:
+            return None
+        return self.destination_free / self.transfer_rate
+
+    def sample(self):
+        now = time.time()
+        usage = disk_usage(self.source)
+        destination_free = self.destination_free_space() if self.destination_free_space else None
+        moved = self.pool.bytes_moved()
+        if self.last is not None and now > self.last[0]:
+            seconds = now - self.last[0]
+            self.transfer_rate = _smooth(self.transfer_rate, (moved - self.last[2]) / seconds)
+            if usage and self.last[1] is not None:
+                fallen = self.last[1] - usage[1]
+                self.fill_rate = _smooth(self.fill_rate, fallen / seconds)
+                self.write_rate = _smooth(self.write_rate, max(fallen + moved - self.last[2], 0) / seconds)
+        self.last = (now, usage[1] if usage else None, moved)
+        if usage:
+            self.source_total, self.source_free = usage
+        self.destination_free = destination_free
+        fraction = self.free_fraction()
+        if fraction is not None and (self.lowest_fraction is None or fraction < self.lowest_fraction):
+            self.lowest_fraction = fraction
+        self._set_pace(self._choose_pace(), now)
+        if now - self.last_report >= REPORT_INTERVAL:
+            self._report()
+
+    def _choose_pace(self):
+        if self.destination_reserve and self.destination_free is not None:
+            reserve = self.destination_reserve * (2 if self.pace == SERVER_FULL else 1)
+            if self.destination_free < reserve:
+                return SERVER_FULL
+        fraction = self.free_fraction()
+        if fraction is None:
+            return NORMAL
+        low_fraction, low_seconds = self.low_fraction, LOW_SECONDS
+        if self.pace == LOW_SPACE:
+            low_fraction, low_seconds = low_fraction + HYSTERESIS, 2 * low_seconds
+        to_full = self.seconds_to_full()
+        if fraction < low_fraction or (to_full is not None and to_full < low_seconds):
+            return LOW_SPACE
+        if fraction > self.high_fraction and (self.write_rate or 0) > IDLE_WRITE_RATE:
+            return GIVING_WAY
+        return NORMAL
+
+    def _set_pace(self, pace, now):
+        if pace == self.pace:
+            return
+        self.pace_seconds[self.pace] = self.pace_seconds.get(self.pace, 0) + now - self.pace_since
+        self.pace, self.pace_since = pace, now
+        self.changes += 1
+        if not self.adapt:
+            # Only the pause is applied, and the pool then goes back to what it was allowed before.
+            if pace == SERVER_FULL:
+                self.paused_limit = self.pool.limit
+                self.pool.set_workers(0)
+            elif self.paused_limit is not None:
+                self.pool.set_workers(self.paused_limit)
+                self.paused_limit = None
+        else:
+            self.pool.set_workers(self.workers[pace])
+            if self.bundler:
+                scale = 2 if pace == LOW_SPACE else 1
+                self.bundler.resize(self.bundle_size[0] * scale, self.bundle_size[1] * scale)
+        self._report()
+
+    def status(self):
+        parts = []
+        fraction = self.free_fraction()
+        if fraction is None:
+            parts.append("Free space on the laptop unknown.")
+        else:
+            parts.append("Laptop %.1f%% free (%s), full in %s." % (fraction * 100, format_bytes(self.source_free),
+                                                                  format_duration(self.seconds_to_full())))
+        if self.destination_free is not None:
+            parts.append("Server %s free, full in %s." % (format_bytes(self.destination_free),
+                                                          format_duration(self.destination_seconds_to_full())))
+        parts.append("MinKNOW writing %s/s, transfers %s/s." % (format_bytes(self.write_rate or 0),
+                                                               format_bytes(self.transfer_rate or 0)))
+        if self.pace == SERVER_FULL:
+            parts.append("Pace: %s, transfers paused." % self.pace)
+        elif self.adapt:
+            parts.append("Pace: %s, moving %d files at once." % (self.pace, self.workers[self.pace]))
+        else:
+            parts.append("Pace would be: %s." % self.pace)
+        return " ".join(parts)
+
+    def _report(self):
+        self.last_report = time.time()
+        if self.report:
+            self.report(self.status())
+
+    def summary(self):
+        seconds = dict(self.pace_seconds)
+        seconds[self.pace] = seconds.get(self.pace, 0) + time.time() - self.pace_since
+        paces = ", ".join("%s %s" % (pace, format_duration(seconds[pace]))
+                          for pace in (LOW_SPACE, NORMAL, GIVING_WAY, SERVER_FULL) if pace in seconds)
+        lowest = "unknown" if self.lowest_fraction is None else "%.1f%%" % (self.lowest_fraction * 100)
+        return "Lowest free space on the laptop %s. Time at each pace: %s. %d changes of pace" \
+               % (lowest, paces, self.changes)
+
+    def _sample_every_interval(self):
+        with self.condition:
+            while not self.closed:
+                self.sample()
+                self.condition.wait(self.interval)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
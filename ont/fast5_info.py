@@ -0,0 +1,126 @@
+"""Read-level metadata from fast5 files, reading only the few attributes needed to judge a read.
+
+A fast5 file is HDF5. MinKNOW writes the channel to /UniqueGlobalKey/channel_id, the raw signal to
+/Raw/Reads/Read_<n>/Signal and, while it still does event detection, the events to
+/Analyses/EventDetection_000/Reads/Read_<n>/Events, each read group carrying its read number, start mux,
+start time and duration (in samples) as attributes. Datasets are only asked for their length, never read.
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+CHANNEL_GROUP = "UniqueGlobalKey/channel_id"
+RAW_READS_GROUP = "Raw/Reads"
+EVENT_READS_GROUP = "Analyses/EventDetection_000/Reads"
+MEMORY_ENTRIES = 100000
+
+# start_time and duration are in seconds. events is None for a file with no event detection, as samples
+# is for a file without the raw signal; anything else missing from the file is None too.
+Fast5Info = namedtuple("Fast5Info", ["channel", "read_number", "mux", "start_time", "duration", "samples",
+                                     "events"])
+
+
+def _value(attributes, name, convert=int):
+    if name not in attributes:
+        return None
+    value = attributes[name]
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "replace")
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _first_read(handle, path):
+    # Single read files hold one Read_<n> group.
+    if path not in handle:
+        return None
+    for name in handle[path]:
+        return handle[path][name]
+    return None
+
+
+def read_fast5_info(path):
+    """Return a Fast5Info for the fast5 file at path. Raises IOError (or OSError) if it cannot be read."""
+    if h5py is None:
+        raise ImportError("Reading fast5 files needs the h5py module (pip install h5py)")
+    with h5py.File(path, 'r') as handle:
+        channel, sampling_rate = None, None
+        if CHANNEL_GROUP in handle:
+            attributes = handle[CHANNEL_GROUP].attrs
+            channel = _value(attributes, "channel_number")
+            sampling_rate = _value(attributes, "sampling_rate", float)
+        raw, events = _first_read(handle, RAW_READS_GROUP), _first_read(handle, EVENT_READS_GROUP)
+        read = raw if raw is not None else events
+        attributes = read.attrs if read is not None else {}
+        start_time, duration = _value(attributes, "start_time"), _value(attributes, "duration")
+        if sampling_rate:
+            start_time = start_time / sampling_rate if start_time is not None else None
+            duration = duration / sampling_rate if duration is not None else None
+        samples = None
+        if raw is not None:
+            samples = raw["Signal"].shape[0] if "Signal" in raw else 0
+        event_count = None
+        if events is not None:
+            event_count = events["Events"].shape[0] if "Events" in events else 0
+        return Fast5Info(channel, _value(attributes, "read_number"), _value(attributes, "start_mux"),
+                         start_time, duration, samples, event_count)
+
+
+def is_short(info, min_events):
+    """True if info is an empty read, or has fewer than min_events events. Unknown lengths are not short."""
+    if info is None:
+        return False
+    if info.events is not None:
+        return info.events < (min_events or 1)
+    return info.samples == 0
+
+
+class Fast5InfoCache(object):
+    """read_fast5_info() for each path, kept until the file's mtime or size changes.
+
+    A file that cannot be read (still being written, or not HDF5) gives None, and is tried again once it
+    changes. The most recently used max_entries paths are kept.
+    """
+
+    def __init__(self, max_entries=MEMORY_ENTRIES):
+        if h5py is None:
+            raise ImportError("Reading fast5 files needs the h5py module (pip install h5py)")
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, status=None):
+        # status is an os.stat result for path, if the caller already has one.
+        try:
+            status = status or os.stat(path)
+        except OSError:
+            return None
+        key = (status.st_mtime, status.st_size)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None and entry[0] == key:
+                self.entries[path] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            info = read_fast5_info(path)
+        except (IOError, OSError, KeyError, ValueError):
+            info = None
+        with self.lock:
+            self.entries[path] = (key, info)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return info
+
+    def summary(self):
+        return "%d files read, %d from memory" % (self.misses, self.hits)
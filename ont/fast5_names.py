@@ -0,0 +1,97 @@
+"""Run name, channel and read number from fast5 file names, for every MinKNOW naming scheme we have seen.
+
+Names that match no scheme (other files, folders, partial transfers) give None rather than an error,
+so a stray file in a reads or dump folder never stops a run.
+"""
+import re
+from collections import namedtuple
+
+ReadName = namedtuple("ReadName", ["run", "channel", "read", "scheme"])
+
+# Tried in order; the first match wins.
+SCHEMES = [
+    # MinKNOW 2016: <user>_<date>_<flowcell>_<minion>_sequencing_run_<run>_<barcode>_ch<channel>_read<read>_strand.fast5
+    ("minknow_2016", re.compile(
+        r"sequencing_run_(?P<run>.+)_(?P<barcode>[0-9A-Za-z]+)_ch(?P<channel>\d+)_read(?P<read>\d+)_[^_]*\.fast5$")),
+    # MinKNOW 1.4 onwards:
+    # <host>_<date>_<flowcell>_<minion>_sequencing_run_<run>_<id>_read_<read>_ch_<channel>_strand.fast5
+    ("minknow_1_4", re.compile(
+        r"sequencing_run_(?P<run>.+)_(?P<barcode>[0-9A-Za-z]+)_read_(?P<read>\d+)_ch_(?P<channel>\d+)_[^_]*\.fast5$")),
+    # Renamed or truncated names that still carry a channel and read number, but no run name.
+    ("channel_read", re.compile(r"(?:^|_)ch(?P<channel>\d+)_read(?P<read>\d+)(?:_[^_]*)?\.fast5$")),
+    ("read_channel", re.compile(r"(?:^|_)read_(?P<read>\d+)_ch_(?P<channel>\d+)(?:_[^_]*)?\.fast5$")),
+]
+
+CACHE_SIZE = 1 << 16
+_cache = {}
+RUN_MARKER = "sequencing_run_"
+
+
+def _split_run(head):
+    # head is everything before the channel and read fields: ..._sequencing_run_<run>_<barcode>
+    start = head.find(RUN_MARKER)
+    if start < 0:
+        return None
+    run, _, barcode = head[start + len(RUN_MARKER):].rpartition("_")
+    if not run or not barcode.isalnum():
+        return None
+    return run
+
+
+def _fast_path(name):
+    # Plain string splitting for the two MinKNOW schemes, which are nearly every name we see.
+    fields = name[:-len(".fast5")].rsplit("_", 5)
+    if len(fields) < 4:
+        return None
+    channel, read = fields[-3], fields[-2]
+    if channel.startswith("ch") and read.startswith("read") and channel[2:].isdigit() and read[4:].isdigit():
+        head = "_".join(fields[:-3])
+        run = _split_run(head)
+        return ReadName(run, int(channel[2:]), int(read[4:]), "minknow_2016" if run else "channel_read")
+    if len(fields) == 6 and fields[1] == "read" and fields[3] == "ch" and fields[2].isdigit() \
+            and fields[4].isdigit():
+        run = _split_run(fields[0])
+        return ReadName(run, int(fields[4]), int(fields[2]), "minknow_1_4" if run else "read_channel")
+    return None
+
+
+def parse(name):
+    """Return a ReadName for a fast5 file name, or None. run is None for schemes without a run name."""
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+    parsed = None
+    # Almost everything that is not a read fails here, before any regular expression is tried.
+    if name.endswith(".fast5") and not name.startswith("."):
+        parsed = _fast_path(name)
+    if parsed is None and name.endswith(".fast5") and not name.startswith("."):
+        # Anything irregular is left to the regular expressions.
+        for scheme, pattern in SCHEMES:
+            match = pattern.search(name)
+            if match:
+                groups = match.groupdict()
+                parsed = ReadName(groups.get("run"), int(groups["channel"]), int(groups["read"]), scheme)
+                break
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[name] = parsed
+    return parsed
+
+
+def parse_read_name(name):
+    """Return (channel, read_number) for a fast5 file name, or None if the name does not match."""
+    parsed = parse(name)
+    if parsed is None:
+        return None
+    return parsed.channel, parsed.read
+
+
+def is_run_read(name, run_name):
+    # A read from this run. Names without a run name fall back to the old substring test.
+    parsed = parse(name)
+    if parsed is None:
+        return False
+    if parsed.run is not None:
+        return parsed.run == run_name
+    return ("sequencing_run_%s" % run_name) in name
@@ -0,0 +1,171 @@
+"""Offline read classification against a k-mer index built from reference fasta files.
+
+The index is a directory holding two numpy arrays: keys.npy, every canonical k-mer of the references in
+ascending order (2 bits a base, so k is at most 31), and taxa.npy, the tax_id of each. Both are loaded
+memory-mapped, so worker processes share one copy through the page cache and start straight away.
+A k-mer found in references of more than one tax_id is left out: there is no taxonomy here to find
+their common ancestor, so it says nothing about which of them a read came from.
+"""
+import json
+import os
+from multiprocessing import Pool, cpu_count
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ont.sequences import read_sequences
+
+K_DEFAULT = 21
+MIN_HITS_DEFAULT = 3  # k-mers a read must share with a tax_id to be given it
+CHUNK_BASES = 10 * 1000 * 1000  # reference sequence handled at once while building
+INFO_FILE = "index.json"
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("The k-mer classifier needs the numpy module (pip install numpy)")
+
+
+def _code_table():
+    table = numpy.full(256, 4, dtype=numpy.uint64)
+    for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+        for base in bases:
+            table[ord(base)] = code
+    return table
+
+
+def canonical_kmers(sequence, k, table=None):
+    """Return the canonical (smaller of forward and reverse complement) k-mers of sequence as uint64.
+
+    Windows containing anything other than A, C, G or T are skipped. sequence is str or bytes.
+    """
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode("ascii", "replace")
+    count = len(sequence) - k + 1
+    if count <= 0:
+        return numpy.empty(0, dtype=numpy.uint64)
+    codes = (table if table is not None else _code_table())[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+    invalid = numpy.concatenate(([0], numpy.cumsum(codes > 3)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    codes = codes & numpy.uint64(3)
+    complement = numpy.uint64(3) - codes
+    forward = numpy.zeros(count, dtype=numpy.uint64)
+    reverse = numpy.zeros(count, dtype=numpy.uint64)
+    two = numpy.uint64(2)
+    for offset in range(k):
+        # Every window at once, one base position at a time.
+        forward = (forward << two) | codes[offset:offset + count]
+        reverse |= complement[offset:offset + count] << numpy.uint64(2 * offset)
+    return numpy.minimum(forward, reverse)[valid]
+
+
+def build_index(references, directory, k=K_DEFAULT, log=None):
+    """Build an index in directory from references, a list of (fasta file, tax_id). Returns the k-mer count."""
+    _require_numpy()
+    if not 0 < k <= 31:
+        raise ValueError("k must be between 1 and 31")
+    table = _code_table()
+    by_taxon = {}
+    for fasta_file, tax_id in references:
+        pieces = by_taxon.setdefault(tax_id, [])
+        for name, sequence in read_sequences(fasta_file, as_bytes=True):
+            for start in range(0, max(len(sequence) - k + 1, 1), CHUNK_BASES):
+                pieces.append(numpy.unique(canonical_kmers(sequence[start:start + CHUNK_BASES + k - 1], k, table)))
+        if log:
+            log("Read %s (tax_id %d)" % (fasta_file, tax_id))
+    keys = []
+    taxa = []
+    for tax_id, pieces in sorted(by_taxon.items()):
+        unique = numpy.unique(numpy.concatenate(pieces)) if pieces else numpy.empty(0, dtype=numpy.uint64)
+        keys.append(unique)
+        taxa.append(numpy.full(len(unique), tax_id, dtype=numpy.int32))
+    keys = numpy.concatenate(keys) if keys else numpy.empty(0, dtype=numpy.uint64)
+    taxa = numpy.concatenate(taxa) if taxa else numpy.empty(0, dtype=numpy.int32)
+    order = numpy.argsort(keys, kind="mergesort")
+    keys, taxa = keys[order], taxa[order]
+    # Each tax_id's k-mers are unique, so a repeated key is shared between tax_ids.
+    shared = numpy.zeros(len(keys), dtype=bool)
+    if len(keys) > 1:
+        repeated = keys[1:] == keys[:-1]
+        shared[1:] |= repeated
+        shared[:-1] |= repeated
+    keys, taxa = keys[~shared], taxa[~shared]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    numpy.save(os.path.join(directory, "keys.npy"), keys)
+    numpy.save(os.path.join(directory, "taxa.npy"), taxa)
+    with open(os.path.join(directory, INFO_FILE), 'w') as info:
+        json.dump({"k": k, "kmers": int(len(keys)), "shared_kmers_dropped": int(shared.sum()),
+                   "taxa": sorted(int(tax_id) for tax_id in by_taxon)}, info)
+    return len(keys)
+
+
+class KmerIndex(object):
+    """A built index, memory-mapped."""
+
+    def __init__(self, directory):
+        _require_numpy()
+        with open(os.path.join(directory, INFO_FILE)) as info:
+            self.info = json.load(info)
+        self.k = self.info["k"]
+        self.keys = numpy.load(os.path.join(directory, "keys.npy"), mmap_mode='r')
+        self.taxa = numpy.load(os.path.join(directory, "taxa.npy"), mmap_mode='r')
+        self.table = _code_table()
+
+    def classify(self, sequence, min_hits=MIN_HITS_DEFAULT):
+        """Return the tax_id sharing the most k-mers with sequence, or 0 if none shares min_hits."""
+        if not len(self.keys):
+            return 0
+        kmers = canonical_kmers(sequence, self.k, self.table)
+        if not len(kmers):
+            return 0
+        positions = numpy.searchsorted(self.keys, kmers)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == kmers
+        if found.sum() < min_hits:
+            return 0
+        tax_ids, counts = numpy.unique(self.taxa[positions[found]], return_counts=True)
+        best = counts.argmax()
+        return int(tax_ids[best]) if counts[best] >= min_hits else 0
+
+
+# Each worker process opens the index once.
+_worker_index = None
+_worker_min_hits = MIN_HITS_DEFAULT
+
+
+def _start_worker(directory, min_hits):
+    global _worker_index, _worker_min_hits
+    _worker_index = KmerIndex(directory)
+    _worker_min_hits = min_hits
+
+
+def _classify_record(record):
+    return record[0], _worker_index.classify(record[1], _worker_min_hits)
+
+
+class KmerClassifier(object):
+    """Classify reads against an index across a pool of processes. Used as OneCodexClient is."""
+
+    def __init__(self, directory, processes=None, min_hits=MIN_HITS_DEFAULT, chunk_size=64):
+        index = KmerIndex(directory)  # fails here, not in the workers, if the index is missing or numpy is
+        self.k = index.k
+        self.kmers = len(index.keys)
+        self.chunk_size = chunk_size
+        self.classified = 0
+        self.pool = Pool(processes or cpu_count(), initializer=_start_worker, initargs=(directory, min_hits))
+
+    def classify_all(self, records):
+        # Yield (name, tax_id) for (name, sequence) records, in the order given.
+        for name, tax_id in self.pool.imap(_classify_record, records, self.chunk_size):
+            self.classified += 1
+            yield name, tax_id
+
+    def summary(self):
+        return "Classified %d reads offline against %d k-mers (k=%d)" % (self.classified, self.kmers, self.k)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
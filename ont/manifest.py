@@ -0,0 +1,64 @@
+"""Append-only record of the reads already transferred to the server."""
+import os
+import threading
+
+NO_CHECKSUM = "-"
+
+
+class TransferManifest(object):
+    """Tab-separated ledger of name, size, mtime and checksum, one line per transferred read.
+
+    The whole file is read into memory on start up, so checking whether a read has already been
+    transferred is a set lookup rather than a stat on the server. Lines are only ever appended;
+    a line cut short by a crash is ignored when the manifest is next loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.existed = os.path.isfile(path)
+        if self.existed:
+            self._load()
+        self.handle = open(path, 'a')
+
+    def _load(self):
+        with open(self.path) as manifest:
+            for line in manifest:
+                if not line.endswith("\n"):
+                    break  # partially written last line
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 4:
+                    continue
+                name, size, mtime, checksum = fields
+                self.entries[name] = (int(size), float(mtime), checksum)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def record(self, name, size, mtime, checksum=None):
+        checksum = checksum or NO_CHECKSUM
+        with self.lock:
+            self.entries[name] = (size, mtime, checksum)
+            self.handle.write("%s\t%d\t%.6f\t%s\n" % (name, size, mtime, checksum))
+            self.handle.flush()
+
+    def seed(self, entries):
+        # Record files already in the destination from before there was a manifest, given as
+        # (name, size, mtime). Checksums are unknown for these. Only needed once, so only one listing is made.
+        seeded = 0
+        for name, size, mtime in entries:
+            if name not in self.entries:
+                self.record(name, size, mtime)
+                seeded += 1
+        return seeded
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
@@ -0,0 +1,312 @@
+"""Counters, gauges and histograms for watching a run while it goes, served as Prometheus text or written as JSON.
+
+Metrics live in a Registry, normally the shared REGISTRY that the ont modules record into. A script shows
+them with a MetricsServer (GET /metrics on a local port, for Prometheus or a browser) and/or a MetricsWriter
+(a JSON file replaced every few seconds, with the rate of each counter since the last one).
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# Seconds, from a small file copy up to a long basecalling batch.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter(object):
+    """A total that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """A value that goes up and down: set() directly, or read from function() whenever it is shown."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, function=None):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+
+class Histogram(object):
+    """Counts of observations (normally seconds) in cumulative buckets, with their count and sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        # with histogram.time(): ... observes the seconds the block took.
+        return _Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(('%s_bucket{le="%s"}' % (self.name, _format(bound)), cumulative))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, count))
+        samples.append((self.name + "_sum", total))
+        samples.append((self.name + "_count", count))
+        return samples
+
+    def quantile(self, fraction):
+        # The upper bound of the bucket the quantile falls in, which is as close as buckets can say.
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = fraction * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        with self.lock:
+            count, total = self.count, self.sum
+        snapshot = {"count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else None}
+        for fraction in QUANTILES:
+            snapshot["p%d" % (fraction * 100)] = self.quantile(fraction)
+        return snapshot
+
+
+def _format(value):
+    if value != value:
+        return "NaN"
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """Named metrics. Asking for a metric that already exists returns it, so modules can share one."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help_text):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text, function=None):
+        gauge = self._get(Gauge, name, help_text)
+        if function is not None:
+            gauge.function = function  # the latest owner wins, for a pool made again
+        return gauge
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets)
+
+    def prometheus(self):
+        # The Prometheus text exposition format, version 0.0.4.
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help_text))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, _format(value)))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """Serve registry at http://host:port/metrics from a background thread. Only this computer by default."""
+
+    def __init__(self, registry=REGISTRY, port=9100, host="127.0.0.1"):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = registry.prometheus().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = _ThreadingServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class MetricsWriter(object):
+    """Replace path, by rename, with a JSON snapshot of registry every interval seconds, and on close().
+
+    Alongside the metrics are the rates: how much each counter went up per second since the last snapshot.
+    """
+
+    def __init__(self, registry=REGISTRY, path="metrics.json", interval=10):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.closed = False
+        self.last = None
+        self.thread = threading.Thread(target=self._write_every_interval, name="metrics-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        now = time.time()
+        metrics = self.registry.snapshot()
+        counters = dict((name, value) for name, value in metrics.items()
+                        if isinstance(self.registry.metrics.get(name), Counter))
+        rates = {}
+        if self.last is not None and now > self.last[0]:
+            for name, value in counters.items():
+                rates[name] = round((value - self.last[1].get(name, 0)) / (now - self.last[0]), 3)
+        self.last = (now, counters)
+        temporary = self.path + ".tmp"
+        with open(temporary, 'w') as handle:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)), "metrics": metrics,
+                       "rates_per_second": rates}, handle, indent=1, sort_keys=True)
+            handle.write("\n")
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temporary, self.path)
+
+    def _write_every_interval(self):
+        with self.condition:
+            while not self.closed:
+                self.condition.wait(self.interval)
+                if not self.closed:
+                    self.write()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.write()
+
+
+class MetricsExporters(object):
+    """The exporters a script was asked for: a MetricsServer on port and/or a MetricsWriter to path.
+
+    Raises IOError if the port cannot be served. path is made absolute, as some scripts change directory.
+    """
+
+    def __init__(self, registry=REGISTRY, port=None, path=None, interval=10):
+        self.exporters = []
+        if port:
+            try:
+                self.exporters.append(MetricsServer(registry, port=port))
+            except (IOError, OSError) as error:
+                raise IOError("cannot serve metrics on port %d: %s" % (port, error))
+        if path:
+            self.exporters.append(MetricsWriter(registry, os.path.abspath(path), interval=interval))
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
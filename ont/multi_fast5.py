@@ -0,0 +1,175 @@
+"""Pack single-read fast5 files into multi-read HDF5 files, and get single reads back out of them.
+
+A pack <prefix>_pack_<time>_<pid>_<n>.fast5 holds one group per read, read_<read id>, which is a copy of
+the whole single-read file (its groups, datasets and root attributes), so a read extracted again is the
+file that went in. A sidecar <pack>.index lists, for every read, its read id, group, original file name
+and mtime, so the reads in a directory of packs can be listed without opening any HDF5. The index is put
+in place before the pack, so a pack that is visible always has a complete index.
+"""
+import itertools
+import os
+import time
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from ont.checksum import partial_name
+
+PACK_MARKER = "_pack_"
+PACK_SUFFIX = ".fast5"
+INDEX_SUFFIX = ".index"
+GROUP_PREFIX = "read_"
+RAW_READS_GROUP = "Raw/Reads"
+
+_pack_counter = itertools.count(1)
+
+
+def _require_h5py():
+    if h5py is None:
+        raise ImportError("Packing fast5 files needs the h5py module (pip install h5py)")
+
+
+def is_pack(name):
+    return PACK_MARKER in name and name.endswith(PACK_SUFFIX) and not name.startswith(".")
+
+
+def pack_name(prefix):
+    return "%s%s%s_%d_%06d%s" % (prefix, PACK_MARKER, time.strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                 next(_pack_counter), PACK_SUFFIX)
+
+
+def read_id(handle, filename):
+    # The read id MinKNOW gave the read, or the file name if it gave none.
+    if RAW_READS_GROUP in handle:
+        for name in handle[RAW_READS_GROUP]:
+            value = handle[RAW_READS_GROUP][name].attrs.get("read_id")
+            if value is not None:
+                return value.decode("ascii") if isinstance(value, bytes) else str(value)
+    return filename[:-len(PACK_SUFFIX)] if filename.endswith(PACK_SUFFIX) else filename
+
+
+def _replace(temporary, path):
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
+
+
+def _sync(path):
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def write_pack(paths, directory, prefix):
+    """Copy the single-read fast5 files in paths into a new pack in directory, synced to disk.
+
+    Returns (pack path, entries), entries being (read id, group, file name, mtime) for each read packed.
+    Files that cannot be read as HDF5 are left out, and if none can be read no pack is written and the
+    path is None. The original files are left for the caller to remove.
+    """
+    _require_h5py()
+    name = pack_name(prefix)
+    path = os.path.join(directory, name)
+    temporary = os.path.join(directory, partial_name(name))
+    entries = []
+    with h5py.File(temporary, 'w') as pack:
+        for source in paths:
+            filename = os.path.basename(source)
+            try:
+                mtime = int(os.path.getmtime(source))
+                single = h5py.File(source, 'r')
+            except (IOError, OSError):
+                continue
+            with single:
+                group = GROUP_PREFIX + read_id(single, filename)
+                if group in pack:
+                    group = GROUP_PREFIX + filename  # the same read id twice: keep both
+                pack.copy(single["/"], group)
+            pack[group].attrs["filename"] = filename
+            entries.append((group[len(GROUP_PREFIX):], group, filename, mtime))
+    if not entries:
+        os.remove(temporary)
+        return None, entries
+    _sync(temporary)
+    index = os.path.join(directory, partial_name(name + INDEX_SUFFIX))
+    with open(index, 'w') as handle:
+        handle.write(format_index(entries))
+        handle.flush()
+        os.fsync(handle.fileno())
+    _replace(index, path + INDEX_SUFFIX)
+    _replace(temporary, path)
+    return path, entries
+
+
+def format_index(entries):
+    return "".join("%s\t%s\t%s\t%d\n" % entry for entry in entries)
+
+
+def read_index(pack_path):
+    entries = []
+    with open(pack_path + INDEX_SUFFIX) as index:
+        for line in index:
+            if not line.endswith("\n"):
+                break
+            identifier, group, filename, mtime = line.rstrip("\n").split("\t")
+            entries.append((identifier, group, filename, int(mtime)))
+    return entries
+
+
+def packed_reads(directory):
+    """Return {file name: pack path} for every read packed in directory, from the indexes alone."""
+    reads = {}
+    for name in os.listdir(directory):
+        if is_pack(name) and os.path.isfile(os.path.join(directory, name + INDEX_SUFFIX)):
+            pack_path = os.path.join(directory, name)
+            for identifier, group, filename, mtime in read_index(pack_path):
+                reads[filename] = pack_path
+    return reads
+
+
+def _write_single(pack, group, filename, mtime, destination_directory):
+    destination = os.path.join(destination_directory, filename)
+    temporary = os.path.join(destination_directory, partial_name(filename))
+    with h5py.File(temporary, 'w') as single:
+        source = pack[group]
+        for key in source:
+            source.copy(source[key], single, name=key)
+        for key, value in source.attrs.items():
+            if key != "filename":
+                single.attrs[key] = value
+    os.utime(temporary, (mtime, mtime))
+    _replace(temporary, destination)
+    return destination
+
+
+def extract_read(pack_path, read, destination_directory):
+    """Write the read with read id (or original file name) read back out as a single-read file.
+
+    Returns the path of the file written. Raises KeyError if the read is not in the pack.
+    """
+    _require_h5py()
+    for identifier, group, filename, mtime in read_index(pack_path):
+        if read in (identifier, filename):
+            with h5py.File(pack_path, 'r') as pack:
+                return _write_single(pack, group, filename, mtime, destination_directory)
+    raise KeyError("%s is not in pack %s" % (read, pack_path))
+
+
+def unpack(pack_path, destination_directory, remove=False):
+    """Write every read in a pack back out as single-read files, each appearing under its own name only
+    once complete. The pack and its index are removed afterwards if remove is True.
+    Returns the file names written."""
+    _require_h5py()
+    names = []
+    with h5py.File(pack_path, 'r') as pack:
+        for identifier, group, filename, mtime in read_index(pack_path):
+            _write_single(pack, group, filename, mtime, destination_directory)
+            names.append(filename)
+    if remove:
+        os.remove(pack_path)
+        os.remove(pack_path + INDEX_SUFFIX)
+    return names
@@ -0,0 +1,149 @@
+"""Sending sequences to the One Codex search API over a pool of kept-alive connections."""
+import json
+import random
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from ont.metrics import REGISTRY
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+SEARCH_URL = "https://app.onecodex.com/api/v0/search"
+GOOD_STATUS = 200
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_BACKOFF = 60  # seconds
+QUEUED_PER_THREAD = 4  # records taken from the input ahead of the results, for each thread
+
+REQUEST_SECONDS = REGISTRY.histogram("onecodex_request_seconds", "Seconds taken by each One Codex search request")
+REQUESTS = REGISTRY.counter("onecodex_requests_total", "One Codex search requests sent")
+RETRIES = REGISTRY.counter("onecodex_retries_total", "One Codex search requests retried")
+FAILURES = REGISTRY.counter("onecodex_failures_total", "Sequences skipped after every retry failed")
+CACHE_HITS = REGISTRY.counter("onecodex_cache_hits_total", "Sequences found in the result cache")
+
+
+class OneCodexAuthError(Exception):
+    pass
+
+
+class OneCodexClient(object):
+    """Classify sequences with up to concurrency requests in flight at once.
+
+    The search API takes one sequence per request, so throughput comes from keeping connections open
+    and several requests in flight rather than from batching. A 429 (rate limited) or 5xx response is
+    retried after the Retry-After the server gives, or an exponential backoff, and holds back every
+    thread, not only the one that got it. An API key that is missing or wrong raises OneCodexAuthError.
+    cache, if given, is a ResultCache (ont/result_cache.py) checked before each search.
+    """
+
+    def __init__(self, api_key, url=SEARCH_URL, concurrency=8, timeout=20, retries=5, backoff=1.0, cache=None):
+        if requests is None:
+            raise ImportError("One Codex searches need the requests module (pip install requests)")
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth(api_key, "")
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPool(concurrency)
+        self.window = concurrency * QUEUED_PER_THREAD
+        self.lock = threading.Lock()
+        self.resume_at = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _hold_back(self, seconds):
+        # Every thread waits until resume_at before its next request.
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+
+    def _wait(self):
+        while True:
+            with self.lock:
+                remaining = self.resume_at - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        try:
+            return min(float(retry_after), MAX_BACKOFF)
+        except (TypeError, ValueError):
+            # Jittered, so that threads held back together do not all retry at the same moment.
+            return min(self.backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+
+    def classify(self, sequence):
+        """Return the tax_id One Codex gives sequence (0 if none), or None if it could not be searched."""
+        if self.cache is not None:
+            tax_id = self.cache.get(sequence)
+            if tax_id is not None:
+                CACHE_HITS.inc()
+                return tax_id
+        tax_id = self._search(sequence)
+        if tax_id is not None and self.cache is not None:
+            self.cache.put(sequence, tax_id)
+        return tax_id
+
+    def _search(self, sequence):
+        for attempt in range(self.retries + 1):
+            self._wait()
+            response = None
+            try:
+                with REQUEST_SECONDS.time():
+                    response = self.session.post(self.url, {'sequence': sequence}, timeout=self.timeout)
+                REQUESTS.inc()
+                with self.lock:
+                    self.sent += 1
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            else:
+                if response.status_code == GOOD_STATUS:
+                    return json.loads(response.text)['tax_id']
+                if response.status_code == 400:
+                    raise OneCodexAuthError('The One Codex API key was not provided')
+                if response.status_code == 401:
+                    raise OneCodexAuthError('The One Codex API key provided was invalid')
+                if response.status_code not in RETRY_STATUSES:
+                    break
+            if attempt < self.retries:
+                RETRIES.inc()
+                with self.lock:
+                    self.retried += 1
+                self._hold_back(self._delay(attempt, response))
+        FAILURES.inc()
+        with self.lock:
+            self.failed += 1
+        return None
+
+    def classify_all(self, records):
+        # Yield (name, tax_id) for (name, sequence) records, in the order given. Only a window of records is
+        # taken from records ahead of the results yielded, so a large or growing input is read as the
+        # results are used rather than all at once, as ThreadPool.imap would.
+        pending = deque()
+        for name, sequence in records:
+            pending.append((name, self.pool.apply_async(self.classify, (sequence,))))
+            if len(pending) >= self.window:
+                name, result = pending.popleft()
+                yield name, result.get()
+        while pending:
+            name, result = pending.popleft()
+            yield name, result.get()
+
+    def summary(self):
+        return "Sent %d requests, %d of them retries" % (self.sent, self.retried)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
@@ -0,0 +1,116 @@
+"""The reads seen on each channel, one bit per read number, saved between runs."""
+import array
+import os
+
+from ont.fast5_names import parse_read_name
+
+CHANNELS = 512
+_TYPECODE = "i"
+
+
+class ChannelIndex(object):
+    """Which read numbers have been seen on each channel.
+
+    Each channel has a bitmap indexed by read number, so a read that arrives after a later read from the
+    same channel (as happens once reads are transferred in parallel) is still new. Channel numbers index
+    straight into a list of bitmaps, so there is no string handling or dictionary copying per file.
+
+    The file an index is saved to is a log of (channel, read number) pairs. The first save() to a path
+    writes the whole index and later ones append what was added since, so saving after every batch
+    costs only the reads in that batch.
+    """
+
+    def __init__(self, channels=CHANNELS):
+        self.bitmaps = [bytearray() for _ in range(channels + 1)]
+        self.unsaved = array.array(_TYPECODE)
+        self.saved_path = None
+
+    def is_new(self, channel, read_number):
+        if channel >= len(self.bitmaps):
+            return True
+        bitmap = self.bitmaps[channel]
+        byte = read_number >> 3
+        return byte >= len(bitmap) or not bitmap[byte] & (1 << (read_number & 7))
+
+    def update(self, channel, read_number):
+        if channel >= len(self.bitmaps):
+            # Flowcells with more channels than expected still work.
+            self.bitmaps.extend(bytearray() for _ in range(channel + 1 - len(self.bitmaps)))
+        if read_number < 0 or not self.is_new(channel, read_number):
+            return
+        bitmap = self.bitmaps[channel]
+        byte = read_number >> 3
+        if byte >= len(bitmap):
+            bitmap.extend(bytearray(byte + 1 - len(bitmap)))
+        bitmap[byte] |= 1 << (read_number & 7)
+        self.unsaved.extend((channel, read_number))
+
+    def new_reads(self, names):
+        """Return the names in names that have not been seen, and mark them as seen.
+
+        A name given twice is only returned the first time. Names that do not parse are ignored.
+        """
+        new = []
+        for name in names:
+            parsed = parse_read_name(name)
+            if parsed and self.is_new(*parsed):
+                self.update(*parsed)
+                new.append(name)
+        return new
+
+    def add_existing(self, names):
+        for name in names:
+            parsed = parse_read_name(name)
+            if parsed:
+                self.update(*parsed)
+
+    def copy(self):
+        index = ChannelIndex(channels=0)
+        index.bitmaps = [bytearray(bitmap) for bitmap in self.bitmaps]
+        return index
+
+    def _pairs(self):
+        pairs = array.array(_TYPECODE)
+        for channel, bitmap in enumerate(self.bitmaps):
+            for byte, bits in enumerate(bitmap):
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        pairs.extend((channel, byte * 8 + bit))
+        return pairs
+
+    def save(self, path):
+        if self.saved_path == path and os.path.isfile(path):
+            # Only what was added since the last save, synced before the caller carries on.
+            with open(path, 'ab') as handle:
+                self.unsaved.tofile(handle)
+                handle.flush()
+                os.fsync(handle.fileno())
+        else:
+            # Written to a temporary file and renamed, so a crash never leaves a half written index.
+            temporary = path + ".tmp"
+            with open(temporary, 'wb') as handle:
+                self._pairs().tofile(handle)
+                handle.flush()
+                os.fsync(handle.fileno())
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)  # os.rename does not overwrite on windows
+            os.rename(temporary, path)
+            self.saved_path = path
+        self.unsaved = array.array(_TYPECODE)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        pairs = array.array(_TYPECODE)
+        size = os.path.getsize(path)
+        count = size // (2 * pairs.itemsize) * 2
+        with open(path, 'rb') as handle:
+            pairs.fromfile(handle, count)
+        for position in range(0, count, 2):
+            index.update(pairs[position], pairs[position + 1])
+        index.unsaved = array.array(_TYPECODE)
+        # A pair cut short by a crash while appending is left out, and the next save writes the file afresh
+        # rather than appending after it.
+        if size == count * pairs.itemsize:
+            index.saved_path = path
+        return index
@@ -0,0 +1,86 @@
+"""tax_id already found for a sequence, so that repeated reads are not searched again."""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+MEMORY_ENTRIES = 100000
+COMMIT_EVERY = 500  # new results between writes to disk
+
+
+def sequence_key(sequence):
+    # Reads are the same regardless of case.
+    return hashlib.sha1(sequence.upper().encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """Sequence hash -> tax_id, least recently used entries in memory over an sqlite file shared between runs.
+
+    Only identical sequences share a result. Results are kept apart for each source, the API URL they came
+    from, so runs against a mock server or another --api_url do not answer for each other. path None keeps
+    the cache in memory only. Safe to use from several threads.
+    """
+
+    def __init__(self, path=None, memory_entries=MEMORY_ENTRIES, source=""):
+        self.source = source
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.unsaved = 0
+        self.database = None
+        if path:
+            self.database = sqlite3.connect(path, check_same_thread=False)
+            # The results table of older versions did not record the source, so it is left unread.
+            self.database.execute("CREATE TABLE IF NOT EXISTS source_results (source TEXT NOT NULL, "
+                                  "sequence_hash TEXT NOT NULL, tax_id INTEGER NOT NULL, "
+                                  "PRIMARY KEY (source, sequence_hash))")
+            self.database.commit()
+
+    def _remember(self, key, tax_id):
+        # Called with the lock held.
+        self.memory.pop(key, None)
+        self.memory[key] = tax_id
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, sequence):
+        """Return the cached tax_id for sequence, or None."""
+        key = sequence_key(sequence)
+        with self.lock:
+            tax_id = self.memory.get(key)
+            if tax_id is None and self.database is not None:
+                row = self.database.execute("SELECT tax_id FROM source_results WHERE source = ? AND sequence_hash = ?",
+                                            (self.source, key)).fetchone()
+                tax_id = row[0] if row else None
+            if tax_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, tax_id)
+            return tax_id
+
+    def put(self, sequence, tax_id):
+        key = sequence_key(sequence)
+        with self.lock:
+            self._remember(key, tax_id)
+            if self.database is not None:
+                self.database.execute("INSERT OR REPLACE INTO source_results VALUES (?, ?, ?)",
+                                      (self.source, key, tax_id))
+                self.unsaved += 1
+                if self.unsaved >= COMMIT_EVERY:
+                    self.database.commit()
+                    self.unsaved = 0
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return "%d hits, %d misses (%.1f%% hit rate)" % (self.hits, self.misses,
+                                                          100.0 * self.hits / lookups if lookups else 0)
+
+    def close(self):
+        if self.database is not None:
+            with self.lock:
+                self.database.commit()
+                self.database.close()
+                self.database = None
@@ -0,0 +1,122 @@
+"""Oldest-first backlog of files in a directory, stat-ing each file once rather than on every scan."""
+import heapq
+import os
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+RETRY_DELAY = 5  # seconds before a file that failed to move is tried again, doubling with each failure
+RETRY_DELAY_MAX = 300
+
+
+class FileBacklog(object):
+    """Heap of (mtime, name, size) for files waiting in a directory.
+
+    scan() lists the directory with scandir, so on Windows the stat comes free with the listing and
+    elsewhere only files not seen before are stat-ed. add() takes names from a DirectoryWatcher.
+    A name stays known until forget() is called, so it is never pushed twice while waiting. A file that
+    failed to move is given to retry(), and requeue() puts it back in the backlog once its delay has passed.
+    """
+
+    def __init__(self, directory, match=None):
+        self.directory = directory
+        self.match = match or (lambda name: True)
+        self.lock = threading.Lock()
+        self.heap = []
+        self.known = set()
+        self.retries = []  # heap of (time due, name)
+        self.failures = {}
+
+    def _push(self, name, status):
+        heapq.heappush(self.heap, (status.st_mtime, name, status.st_size))
+        self.known.add(name)
+
+    def scan(self):
+        # Returns the set of matching names, for use as a DirectoryWatcher listing.
+        names = set()
+        if scandir is None:
+            names = set(name for name in os.listdir(self.directory) if self.match(name))
+            self.add(names)
+            return names
+        with self.lock:
+            for entry in scandir(self.directory):
+                name = entry.name
+                if not self.match(name):
+                    continue
+                names.add(name)
+                if name in self.known:
+                    continue
+                try:
+                    self._push(name, entry.stat())
+                except OSError:
+                    names.discard(name)  # moved or deleted since the listing
+            # Names no longer in the directory will not come back.
+            self.known.intersection_update(names.union(name for _, name, _ in self.heap))
+        return names
+
+    def add(self, names):
+        # Stat and queue names not already known. Returns the number added.
+        added = 0
+        with self.lock:
+            for name in names:
+                if name in self.known:
+                    continue
+                try:
+                    status = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                self._push(name, status)
+                added += 1
+        return added
+
+    def drain(self):
+        # Yield (mtime, name, size), oldest first, until the backlog is empty.
+        while True:
+            with self.lock:
+                if not self.heap:
+                    return
+                item = heapq.heappop(self.heap)
+            yield item
+
+    def forget(self, name):
+        # Called once a file has left the directory, so it may be queued again if it reappears.
+        with self.lock:
+            self.known.discard(name)
+            self.failures.pop(name, None)
+
+    def retry(self, name):
+        # Called when a file failed to move. It stays known, so a scan does not queue it again before it is due.
+        with self.lock:
+            failures = self.failures.get(name, 0) + 1
+            self.failures[name] = failures
+            self.known.add(name)
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), RETRY_DELAY_MAX)
+            heapq.heappush(self.retries, (time.time() + delay, name))
+
+    def requeue(self):
+        # Put files whose retry is due back in the backlog. Returns the number put back.
+        requeued = 0
+        now = time.time()
+        with self.lock:
+            while self.retries and self.retries[0][0] <= now:
+                _, name = heapq.heappop(self.retries)
+                try:
+                    status = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    # Gone from the directory since it failed.
+                    self.known.discard(name)
+                    self.failures.pop(name, None)
+                    continue
+                self._push(name, status)
+                requeued += 1
+        return requeued
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,299 @@
+"""Reading FASTA and FASTQ files, and writing basecalled reads into rolling files that can be read as they grow.
+
+Every output file has two companions:
+
+    <file>.fai   a samtools faidx style index, one line per record: name, length, offset, line bases,
+                 line width and, for FASTQ, the offset of the qualities. A line is only added once its
+                 record is completely written, so every line in the index points at a whole record.
+    <file>.done  created (by rename) once the file is closed for good. Until then more records may follow.
+"""
+import gzip
+import io
+import os
+import threading
+import time
+
+INDEX_SUFFIX = ".fai"
+DONE_SUFFIX = ".done"
+BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class RecordParser(object):
+    """File-like object that turns FASTA or FASTQ text written to it into on_record(name, sequence, quality).
+
+    quality is None for FASTA. A FASTA record is only complete once the next header arrives, so close()
+    must be called at the end to pass on the last one.
+    """
+
+    def __init__(self, on_record):
+        self.on_record = on_record
+        self.buffer = ""
+        self.lines = []
+        self.records = 0
+
+    def write(self, text):
+        lines, newline, self.buffer = (self.buffer + text).rpartition("\n")
+        if newline:
+            for line in lines.split("\n"):
+                self._line(line.rstrip("\r"))
+
+    def flush(self):
+        pass
+
+    def _line(self, line):
+        if not line:
+            return
+        if self.lines and self.lines[0].startswith("@"):
+            # FASTQ records are four lines, and a quality line may itself start with '@'.
+            self.lines.append(line)
+            if len(self.lines) == 4:
+                self._emit(self.lines[1], self.lines[3])
+                self.lines = []
+        elif line.startswith(">") or line.startswith("@"):
+            if self.lines:
+                self._emit("".join(self.lines[1:]), None)
+            self.lines = [line]
+        elif self.lines:
+            self.lines.append(line)
+
+    def _emit(self, sequence, quality):
+        name = self.lines[0][1:].split()[0] if self.lines[0][1:].strip() else ""
+        self.records += 1
+        self.on_record(name, sequence, quality)
+
+    def close(self):
+        if self.buffer:
+            self._line(self.buffer.rstrip("\r"))
+            self.buffer = ""
+        if self.lines and self.lines[0].startswith(">"):
+            self._emit("".join(self.lines[1:]), None)
+        self.lines = []
+
+
+class RollingWriter(object):
+    """Append records to <prefix>_<time>.fasta (or .fastq), starting a new file every max_bytes or max_age.
+
+    Safe to call from several threads. A file is finished, and its .done written, when it reaches
+    max_bytes, once it has been open for max_age seconds, or on close().
+    on_written, if given, is called as on_written(path, number, name, sequence) once each record is in
+    the file and its index, number counting from 0 in each file. It is called in the order records are
+    written, with the writer locked.
+    """
+
+    def __init__(self, directory, prefix, fastq=False, max_bytes=16 * 1024 * 1024, max_age=60, on_written=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.extension = "fastq" if fastq else "fasta"
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.on_written = on_written
+        self.condition = threading.Condition()
+        self.path = None
+        self.handle = None
+        self.index = None
+        self.opened = None
+        self.records = 0
+        self.finished = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._roll_when_old, name="rolling-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _open(self):
+        # Called with the condition held. Named by the time, like the old per batch files.
+        stamp = int(time.time())
+        while os.path.exists(os.path.join(self.directory, "%s_%d.%s" % (self.prefix, stamp, self.extension))):
+            stamp += 1
+        self.path = os.path.join(self.directory, "%s_%d.%s" % (self.prefix, stamp, self.extension))
+        self.index = open(self.path + INDEX_SUFFIX, 'w')
+        # Created and closed once before being opened for writing, so that anything watching the directory
+        # for closed files (see ont/watcher.py) hears of the new file straight away and can start tailing it.
+        open(self.path, 'w').close()
+        self.handle = open(self.path, 'a')
+        self.opened = time.time()
+        self.records = 0
+        self.condition.notify()
+
+    def write(self, name, sequence, quality=None):
+        with self.condition:
+            if self.handle is None:
+                self._open()
+            offset = self.handle.tell()
+            header = "%s%s\n" % ("@" if quality is not None else ">", name)
+            sequence_offset = offset + len(header)
+            if quality is None:
+                self.handle.write("%s%s\n" % (header, sequence))
+                entry = "%s\t%d\t%d\t%d\t%d\n" % (name, len(sequence), sequence_offset, len(sequence),
+                                                 len(sequence) + 1)
+            else:
+                self.handle.write("%s%s\n+\n%s\n" % (header, sequence, quality))
+                entry = "%s\t%d\t%d\t%d\t%d\t%d\n" % (name, len(sequence), sequence_offset, len(sequence),
+                                                     len(sequence) + 1, sequence_offset + len(sequence) + 3)
+            # The record reaches the file before its index line does.
+            self.handle.flush()
+            self.index.write(entry)
+            self.index.flush()
+            self.records += 1
+            if self.on_written:
+                self.on_written(self.path, self.records - 1, name, sequence)
+            if self.handle.tell() >= self.max_bytes:
+                self._finish()
+
+    def _finish(self):
+        # Called with the condition held.
+        if self.handle is None:
+            return
+        for handle in (self.handle, self.index):
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+        with open(self.path + DONE_SUFFIX + ".tmp", 'w') as done:
+            done.write("%d\n" % self.records)
+        os.rename(self.path + DONE_SUFFIX + ".tmp", self.path + DONE_SUFFIX)
+        self.finished.append(self.path)
+        self.handle = self.index = self.path = self.opened = None
+
+    def _roll_when_old(self):
+        with self.condition:
+            while not self.closed:
+                if self.opened is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.opened + self.max_age - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self._finish()
+
+    def close(self):
+        with self.condition:
+            self._finish()
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+
+def is_done(path):
+    return os.path.isfile(path + DONE_SUFFIX)
+
+
+def read_index(path, start=0):
+    """Return the index entries of path from entry number start, as (name, length, offset, quality_offset).
+
+    quality_offset is None for FASTA. A line still being written is left out.
+    """
+    entries = []
+    if not os.path.isfile(path + INDEX_SUFFIX):
+        return entries
+    with open(path + INDEX_SUFFIX) as index:
+        for number, line in enumerate(index):
+            if not line.endswith("\n"):
+                break
+            if number < start:
+                continue
+            fields = line.rstrip("\n").split("\t")
+            quality_offset = int(fields[5]) if len(fields) > 5 else None
+            entries.append((fields[0], int(fields[1]), int(fields[2]), quality_offset))
+    return entries
+
+
+def read_records(path, entries):
+    # Yield (name, sequence, quality) for index entries of path, seeking straight to each record.
+    with open(path) as handle:
+        for name, length, offset, quality_offset in entries:
+            handle.seek(offset)
+            sequence = handle.read(length)
+            quality = None
+            if quality_offset is not None:
+                handle.seek(quality_offset)
+                quality = handle.read(length)
+            yield name, sequence, quality
+
+
+def _open_binary(path):
+    # gzip files are recognised by their first bytes, whatever they are called.
+    with open(path, 'rb') as handle:
+        compressed = handle.read(2) == GZIP_MAGIC
+    if compressed:
+        return io.BufferedReader(gzip.open(path, 'rb'), BLOCK_SIZE)
+    return io.open(path, 'rb', buffering=BLOCK_SIZE)
+
+
+def _fasta_records(handle):
+    # Split whole blocks on the start of each header rather than going line by line.
+    remainder = b""
+    first = True
+    while True:
+        block = handle.read(BLOCK_SIZE)
+        if not block:
+            break
+        records = (remainder + block).split(b"\n>")
+        remainder = records.pop()
+        for record in records:
+            if first:
+                first = False
+                record = record.lstrip()[1:]
+            yield record
+    if remainder.strip():
+        yield remainder.lstrip()[1:] if first else remainder
+
+
+def _fastq_records(handle):
+    while True:
+        header = handle.readline()
+        if not header:
+            return
+        if not header.strip():
+            continue
+        sequence = handle.readline()
+        handle.readline()
+        quality = handle.readline()
+        yield header[1:], sequence.rstrip(b"\r\n"), quality.rstrip(b"\r\n")
+
+
+def read_sequences(path, as_bytes=False):
+    """Yield (id, sequence) for each record of a FASTA or FASTQ file, which may be gzipped.
+
+    id is the first word of the header, as Biopython's record.id. Values are str, or bytes if as_bytes,
+    which saves decoding when they are only written out again or hashed.
+    """
+    with _open_binary(path) as handle:
+        first = handle.peek(1)[:1].lstrip() if hasattr(handle, "peek") else b""
+        if first == b"@":
+            records = ((header, sequence) for header, sequence, quality in _fastq_records(handle))
+        else:
+            records = _fasta_records(handle)
+            records = ((header, sequence.replace(b"\n", b"").replace(b"\r", b""))
+                       for header, _, sequence in (record.partition(b"\n") for record in records))
+        for header, sequence in records:
+            fields = header.split(None, 1)
+            name = fields[0] if fields else b""
+            if as_bytes or str is bytes:  # python 2 str is already bytes
+                yield name, sequence
+            else:
+                yield name.decode("utf-8"), sequence.decode("ascii")
+
+
+def read_numbered(path, numbers):
+    """Yield (number, id, sequence) for the records of path numbered in numbers, counting from 0.
+
+    A file with an index is read by seeking straight to each record, and any other is read through as far
+    as the last number wanted.
+    """
+    numbers = sorted(set(numbers))
+    if not numbers:
+        return
+    if os.path.isfile(path + INDEX_SUFFIX):
+        entries = read_index(path)
+        numbers = [number for number in numbers if number < len(entries)]
+        records = read_records(path, [entries[number] for number in numbers])
+        for number, (name, sequence, quality) in zip(numbers, records):
+            yield number, name, sequence
+        return
+    wanted = set(numbers)
+    for number, (name, sequence) in enumerate(read_sequences(path)):
+        if number in wanted:
+            yield number, name, sequence
+        if number >= numbers[-1]:
+            return
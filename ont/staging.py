@@ -0,0 +1,119 @@
+"""Put files into a batch directory without copying their contents where the filesystem allows it."""
+import errno
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from <linux/fs.h>
+METHODS = ("reflink", "hardlink", "copy")
+BATCH_PREFIX = ".nanonet_batch_"  # so that remove_batches() only ever removes directories made by stage_batch()
+
+# Errors meaning 'this filesystem (or pair of filesystems) cannot do that', rather than a real failure.
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ("EXDEV", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EINVAL", "EPERM", "ENOSYS", "EMLINK")
+                   if hasattr(errno, name))
+
+
+def reflink(source, destination):
+    # Copy-on-write clone (btrfs, xfs with reflink, bcachefs). The clone shares blocks until either is written.
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(source, 'rb') as reader:
+        with open(destination, 'wb') as writer:
+            try:
+                fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+            except (IOError, OSError):
+                writer.close()
+                os.remove(destination)
+                raise
+    shutil.copystat(source, destination)
+
+
+def hardlink(source, destination):
+    os.link(source, destination)
+
+
+def copy(source, destination):
+    shutil.copy2(source, destination)
+
+
+_FUNCTIONS = {"reflink": reflink, "hardlink": hardlink, "copy": copy}
+
+
+class Stager(object):
+    """Stage files by the cheapest method that works, remembering which methods do not.
+
+    method 'auto' tries a reflink, then a hardlink, then a full copy. A reflink is preferred to a hardlink
+    because the staged file is then independent of the original: writing to one does not change the
+    other. A hardlink shares the same file, which is fine as long as nothing edits reads in place.
+    """
+
+    def __init__(self, method="auto"):
+        self.methods = list(METHODS) if method == "auto" else [method]
+        self.lock = threading.Lock()
+        self.counts = dict((name, 0) for name in METHODS)
+
+    def stage(self, source, directory):
+        destination = os.path.join(directory, os.path.basename(source))
+        for method in list(self.methods):
+            try:
+                _FUNCTIONS[method](source, destination)
+            except (IOError, OSError) as error:
+                if method == "copy" or error.errno not in _UNSUPPORTED:
+                    raise
+                with self.lock:
+                    if method in self.methods and len(self.methods) > 1:
+                        self.methods.remove(method)
+                continue
+            with self.lock:
+                self.counts[method] += 1
+            return method
+        raise OSError(errno.EOPNOTSUPP, "Could not stage %s with any of %s" % (source, ", ".join(self.methods)))
+
+    def stage_batch(self, sources, parent, taken=None):
+        """Stage sources into a new batch directory in parent, and return (its path, its number).
+
+        Batch directories are numbered by the time in seconds, counting up past numbers already taken, as
+        batches can be made within the same second. taken(number), if given, also rules out numbers, such as
+        those of output files already written.
+        """
+        number = int(round(time.time()))
+        while True:
+            directory = os.path.join(parent, BATCH_PREFIX + str(number))
+            try:
+                if taken is not None and taken(number):
+                    raise OSError(errno.EEXIST, "batch %d already used" % number)
+                os.mkdir(directory)
+                break
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+                number += 1
+        for source in sources:
+            self.stage(source, directory)
+        return directory, number
+
+    def summary(self):
+        return ", ".join("%d by %s" % (self.counts[name], name) for name in METHODS if self.counts[name])
+
+
+def remove_batches(parent):
+    # Batch directories left in parent by a run that stopped part way through. Nothing else is touched.
+    for name in os.listdir(parent):
+        if name.startswith(BATCH_PREFIX) and name[len(BATCH_PREFIX):].isdigit() and \
+                os.path.isdir(os.path.join(parent, name)):
+            shutil.rmtree(os.path.join(parent, name))
+
+
+def publish(source, directory):
+    # Reads in a staging directory are made visible in directory by rename alone: no data is moved.
+    destination = os.path.join(directory, os.path.basename(source))
+    if os.name == "nt" and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
@@ -0,0 +1,180 @@
+"""A pool of worker threads moving files off the sequencing laptop, oldest first."""
+import itertools
+import os
+import threading
+import time
+
+from ont.metrics import REGISTRY
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+_STOP = float("inf")  # sorts after every real mtime, so workers finish the backlog before stopping
+
+
+class WorkerStats(object):
+    """Files, bytes and busy seconds for one worker thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+
+    def throughput(self):
+        # Megabytes per second of time spent transferring.
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds / 1e6
+
+    def __str__(self):
+        return "%s: %d files, %.1f MB in %.1f seconds (%.2f MB/s), %d failures" % \
+               (self.name, self.files, self.bytes / 1e6, self.seconds, self.throughput(), self.failures)
+
+
+class TransferPool(object):
+    """Run transfer(item) for each submitted item on a pool of threads.
+
+    An item is a file path, or a tuple of paths to be sent together as a bundle. Items are handed out
+    oldest mtime first. The queue is bounded, so submit() blocks when the destination cannot keep up:
+    the producer is held back rather than the backlog growing without limit.
+    transfer(item) returns (files, bytes) moved, or None if the item was skipped.
+    set_workers() changes how many of the threads may transfer at once, from none up to workers; limit is how
+    many may to begin with (all of them by default).
+    With a name, the pool records <name>_seconds (each item), <name>_files_total, <name>_bytes_total,
+    <name>_failures_total, <name>_queue_depth and <name>_busy_workers in the metrics REGISTRY.
+    """
+
+    def __init__(self, transfer, workers=4, queue_size=256, on_error=None, name=None, limit=None):
+        self.transfer = transfer
+        self.on_error = on_error
+        self.busy = 0
+        self.name = name
+        if name:
+            self.item_seconds = REGISTRY.histogram(name + "_seconds", "Seconds taken by each %s item" % name)
+            self.files_total = REGISTRY.counter(name + "_files_total", "Files handled by %s" % name)
+            self.bytes_total = REGISTRY.counter(name + "_bytes_total", "Bytes handled by %s" % name)
+            self.failures_total = REGISTRY.counter(name + "_failures_total", "Items that failed in %s" % name)
+            REGISTRY.gauge(name + "_queue_depth", "Items waiting for a %s worker" % name, function=self.backlog)
+            REGISTRY.gauge(name + "_busy_workers", "%s workers busy, out of %d" % (name, workers),
+                           function=lambda: self.busy)
+        self.queue = queue.PriorityQueue(maxsize=queue_size)
+        self.slots = threading.Condition()
+        self.limit = max(1, min(limit or workers, workers))
+        self.running = 0  # threads transferring an item, at most limit
+        self.counter = itertools.count()  # tie breaker so equal mtimes keep submission order
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.stats = []
+        self.threads = []
+        for number in range(workers):
+            stats = WorkerStats("worker-%d" % (number + 1))
+            thread = threading.Thread(target=self._work, args=(stats,), name=stats.name)
+            thread.daemon = True
+            thread.start()
+            self.stats.append(stats)
+            self.threads.append(thread)
+
+    def submit(self, item, mtime=None):
+        # Returns False if the item is already queued or being transferred.
+        with self.lock:
+            if item in self.pending:
+                return False
+            self.pending.add(item)
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(item[0] if isinstance(item, tuple) else item)
+            except OSError:
+                with self.lock:
+                    self.pending.discard(item)
+                return False
+        self.queue.put((mtime, next(self.counter), item))
+        return True
+
+    def set_workers(self, workers):
+        # Threads over the limit finish their current item and then wait until it is raised again.
+        with self.slots:
+            self.limit = max(0, min(workers, len(self.threads)))
+            self.slots.notify_all()
+
+    def _work(self, stats):
+        while True:
+            with self.slots:
+                while self.running >= self.limit:
+                    self.slots.wait()
+            entry = self.queue.get()
+            if entry[0] == _STOP:
+                self.queue.task_done()
+                with self.slots:
+                    self.slots.notify()  # the next thread waiting for a slot takes its own stop
+                return
+            # A slot is only taken with an item in hand. The limit may have been lowered, or the slot taken by
+            # another thread, while this one waited for the item, in which case it goes back to the queue.
+            with self.slots:
+                allowed = self.running < self.limit
+                if allowed:
+                    self.running += 1
+            if not allowed:
+                self.queue.put(entry)
+                self.queue.task_done()
+                continue
+            try:
+                self._take(stats, entry[2])
+            finally:
+                with self.slots:
+                    self.running -= 1
+                    self.slots.notify()
+
+    def _take(self, stats, item):
+        # Transfer one item.
+        try:
+            start = time.time()
+            with self.lock:
+                self.busy += 1
+            try:
+                moved = self.transfer(item)
+            except Exception as error:
+                stats.failures += 1
+                if self.name:
+                    self.failures_total.inc()
+                if self.on_error:
+                    self.on_error(item, error)
+                return
+            finally:
+                with self.lock:
+                    self.busy -= 1
+            if moved is not None:
+                seconds = time.time() - start
+                stats.files += moved[0]
+                stats.bytes += moved[1]
+                stats.seconds += seconds
+                if self.name:
+                    self.item_seconds.observe(seconds)
+                    self.files_total.inc(moved[0])
+                    self.bytes_total.inc(moved[1])
+        finally:
+            with self.lock:
+                self.pending.discard(item)
+            self.queue.task_done()
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def files_moved(self):
+        return sum(stats.files for stats in self.stats)
+
+    def bytes_moved(self):
+        return sum(stats.bytes for stats in self.stats)
+
+    def join(self):
+        # Wait until everything submitted so far has been transferred.
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put((_STOP, next(self.counter), None))
+        for thread in self.threads:
+            thread.join()
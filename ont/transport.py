@@ -0,0 +1,310 @@
+"""Ways of putting reads on the server: a mapped drive or local path, or SFTP."""
+import os
+import posixpath
+import shutil
+import socket
+import stat
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+from ont.bundle import format_index, index_name, write_bundle
+from ont.checksum import (ChecksumError, HashingReader, HashingWriter, copy_verified, file_checksum, new_hasher,
+                          partial_name)
+from ont.disk_space import disk_usage
+
+
+class LocalTransport(object):
+    """The server is a mapped network drive (or any path this computer can write to).
+
+    Copies are read back from the server and checksummed, or with read_back False only checked by size.
+    """
+
+    name = "local"
+
+    def __init__(self, checksum="crc32", read_back=True):
+        self.checksum = checksum
+        self.read_back = read_back
+
+    def join(self, *parts):
+        return os.path.join(*parts)
+
+    def abspath(self, path):
+        return os.path.abspath(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def makedirs(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def free_space(self, path):
+        # Bytes free on the filesystem holding path, or None if that cannot be told.
+        usage = disk_usage(path)
+        return usage[1] if usage else None
+
+    def list_files(self, directory):
+        # Yields (name, size, mtime) for each file in directory.
+        for name in os.listdir(directory):
+            status = os.stat(os.path.join(directory, name))
+            if stat.S_ISREG(status.st_mode):
+                yield name, status.st_size, status.st_mtime
+
+    def move(self, source, directory):
+        # Returns the checksum of the copy, or None if files are moved without checking.
+        if self.checksum == "none":
+            shutil.move(source, directory)
+            return None
+        checksum = copy_verified(source, directory, algorithm=self.checksum, read_back=self.read_back)
+        os.remove(source)
+        return checksum
+
+    def move_bundle(self, sources, directory, name, compression="none"):
+        # Pack sources into the tar bundle directory/name, put its index beside it and remove the sources.
+        # Returns (bundle checksum, index entries).
+        temporary = os.path.join(directory, partial_name(name))
+        hasher = None if self.checksum == "none" else new_hasher(self.checksum)
+        try:
+            with open(temporary, 'wb') as handle:
+                writer = HashingWriter(handle, hasher)
+                entries = write_bundle(writer, sources, compression, self.checksum)
+                handle.flush()
+                os.fsync(handle.fileno())
+            copied_size = os.path.getsize(temporary)
+            if copied_size != writer.bytes:
+                raise ChecksumError("Size mismatch writing bundle %s: %d sent, %d on the server"
+                                    % (name, writer.bytes, copied_size))
+            checksum = None
+            if hasher is not None:
+                checksum = "%s:%s" % (self.checksum, hasher.hexdigest())
+                if self.read_back:
+                    copied_checksum = file_checksum(temporary, self.checksum)
+                    if copied_checksum != checksum:
+                        raise ChecksumError("Checksum mismatch writing bundle %s: %s sent, %s on the server"
+                                            % (name, checksum, copied_checksum))
+            index_temporary = os.path.join(directory, partial_name(index_name(name)))
+            with open(index_temporary, 'w') as index:
+                index.write(format_index(entries))
+            os.rename(index_temporary, os.path.join(directory, index_name(name)))
+            os.rename(temporary, os.path.join(directory, name))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        for source in sources:
+            os.remove(source)
+        return checksum, entries
+
+    def close(self):
+        pass
+
+
+class _SFTPConnection(object):
+    # One SSH session and its SFTP channel.
+
+    def __init__(self, host, port, username, password, key_filename, known_hosts=None):
+        if paramiko is None:
+            raise ImportError("SFTP transfers need the paramiko module (pip install paramiko)")
+        self.ssh = paramiko.SSHClient()
+        self.ssh.load_system_host_keys()
+        if known_hosts:
+            self.ssh.load_host_keys(known_hosts)
+        self.ssh.connect(host, port=port, username=username, password=password, key_filename=key_filename)
+        self.sftp = self.ssh.open_sftp()
+
+    def __getattr__(self, name):
+        # putfo, stat, mkdir, listdir_attr, posix_rename, remove ...
+        return getattr(self.sftp, name)
+
+    def is_alive(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        self.sftp.close()
+        self.ssh.close()
+
+
+class SFTPTransport(object):
+    """The server is reached over SFTP, with a pool of persistent connections.
+
+    Each worker thread borrows a connection for a file and hands it back afterwards, so many files are
+    sent over the same sessions without the per-file cost of a mapped drive; paramiko pipelines the writes
+    within a file. A connection that has dropped is thrown away and the file retried once on a new one.
+
+    connect, if given, is called with no arguments to make a connection. Anything providing open, putfo,
+    stat, mkdir, listdir_attr, posix_rename, remove, close and is_alive like _SFTPConnection will do, which
+    allows testing against an in-process stand-in instead of an sshd. known_hosts is a file of host keys
+    trusted as well as the user's own, such as the one benchmarks/mock_sftp_server.py writes.
+    """
+
+    name = "sftp"
+
+    def __init__(self, host, port=22, username=None, password=None, key_filename=None, connections=4,
+                 checksum="crc32", connect=None, known_hosts=None):
+        self.checksum = checksum
+        if connect is None:
+            if paramiko is None:
+                raise ImportError("SFTP transfers need the paramiko module (pip install paramiko)")
+
+            def connect():
+                return _SFTPConnection(host, port, username, password, key_filename, known_hosts)
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(connections)
+        self.lock = threading.Lock()
+        self.connections_made = 0
+
+    def _new_connection(self):
+        connection = self.connect()
+        with self.lock:
+            self.connections_made += 1
+        return connection
+
+    def _call(self, function, retry=True):
+        # Run function(connection) on a pooled connection, reconnecting once if the connection has dropped.
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = self._new_connection()
+            try:
+                result = function(connection)
+            except (EOFError, socket.error, IOError):
+                if connection.is_alive():
+                    self.idle.put(connection)
+                    raise
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                if not retry:
+                    raise
+                connection = self._new_connection()
+                try:
+                    result = function(connection)
+                except BaseException:
+                    connection.close()
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+            self.idle.put(connection)
+            return result
+
+    def join(self, *parts):
+        return posixpath.join(*parts)
+
+    def abspath(self, path):
+        return posixpath.normpath(path)
+
+    def isdir(self, path):
+        def remote_isdir(connection):
+            try:
+                return stat.S_ISDIR(connection.stat(path).st_mode)
+            except IOError as error:
+                if connection.is_alive():
+                    return False
+                raise error
+        return self._call(remote_isdir)
+
+    def makedirs(self, path):
+        def remote_makedirs(connection):
+            current = "/" if path.startswith("/") else ""
+            for part in path.strip("/").split("/"):
+                current = posixpath.join(current, part)
+                try:
+                    connection.stat(current)
+                except IOError:
+                    connection.mkdir(current)
+        self._call(remote_makedirs)
+
+    def free_space(self, path):
+        # SFTP has no standard way of asking, and paramiko does not send OpenSSH's statvfs extension.
+        return None
+
+    def list_files(self, directory):
+        attributes = self._call(lambda connection: connection.listdir_attr(directory))
+        for attribute in attributes:
+            if stat.S_ISREG(attribute.st_mode):
+                yield attribute.filename, attribute.st_size, attribute.st_mtime
+
+    def move(self, source, directory):
+        # The read is streamed into a hidden .partial file and renamed once the server has all of it.
+        # SSH already protects the bytes on the wire, so the checksum is taken from the stream as it is
+        # sent and the remote copy is checked by size rather than read back over the network.
+        name = os.path.basename(source)
+        temporary = posixpath.join(directory, partial_name(name))
+        destination = posixpath.join(directory, name)
+        size = os.path.getsize(source)
+        mtime = os.path.getmtime(source)
+
+        def upload(connection):
+            hasher = None if self.checksum == "none" else new_hasher(self.checksum)
+            with open(source, 'rb') as handle:
+                attributes = connection.putfo(HashingReader(handle, hasher), temporary, file_size=size,
+                                              confirm=True)
+            if attributes.st_size != size:
+                connection.remove(temporary)
+                raise ChecksumError("Size mismatch copying %s: %d on the laptop, %d on the server"
+                                    % (source, size, attributes.st_size))
+            if hasattr(connection, "utime"):
+                connection.utime(temporary, (mtime, mtime))
+            connection.posix_rename(temporary, destination)
+            return None if hasher is None else "%s:%s" % (self.checksum, hasher.hexdigest())
+
+        checksum = self._call(upload)
+        os.remove(source)
+        return checksum
+
+    def move_bundle(self, sources, directory, name, compression="none"):
+        # As move(), but the reads are streamed as one tar bundle over a single remote file.
+        temporary = posixpath.join(directory, partial_name(name))
+        index_temporary = posixpath.join(directory, partial_name(index_name(name)))
+
+        def upload(connection):
+            hasher = None if self.checksum == "none" else new_hasher(self.checksum)
+            remote = connection.open(temporary, 'wb')
+            try:
+                if hasattr(remote, "set_pipelined"):
+                    remote.set_pipelined(True)
+                writer = HashingWriter(remote, hasher)
+                entries = write_bundle(writer, sources, compression, self.checksum)
+            finally:
+                remote.close()
+            remote_size = connection.stat(temporary).st_size
+            if remote_size != writer.bytes:
+                connection.remove(temporary)
+                raise ChecksumError("Size mismatch writing bundle %s: %d sent, %d on the server"
+                                    % (name, writer.bytes, remote_size))
+            index = connection.open(index_temporary, 'w')
+            try:
+                index.write(format_index(entries).encode("utf-8"))
+            finally:
+                index.close()
+            connection.posix_rename(index_temporary, posixpath.join(directory, index_name(name)))
+            connection.posix_rename(temporary, posixpath.join(directory, name))
+            checksum = None if hasher is None else "%s:%s" % (self.checksum, hasher.hexdigest())
+            return checksum, entries
+
+        checksum, entries = self._call(upload)
+        for source in sources:
+            os.remove(source)
+        return checksum, entries
+
+    def close(self):
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            connection.close()
@@ -0,0 +1,167 @@
+"""Watch a directory for new files, using inotify where available and adaptive polling otherwise."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+# Polling starts quickly and backs off to the old one minute sleep when nothing is arriving.
+POLL_INTERVAL_MIN = 1
+POLL_INTERVAL_MAX = 60
+IDLE_NOTICE_INTERVAL = 60  # seconds between 'no files found' notices
+
+
+class _Inotify(object):
+    """Minimal ctypes binding: one watch on one directory for completed files."""
+
+    def __init__(self, directory):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on linux")
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Only completed files are of interest: a file closed after writing or one renamed in.
+        path = os.path.abspath(directory).encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error_number = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error_number, "inotify_add_watch failed on %s" % directory)
+
+    def read(self, timeout):
+        # Returns (names, overflowed). Blocks for at most timeout seconds.
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return [], False
+        buffer = os.read(self.fd, READ_SIZE)
+        names = []
+        overflowed = False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            elif length:
+                name = buffer[offset:offset + length].rstrip(b"\0")
+                if not isinstance(name, str):
+                    name = name.decode(sys.getfilesystemencoding())
+                names.append(name)
+            offset += length
+        return names, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher(object):
+    """Yield batches of new file names in a directory until none have arrived for 'watch' seconds.
+
+    match is a function of the file name deciding whether the file is of interest.
+    on_idle, if given, is called as on_idle(idle_seconds, remaining_seconds) about once a minute while waiting.
+    listing, if given, replaces os.listdir for full scans and must return the set of matching names.
+    tick, if given, makes batches() also yield an empty batch every tick seconds while nothing arrives,
+    for callers that follow files as they grow. These do not count as new files for the watch period, but
+    a caller can call touch() when a file it follows has grown, so that the period starts again.
+    The same name may be yielded twice (for example after an inotify queue overflow), so callers should
+    tolerate duplicates as the old listdir loops did.
+    """
+
+    def __init__(self, directory, match=None, watch=800, on_idle=None, use_inotify=True, listing=None,
+                 tick=None):
+        self.directory = directory
+        self.match = match or (lambda name: True)
+        self.listing = listing
+        self.watch = watch
+        self.on_idle = on_idle
+        self.use_inotify = use_inotify
+        self.tick = tick
+        self.mode = None
+        self.last_event_time = None
+
+    def touch(self):
+        self.last_event_time = time.time()
+
+    def _listing(self):
+        if self.listing:
+            return self.listing()
+        return set(name for name in os.listdir(self.directory) if self.match(name))
+
+    def _open_inotify(self):
+        if not self.use_inotify:
+            return None
+        try:
+            return _Inotify(self.directory)
+        except (OSError, AttributeError):
+            # No inotify (not linux, old kernel or libc): fall back to polling.
+            return None
+
+    def batches(self):
+        inotify = self._open_inotify()
+        self.mode = "inotify" if inotify else "poll"
+        try:
+            # The watch is in place before the first listing, so nothing written in between is missed.
+            previous = self._listing()
+            self.last_event_time = time.time()
+            if previous:
+                yield sorted(previous)
+                self.last_event_time = time.time()
+            poll_interval = POLL_INTERVAL_MIN
+            next_notice = IDLE_NOTICE_INTERVAL
+            last_tick = time.time()
+
+            while True:
+                idle = time.time() - self.last_event_time
+                if idle > self.watch:
+                    return
+                wait = min(self.watch - idle, next_notice - idle)
+                if self.tick:
+                    wait = min(wait, last_tick + self.tick - time.time())
+                if inotify:
+                    names, overflowed = inotify.read(max(wait, 0) + 0.01)
+                    if overflowed:
+                        new_files = self._listing()
+                    else:
+                        new_files = set(name for name in names if self.match(name))
+                else:
+                    time.sleep(max(min(poll_interval, wait), 0) + 0.01)
+                    current = self._listing()
+                    new_files = current - previous
+                    previous = current
+                    poll_interval = POLL_INTERVAL_MIN if new_files else min(poll_interval * 2, POLL_INTERVAL_MAX)
+
+                if new_files:
+                    yield sorted(new_files)
+                    # Time spent processing the batch does not count towards the watch period.
+                    self.last_event_time = last_tick = time.time()
+                    next_notice = IDLE_NOTICE_INTERVAL
+                    continue
+
+                if self.tick and time.time() - last_tick >= self.tick:
+                    paused, before = time.time(), self.last_event_time
+                    yield []
+                    # Nor does time spent following files, unless the caller called touch().
+                    if self.last_event_time == before:
+                        self.last_event_time += time.time() - paused
+                    last_tick = time.time()
+
+                idle = time.time() - self.last_event_time
+                if idle >= next_notice:
+                    if self.on_idle:
+                        self.on_idle(int(idle), max(int(self.watch - idle), 0))
+                    next_notice += IDLE_NOTICE_INTERVAL
+        finally:
+            if inotify:
+                inotify.close()
@@ -0,0 +1,719 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+import sys
+import threading
+from collections import deque
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from ont.abundance import AbundanceTable
+from ont.basecall_service import BasecallError, ServicePool
+from ont.bundle import Bundler
+from ont.checkpoint import ClassificationCheckpoint
+from ont.checksum import algorithms
+from ont.fast5_info import Fast5InfoCache, is_short
+from ont.fast5_names import is_run_read
+from ont.kmer_classifier import MIN_HITS_DEFAULT, KmerClassifier
+from ont.manifest import TransferManifest
+from ont.metrics import REGISTRY, MetricsExporters
+from ont.multi_fast5 import packed_reads
+from ont.onecodex import SEARCH_URL, OneCodexAuthError, OneCodexClient
+from ont.read_index import ChannelIndex
+from ont.result_cache import ResultCache
+from ont.scanner import RETRY_DELAY, FileBacklog
+from ont.sequences import INDEX_SUFFIX, is_done, read_index, read_numbered, read_records, RollingWriter
+from ont.staging import Stager, publish, remove_batches
+from ont.transfer import TransferPool
+from ont.transport import LocalTransport
+from ont.watcher import DirectoryWatcher
+
+# This script runs fast5-transfer-realtime.py, nanonet-realtime.py and onecodex-realtime.py as one process.
+# Each read is handed straight from one stage to the next in memory: a read moved into dump joins the next
+# basecalling batch without the dump directory being watched, and each read is sent to be classified as soon
+# as it is basecalled, without the fasta directory being watched or the fasta file read back.
+# The stages are joined by bounded queues. When one falls behind, the stages before it wait for it, and in
+# the end reads are left on the laptop until there is room for them.
+# The directories, manifest, channel index and checkpoint are those of the separate scripts, so a run can be
+# started with this script and carried on with those (or the other way round).
+
+help_descriptor = "This script moves fast5 files from the laptop onto the server, basecalls them with nanonet " + \
+                  "and classifies the reads, as fast5-transfer-realtime.py, nanonet-realtime.py and " + \
+                  "onecodex-realtime.py do, in a single process. Reads pass from one step to the next as soon " + \
+                  "as they are ready. The server must be a mapped network drive (or a local directory). The " + \
+                  "reads are placed into YYYY_MM_DD_<RUN_NAME>/dump, reads, fasta and one_codex as before."
+
+parser = argparse.ArgumentParser(description=help_descriptor)
+
+parser.add_argument('--version', action='version', version="%(prog)s 1.0")
+parser.add_argument("--run_name", nargs='?', dest="RUN_NAME", type=str,
+                    help="This is a required argument. What is the name of your run as they appear on the fast5 " +
+                         "files? User_Date_FlowcellID_MinIONID_sequencing_run_<RUNNAME>_5DigitBarcode_Channel_Read",
+                    required=True)
+parser.add_argument("--reads_directory", nargs='?', dest="READS_DIRECTORY", type=str,
+                    help="This is the directory that contains the fast5 files produced by MinKNOW.",
+                    required=True)
+parser.add_argument("--server_directory", nargs='?', dest="SERVER_DIRECTORY", type=str,
+                    help="This is the directory generally the parent directory of the run folder. If the run folder" +
+                         " does not exist, it will be created.",
+                    required=True)
+parser.add_argument("--run_directory", nargs='?', dest="RUN_DIRECTORY", type=str,
+                    help="This is the parent folder of the dump, reads, fasta and one_codex folders. If not " +
+                         "specified, this will become <server_directory>/YYYY_MM_DD_<run_name>")
+parser.add_argument("--watch", nargs='?', dest="WATCH", type=int,
+                    help="This time (seconds) allowed with no new fast5 files" +
+                         "entering the reads folder before exiting the script. Default set at 800")
+parser.add_argument("--poll", action="store_true", dest="POLL",
+                    help="Poll the reads directory instead of using inotify. Use this if the reads directory " +
+                         "is itself on a network drive, where inotify does not see changes.")
+parser.add_argument("--queue_size", nargs='?', dest="QUEUE_SIZE", type=int,
+                    help="Maximum number of reads waiting between one stage and the next before the earlier " +
+                         "stage waits for the later one to catch up. Default set at 256")
+
+# Transfer
+parser.add_argument("--transfer_threads", nargs='?', dest="TRANSFER_THREADS", type=int,
+                    help="Number of files transferred at once. Default set at 4")
+parser.add_argument("--checksum", nargs='?', dest="CHECKSUM", type=str, choices=algorithms() + ["none"],
+                    help="Checksum used to verify each read is intact on the server before it is deleted from " +
+                         "the laptop. 'none' moves files without checking. Default set at crc32")
+parser.add_argument("--no_read_back", action="store_false", dest="READ_BACK",
+                    help="Do not read each copy back from the server to compare its checksum before the read is " +
+                         "deleted from the laptop, only its size. Reading back doubles the traffic to the " +
+                         "server, but without it a read corrupted on its way to the server is still deleted " +
+                         "from the laptop.")
+parser.add_argument("--min_events", nargs='?', dest="MIN_EVENTS", type=int,
+                    help="Reads with fewer events than this, or no signal at all, are transferred after the " +
+                         "other reads found with them and are not basecalled. nanonet itself skips reads under " +
+                         "500 events. Each read is opened to count its events, which needs h5py. Default set at 0 " +
+                         "(reads are not opened)")
+
+# Basecalling
+parser.add_argument("--threads", nargs='?', dest="THREAD_COUNT", type=int,
+                    help="Number of processors used by nanonet. Default set at 4")
+parser.add_argument("--workers", nargs='?', dest="WORKERS", type=int,
+                    help="Number of nanonet processes run at once, sharing the threads between them. " +
+                         "Default set at 2, or 1 if only one thread is used.")
+parser.add_argument("--batch_reads", nargs='?', dest="BATCH_READS", type=int,
+                    help="Maximum number of reads basecalled in one batch. Default set at 200")
+parser.add_argument("--batch_age", nargs='?', dest="BATCH_AGE", type=int,
+                    help="Maximum time (seconds) a read waits for its batch to fill before the batch is " +
+                         "basecalled anyway. Default set at 5")
+parser.add_argument("--staging", nargs='?', dest="STAGING", type=str, default="auto",
+                    choices=["auto", "reflink", "hardlink", "copy"],
+                    help="How reads are put in the tmp directory for nanonet, as for nanonet-realtime.py. " +
+                         "Default set at auto")
+parser.add_argument("--basecaller", nargs='?', dest="BASECALLER", type=str, default="service",
+                    choices=["service", "stub"],
+                    help="'service' keeps one nanonet process per worker running for the whole run. 'stub' " +
+                         "writes a made up sequence for each read instead of calling it, for testing without " +
+                         "nanonet. Default set at service")
+parser.add_argument("--fastq", action="store_true", dest="FASTQ",
+                    help="Write fastq rather than fasta.")
+parser.add_argument("--roll_megabytes", nargs='?', dest="ROLL_MEGABYTES", type=int,
+                    help="Size (MB) at which a fasta file is finished and a new one started. Default set at 16")
+parser.add_argument("--roll_age", nargs='?', dest="ROLL_AGE", type=int,
+                    help="Time (seconds) after which a fasta file is finished and a new one started. " +
+                         "Default set at 60")
+
+# Classification
+parser.add_argument("--classifier", nargs='?', dest="CLASSIFIER", type=str, default="onecodex",
+                    choices=["onecodex", "kmer", "none"],
+                    help="'onecodex' searches each read with the One Codex API. 'kmer' classifies reads on this " +
+                         "computer against a k-mer index made by kmer-index-build.py (see --kmer_index). 'none' " +
+                         "stops after basecalling. Default set at onecodex")
+parser.add_argument("--kmer_index", nargs='?', dest="KMER_INDEX", type=str,
+                    help="Directory of the k-mer index, for --classifier kmer.")
+parser.add_argument("--kmer_min_hits", nargs='?', dest="KMER_MIN_HITS", type=int,
+                    help="Number of k-mers a read must share with a tax_id to be classified as it, for " +
+                         "--classifier kmer. Default set at %d" % MIN_HITS_DEFAULT)
+parser.add_argument("--processes", nargs='?', dest="PROCESSES", type=int,
+                    help="Number of processes classifying reads, for --classifier kmer. Default set at the " +
+                         "number of processors")
+parser.add_argument("--api_url", nargs='?', dest="API_URL", type=str,
+                    help="The One Codex search API. Point this at a local server to test without using the " +
+                         "real API. Default set at %s" % SEARCH_URL)
+parser.add_argument("--concurrency", nargs='?', dest="CONCURRENCY", type=int,
+                    help="Number of sequences being searched at once. Default set at 8")
+parser.add_argument("--retries", nargs='?', dest="RETRIES", type=int,
+                    help="Number of times a sequence is retried when One Codex is busy (or rate limiting) or " +
+                         "cannot be reached, before it is skipped. Default set at 5")
+parser.add_argument("--cache", nargs='?', dest="CACHE", type=str,
+                    help="sqlite file of the tax_id found for each sequence, shared between runs. Use 'none' to " +
+                         "search every read. Default set at ~/.onecodex_cache.sqlite")
+parser.add_argument("--abundance_interval", nargs='?', dest="ABUNDANCE_INTERVAL", type=int,
+                    help="How often (seconds) the reads and bases found so far for each tax_id are written to " +
+                         "RUN_DIRECTORY/one_codex/<run_name>.abundance.json and .tsv. Default set at 30")
+parser.add_argument("--metrics_port", nargs='?', dest="METRICS_PORT", type=int,
+                    help="Serve counters, rates and latencies for each stage at http://localhost:<port>/metrics, in " +
+                         "the Prometheus text format, while the script runs. Default set at 0 (off)")
+parser.add_argument("--metrics_file", nargs='?', dest="METRICS_FILE", type=str,
+                    help="Write the same metrics, and the rate of each counter, as JSON to this file every " +
+                         "--metrics_interval seconds. Default set at none")
+parser.add_argument("--metrics_interval", nargs='?', dest="METRICS_INTERVAL", type=int, default=10,
+                    help="How often (seconds) the metrics file is written. Default set at 10")
+parser.add_argument("--logfile", nargs='?', dest="LOGFILE", type=str,
+                    help="This is the file that some general notes are printed to. If not specified," +
+                         "the file will be RUN_DIRECTORY/log/<run_name>.pipeline.log")
+args = parser.parse_args()
+
+# Assign inputs
+RUN_NAME = args.RUN_NAME
+READS_DIRECTORY = args.READS_DIRECTORY
+SERVER_DIRECTORY = args.SERVER_DIRECTORY
+RUN_DIRECTORY = args.RUN_DIRECTORY
+WATCH = args.WATCH
+POLL = args.POLL
+QUEUE_SIZE = args.QUEUE_SIZE
+TRANSFER_THREADS = args.TRANSFER_THREADS
+CHECKSUM = args.CHECKSUM
+READ_BACK = args.READ_BACK
+MIN_EVENTS = args.MIN_EVENTS
+THREAD_COUNT = args.THREAD_COUNT
+WORKERS = args.WORKERS
+BATCH_READS = args.BATCH_READS
+BATCH_AGE = args.BATCH_AGE
+STAGING = args.STAGING
+BASECALLER = args.BASECALLER
+FASTQ = args.FASTQ
+ROLL_MEGABYTES = args.ROLL_MEGABYTES
+ROLL_AGE = args.ROLL_AGE
+CLASSIFIER = args.CLASSIFIER
+KMER_INDEX = args.KMER_INDEX
+KMER_MIN_HITS = args.KMER_MIN_HITS
+PROCESSES = args.PROCESSES
+API_URL = args.API_URL
+CONCURRENCY = args.CONCURRENCY
+RETRIES = args.RETRIES
+CACHE = args.CACHE
+ABUNDANCE_INTERVAL = args.ABUNDANCE_INTERVAL
+METRICS_PORT = args.METRICS_PORT
+METRICS_FILE = args.METRICS_FILE
+METRICS_INTERVAL = args.METRICS_INTERVAL
+LOGFILE = args.LOGFILE
+
+# Defaults
+WATCH_DEFAULT = 800
+QUEUE_SIZE_DEFAULT = 256
+TRANSFER_THREADS_DEFAULT = 4
+CHECKSUM_DEFAULT = "crc32"
+THREAD_COUNT_DEFAULT = 4
+WORKERS_DEFAULT = 2
+BATCH_READS_DEFAULT = 200
+BATCH_AGE_DEFAULT = 5  # shorter than nanonet-realtime.py's, as nothing else waits on the dump directory
+ROLL_MEGABYTES_DEFAULT = 16
+ROLL_AGE_DEFAULT = 60
+CONCURRENCY_DEFAULT = 8
+RETRIES_DEFAULT = 5
+CHECKPOINT_RECORDS = 100  # records classified between checkpoints
+ABUNDANCE_INTERVAL_DEFAULT = 30
+CACHE_DEFAULT = os.path.expanduser("~/.onecodex_cache.sqlite")
+INVALID_SYMBOLS = "~`!@#$%^&*()-+={}[]:>;',</?*-+"
+
+date = time.strftime("%Y_%m_%d")
+
+# Does the RUN_NAME contain any 'bad' characters.
+for s in RUN_NAME:
+    if s in INVALID_SYMBOLS:
+        error_message = "Error, invalid character in filename. Cannot have any of the following characters %s" \
+                        % INVALID_SYMBOLS
+        sys.exit(error_message)
+
+# Checking to ensure that the reads and server directories exist
+if not os.path.isdir(READS_DIRECTORY):
+    error_message = "Error: cannot locate or find reads directory %s" % READS_DIRECTORY
+    sys.exit(error_message)
+READS_DIRECTORY = os.path.abspath(READS_DIRECTORY) + "/"
+
+if not os.path.isdir(SERVER_DIRECTORY):
+    error_message = "Error: cannot locate or find server directory %s" % SERVER_DIRECTORY
+    sys.exit(error_message)
+SERVER_DIRECTORY = os.path.abspath(SERVER_DIRECTORY) + "/"
+
+if RUN_DIRECTORY:
+    if not os.path.isdir(RUN_DIRECTORY):
+        error_message = "Error: run directory specified but does not exist %s" % RUN_DIRECTORY
+        sys.exit(error_message)
+    RUN_DIRECTORY = os.path.abspath(RUN_DIRECTORY) + "/"
+else:
+    RUN_DIRECTORY = SERVER_DIRECTORY + date + "_" + RUN_NAME + "/"
+    general_message = "Run directory not specified. Using %s" % RUN_DIRECTORY
+    print(general_message)
+
+DUMP_DIRECTORY = RUN_DIRECTORY + "dump/"
+BASECALLED_DIRECTORY = RUN_DIRECTORY + "reads/"
+FASTA_DIRECTORY = RUN_DIRECTORY + "fasta/"
+ONE_CODEX_DIRECTORY = RUN_DIRECTORY + "one_codex/"
+LOG_DIRECTORY = RUN_DIRECTORY + "log/"
+for directory in (DUMP_DIRECTORY, BASECALLED_DIRECTORY, FASTA_DIRECTORY, ONE_CODEX_DIRECTORY, LOG_DIRECTORY):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+if not WATCH:
+    WATCH = WATCH_DEFAULT
+    general_message = "Watch option not defined. Using %s" % WATCH_DEFAULT
+    print(general_message)
+
+if not QUEUE_SIZE:
+    QUEUE_SIZE = QUEUE_SIZE_DEFAULT
+
+if not TRANSFER_THREADS:
+    TRANSFER_THREADS = TRANSFER_THREADS_DEFAULT
+
+if not CHECKSUM:
+    CHECKSUM = CHECKSUM_DEFAULT
+
+fast5_info = None
+if MIN_EVENTS:
+    try:
+        fast5_info = Fast5InfoCache()
+    except ImportError as error:
+        sys.exit("Error: %s" % error)
+
+if not THREAD_COUNT:
+    THREAD_COUNT = THREAD_COUNT_DEFAULT
+
+if not WORKERS:
+    WORKERS = min(WORKERS_DEFAULT, THREAD_COUNT)
+THREADS_PER_WORKER = max(THREAD_COUNT // WORKERS, 1)
+
+if not BATCH_READS:
+    BATCH_READS = BATCH_READS_DEFAULT
+
+if not BATCH_AGE:
+    BATCH_AGE = BATCH_AGE_DEFAULT
+
+if not ROLL_MEGABYTES:
+    ROLL_MEGABYTES = ROLL_MEGABYTES_DEFAULT
+
+if not ROLL_AGE:
+    ROLL_AGE = ROLL_AGE_DEFAULT
+
+OUTPUT_EXTENSION = "fastq" if FASTQ else "fasta"
+
+if not API_URL:
+    API_URL = SEARCH_URL
+
+if not CONCURRENCY:
+    CONCURRENCY = CONCURRENCY_DEFAULT
+
+if RETRIES is None:
+    RETRIES = RETRIES_DEFAULT
+
+if CLASSIFIER == "kmer":
+    if not KMER_INDEX or not os.path.isdir(KMER_INDEX):
+        error_message = "Error: --classifier kmer needs the directory of a k-mer index, given by --kmer_index"
+        sys.exit(error_message)
+    if not KMER_MIN_HITS:
+        KMER_MIN_HITS = MIN_HITS_DEFAULT
+    CACHE = "none"
+
+if not CACHE:
+    CACHE = CACHE_DEFAULT
+    general_message = "Cache not defined, using %s" % CACHE_DEFAULT
+    print(general_message)
+
+if not ABUNDANCE_INTERVAL:
+    ABUNDANCE_INTERVAL = ABUNDANCE_INTERVAL_DEFAULT
+
+# Create the log file
+if LOGFILE:
+    if not os.path.isfile(LOGFILE):
+        error_message = "Log file specifed but does not exist."
+        sys.exit(error_message)
+else:
+    LOGFILE = LOG_DIRECTORY + date + "_" + RUN_NAME + ".pipeline.log"
+    general_message = "Log file not defined, using %s" % LOGFILE
+    print(general_message)
+
+
+def log(message):
+    print(message)
+    logger = open(LOGFILE, 'a+')
+    logger.write(message + "\n")
+    logger.close()
+
+
+# Set up the classifier first, so that a missing index or module is found before any reads are moved.
+cache = None
+client = None
+if CLASSIFIER != "none":
+    ONECODEX_API_KEY = os.environ.get("ONECODEX_API_KEY")
+    timeout = 20
+    cache = None if CACHE == "none" else ResultCache(CACHE, source=API_URL)
+    try:
+        if CLASSIFIER == "kmer":
+            # One read at a time, as reads arrive one at a time rather than a file at once.
+            client = KmerClassifier(KMER_INDEX, processes=PROCESSES, min_hits=KMER_MIN_HITS, chunk_size=1)
+        else:
+            client = OneCodexClient(ONECODEX_API_KEY, url=API_URL, concurrency=CONCURRENCY, timeout=timeout,
+                                    retries=RETRIES, cache=cache)
+    except (ImportError, IOError, OSError) as error:
+        sys.exit("Error: %s" % error)
+
+# And the basecaller, for the same reason. Each basecall worker has its own service process, replaced if it
+# dies part way through a batch.
+try:
+    basecall_services = ServicePool("stub" if BASECALLER == "stub" else "nanonet", report=log)
+except BasecallError as error:
+    sys.exit("Error: %s. Run nanonet-realtime.py --basecaller command to call each batch with nanonetcall" % error)
+
+# State kept by the separate scripts, shared with them.
+transport = LocalTransport(checksum=CHECKSUM, read_back=READ_BACK)
+manifest = TransferManifest(LOG_DIRECTORY + RUN_NAME + ".transfer.manifest")
+if not manifest.existed:
+    manifest.seed(entry for entry in transport.list_files(DUMP_DIRECTORY) if entry[0].endswith('.fast5'))
+channel_index_file = LOG_DIRECTORY + RUN_NAME + ".called_reads"
+if os.path.isfile(channel_index_file):
+    called_index = ChannelIndex.load(channel_index_file)
+else:
+    called_index = ChannelIndex()
+    called_index.add_existing(os.listdir(BASECALLED_DIRECTORY))
+    called_index.add_existing(packed_reads(BASECALLED_DIRECTORY))
+called_index_lock = threading.Lock()
+checkpoint = ClassificationCheckpoint(LOG_DIRECTORY + RUN_NAME + ".onecodex.checkpoint")
+unchecked_bytes = checkpoint.restore_outputs()
+output_file = ONE_CODEX_DIRECTORY + date + "_" + RUN_NAME + ".onecodex"
+abundance = AbundanceTable(ONE_CODEX_DIRECTORY + RUN_NAME + ".abundance", RUN_NAME, interval=ABUNDANCE_INTERVAL)
+if checkpoint.files:
+    if checkpoint.counts is None:
+        # Checkpoint from an older version, without counts: carry on from the last snapshot instead.
+        abundance.load()
+        checkpoint.record_counts(abundance.counts())
+    abundance.restore(checkpoint.counts)
+
+start_time = time.time()
+logger = open(LOGFILE, 'a+')
+logger.write("The time is %s:\n" % time.strftime("%c"))
+logger.write("Commencing pipeline from %s to %s\n" % (READS_DIRECTORY, RUN_DIRECTORY))
+logger.write("Resuming with %d reads transferred, %d fasta files classified from, %d bytes of unchecked "
+             "results removed\n" % (len(manifest), len(checkpoint.files), unchecked_bytes))
+logger.close()
+
+
+# Rates and latencies while the run goes, for seeing which stage is holding the others up.
+try:
+    metrics_exporters = MetricsExporters(REGISTRY, port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_INTERVAL)
+except IOError as error:
+    sys.exit("Error: %s" % error)
+reads_total = REGISTRY.counter("classify_reads_total", "Reads classified, including those given no tax_id")
+bases_total = REGISTRY.counter("classify_bases_total", "Bases in the reads classified")
+classified_total = REGISTRY.counter("classify_classified_total", "Reads given a tax_id")
+failed_total = REGISTRY.counter("classify_failed_total", "Reads that could not be classified")
+classify_latency = REGISTRY.histogram("classify_latency_seconds", "Seconds from a read being basecalled to its "
+                                      "being classified")
+
+
+# Stage 3: classification. Reads arrive in the order they are written to the fasta files, as
+# (fasta file, record number, name, sequence), and the checkpoint records how far through each file has got.
+STOP = None
+classify_queue = queue.Queue(maxsize=QUEUE_SIZE)
+REGISTRY.gauge("classify_queue_depth", "Basecalled reads waiting to be classified", function=classify_queue.qsize)
+# The classifiers take records as fast as they are given them, so the number in flight is limited here.
+in_flight = threading.BoundedSemaphore(QUEUE_SIZE)
+classify_stats = {"read": 0, "classified": 0, "failed": 0, "retried": 0, "latency": 0.0}
+classify_errors = []
+upstream_done = threading.Event()
+
+
+def queued_records(pending):
+    while True:
+        item = classify_queue.get()
+        if item is STOP or classify_errors:
+            return
+        in_flight.acquire()
+        pending.append(item)
+        yield item[2], item[3]
+
+
+def record_result(fasta_file, name, tax_id, length, output):
+    # Count a read given a result, and write it out if that is a tax_id.
+    classify_stats["read"] += 1
+    reads_total.inc()
+    bases_total.inc(length)
+    abundance.add(tax_id, length, fasta_file)
+    if tax_id != 0:
+        classify_stats["classified"] += 1
+        classified_total.inc()
+        output.write(name + "\t" + str(tax_id) + "\n")
+
+
+def classify_stage():
+    output = open(output_file, 'a+')
+    pending = deque()
+    # Records classified from each fasta file, and the files with some not yet checkpointed.
+    positions = {}
+    uncommitted = set()
+    since_commit = 0
+    # Numbers of the records in each file that could not be searched, kept in the checkpoint for retry_failed().
+    failed = {}
+    try:
+        for name, tax_id in client.classify_all(queued_records(pending)):
+            fasta_file, number, _, sequence, written = pending.popleft()
+            in_flight.release()
+            positions[fasta_file] = number + 1
+            uncommitted.add(fasta_file)
+            since_commit += 1
+            classify_stats["latency"] += time.time() - written
+            classify_latency.observe(time.time() - written)
+            if tax_id is None:
+                classify_stats["failed"] += 1
+                failed_total.inc()
+                failed.setdefault(fasta_file, []).append(number)
+            else:
+                record_result(fasta_file, name, tax_id, len(sequence), output)
+            # Checkpointed every so often, and whenever the reads so far have all been classified.
+            if since_commit >= CHECKPOINT_RECORDS or (not pending and classify_queue.empty()):
+                for path in uncommitted:
+                    checkpoint.commit(path, positions[path], False, output, abundance.take_uncommitted(path),
+                                      failed=failed.pop(path, ()))
+                uncommitted.clear()
+                since_commit = 0
+                abundance.save_if_due()
+    except OneCodexAuthError as error:
+        classify_errors.append(error)
+        for _ in pending:
+            in_flight.release()
+        log("Error: %s. Reads are still transferred and basecalled, but not classified." % error)
+        # Keep taking reads so that the stages before this one are not held up.
+        while not (upstream_done.is_set() and classify_queue.empty()):
+            try:
+                classify_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+    # Every file is complete by now, and is finished once all its reads are classified.
+    for path, records in positions.items():
+        checkpoint.commit(path, records, is_done(path) and records >= len(read_index(path)), output,
+                          abundance.take_uncommitted(path), failed=failed.pop(path, ()))
+    output.close()
+
+
+def retry_failed(fasta_file):
+    # Search again the reads of fasta_file that could not be searched when they were first basecalled.
+    numbers = deque()
+
+    def failed_records():
+        for number, name, sequence in read_numbered(fasta_file, checkpoint.failed_records(fasta_file)):
+            numbers.append((number, len(sequence)))
+            yield name, sequence
+
+    output = open(output_file, 'a+')
+    retried = []
+    try:
+        for name, tax_id in client.classify_all(failed_records()):
+            number, length = numbers.popleft()
+            if tax_id is not None:
+                record_result(fasta_file, name, tax_id, length, output)
+                retried.append(number)
+    except OneCodexAuthError as error:
+        classify_errors.append(error)
+    checkpoint.commit(fasta_file, checkpoint.records_done(fasta_file), checkpoint.is_finished(fasta_file), output,
+                      abundance.take_uncommitted(fasta_file), retried=retried)
+    output.close()
+    classify_stats["retried"] += len(retried)
+
+
+def send_to_classify(fasta_file, number, name, sequence):
+    # Called by the fasta writer, in order. Waits here if classification has fallen behind.
+    classify_queue.put((fasta_file, number, name, sequence, time.time()))
+
+
+classify_thread = None
+if client:
+    classify_thread = threading.Thread(target=classify_stage, name="classify")
+    classify_thread.daemon = True
+    classify_thread.start()
+    # Reads basecalled by an earlier run but not yet classified go first.
+    for filename in sorted(os.listdir(FASTA_DIRECTORY)):
+        fasta_file = FASTA_DIRECTORY + filename
+        if not filename.endswith(INDEX_SUFFIX) or checkpoint.is_finished(fasta_file[:-len(INDEX_SUFFIX)]):
+            continue
+        fasta_file = fasta_file[:-len(INDEX_SUFFIX)]
+        start = checkpoint.records_done(fasta_file)
+        entries = read_index(fasta_file, start=start)
+        for number, (name, sequence, quality) in enumerate(read_records(fasta_file, entries), start):
+            send_to_classify(fasta_file, number, name, sequence)
+
+# Stage 2: basecalling. Batches are formed from reads as they arrive in dump, and each read is written to the
+# rolling fasta file, and passed on to be classified, as soon as it is called.
+stager = Stager(STAGING)
+rolling_writer = RollingWriter(FASTA_DIRECTORY, RUN_NAME + "_1D", fastq=FASTQ,
+                               max_bytes=ROLL_MEGABYTES * 1024 * 1024, max_age=ROLL_AGE,
+                               on_written=send_to_classify if client else None)
+
+
+def prepare_batch(new_fast5_files, oldest_time):
+    tmp_nanonet_directory, _ = stager.stage_batch([DUMP_DIRECTORY + read for read in new_fast5_files],
+                                                  BASECALLED_DIRECTORY)
+    # Waits here if every basecaller is busy and a batch is already queued.
+    basecall_pool.submit((tmp_nanonet_directory, tuple(new_fast5_files)), mtime=oldest_time)
+
+
+def basecall_batch(batch):
+    tmp_nanonet_directory, new_fast5_files = batch
+    basecall_services.call(tmp_nanonet_directory, jobs=THREADS_PER_WORKER, fastq=FASTQ,
+                           on_record=rolling_writer.write)
+    for read in os.listdir(tmp_nanonet_directory):
+        publish(tmp_nanonet_directory + "/" + read, BASECALLED_DIRECTORY)
+    os.rmdir(tmp_nanonet_directory)
+    # Only reads that have been called are saved to the index, so a restart repeats unfinished batches.
+    with called_index_lock:
+        called_index.add_existing(new_fast5_files)
+        called_index.save(channel_index_file)
+    return len(new_fast5_files), 0
+
+
+def log_basecall_error(batch, error):
+    log("Error basecalling %s: %s" % (batch[0], error))
+
+
+basecall_pool = TransferPool(basecall_batch, workers=WORKERS, queue_size=1, on_error=log_basecall_error,
+                             name="basecall")
+batcher = Bundler(prepare_batch, max_reads=BATCH_READS, max_bytes=float("inf"), max_age=BATCH_AGE)
+
+# Batch directories left by a run that stopped part way through. Their reads are still in dump and, as each
+# read is only saved once its own batch is done (however far later batches got), are called again below.
+remove_batches(BASECALLED_DIRECTORY)
+
+# Reads moved into dump by an earlier run, or by fast5-transfer-realtime.py, but not yet called.
+for read in called_index.copy().new_reads(sorted(os.listdir(DUMP_DIRECTORY))):
+    batcher.add(read, 0, time.time())
+
+
+# Stage 1: transfer from the laptop, oldest first. Each read joins a basecalling batch once it is in dump.
+def is_run_fast5(filename):
+    return is_run_read(filename, RUN_NAME)
+
+
+backlog = FileBacklog(READS_DIRECTORY, match=is_run_fast5)
+files_found = REGISTRY.counter("transfer_files_found_total", "Reads found in the reads directory")
+REGISTRY.gauge("transfer_backlog_files", "Reads found but not yet queued for transfer", function=lambda: len(backlog))
+short_reads = []
+
+
+def is_short_read(path):
+    return fast5_info is not None and is_short(fast5_info.get(path), MIN_EVENTS)
+
+
+def transfer_read(path):
+    read = os.path.basename(path)
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None  # picked up twice, already moved
+    if read in manifest:
+        print("Warning, %s already exists in dump directory. Deleting from laptop." % read)
+        os.remove(path)
+        backlog.forget(read)
+        return None
+    short = is_short_read(path)  # looked up before the move, while the path is the one cached
+    checksum = transport.move(path, DUMP_DIRECTORY)
+    manifest.record(read, status.st_size, status.st_mtime, checksum)
+    backlog.forget(read)
+    if short:
+        # Too short to call, so put in the reads directory as it is, for metrichor.
+        if not os.path.exists(BASECALLED_DIRECTORY + read):
+            stager.stage(DUMP_DIRECTORY + read, BASECALLED_DIRECTORY)
+        with called_index_lock:
+            called_index.add_existing([read])
+            called_index.save(channel_index_file)
+        short_reads.append(read)
+    else:
+        # Waits here if basecalling has fallen behind, which in turn holds back the scan of the laptop.
+        batcher.add(read, 0, time.time())
+    return 1, status.st_size
+
+
+def log_transfer_error(path, error):
+    # Tried again after a delay, as no new event will bring the read back to the watcher.
+    backlog.retry(os.path.basename(path))
+    log("Error transferring %s: %s. Trying again later" % (path, error))
+
+
+transfer_pool = TransferPool(transfer_read, workers=TRANSFER_THREADS, queue_size=QUEUE_SIZE,
+                             on_error=log_transfer_error, name="transfer")
+
+
+def log_idle(idle_seconds, remaining_seconds):
+    log("No fast5 files found in the last %d seconds.\n" % idle_seconds)
+    log("Waiting for new reads, breaking in %d if no more reads created.\n" % remaining_seconds)
+
+
+# The laptop's reads directory is the only one watched. The watcher also wakes every few seconds while nothing
+# arrives, to try again any reads that failed to move.
+watcher = DirectoryWatcher(READS_DIRECTORY, match=is_run_fast5, watch=WATCH, on_idle=log_idle,
+                           use_inotify=not POLL, listing=backlog.scan, tick=RETRY_DELAY)
+
+for fast5_files in watcher.batches():
+    backlog.add(fast5_files)
+    files_found.inc(len(fast5_files))
+    if backlog.requeue():
+        watcher.touch()
+    # As in fast5-transfer-realtime.py, short reads follow the rest of their scan but keep their own mtime.
+    deferred = []
+    for mtime, read, size in backlog.drain():
+        if is_short_read(READS_DIRECTORY + read):
+            deferred.append((mtime, read))
+            continue
+        transfer_pool.submit(READS_DIRECTORY + read, mtime=mtime)
+    for mtime, read in deferred:
+        transfer_pool.submit(READS_DIRECTORY + read, mtime=mtime)
+
+# Each stage finishes what it has before the next is told there is nothing more to come.
+transfer_pool.close()
+transport.close()
+manifest.close()
+batcher.close()
+basecall_pool.close()
+basecall_services.close()
+rolling_writer.close()
+if classify_thread:
+    upstream_done.set()
+    classify_queue.put(STOP)
+    classify_thread.join()
+    # Reads that could not be searched are tried once more, as they are whenever the pipeline is run again,
+    # rather than being skipped for good.
+    for fasta_file in sorted(checkpoint.failed):
+        if os.path.isfile(fasta_file) and not classify_errors:
+            retry_failed(fasta_file)
+    abundance.save()
+    client.close()
+if cache:
+    cache.close()
+checkpoint.close()
+metrics_exporters.close()
+
+end_time = time.time()
+logger = open(LOGFILE, 'a+')
+logger.write("No fast5 files found for %d seconds\n" % WATCH)
+logger.write("Moved %d files\n" % transfer_pool.files_moved())
+for worker_stats in transfer_pool.stats:
+    logger.write("transfer %s\n" % worker_stats)
+logger.write("Basecalled %d reads into %d %s files\n" % (basecall_pool.files_moved(), len(rolling_writer.finished),
+                                                         OUTPUT_EXTENSION))
+logger.write("Reads staged: %s\n" % (stager.summary() or "none"))
+if fast5_info:
+    logger.write("%d reads too short to basecall. Fast5 files inspected: %s\n" % (len(short_reads),
+                                                                                 fast5_info.summary()))
+if client:
+    reads_done = classify_stats["read"] + classify_stats["failed"]
+    logger.write("Analysed %d sequences\n" % classify_stats["read"])
+    logger.write("Classified %d sequences\n" % classify_stats["classified"])
+    logger.write("Skipped %d sequences that could not be searched\n" % classify_stats["failed"])
+    logger.write("Searched %d sequences skipped earlier. %d are still to be searched, when the pipeline is next "
+                 "run\n" % (classify_stats["retried"],
+                            sum(len(checkpoint.failed_records(fasta_file)) for fasta_file in checkpoint.failed)))
+    if reads_done:
+        logger.write("Mean time from basecalled to classified: %.2f seconds\n"
+                     % (classify_stats["latency"] / reads_done))
+    logger.write("%s\n" % client.summary())
+    if cache:
+        logger.write("Cache: %s\n" % cache.summary())
+logger.write("Process completed in %d seconds.\n" % (end_time - start_time))
+logger.write("Exiting\n")
+logger.close()
+if classify_errors:
+    sys.exit(str(classify_errors[0]))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import the ont package from the repository root, as do the tests.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,77 @@
+import pytest
+
+from ont.basecall_service import BasecallError, BasecallService, ServicePool, StubBackend
+from ont.sequences import read_sequences
+
+NAMES = ["read_1", "read_2", "read_3"]
+
+
+@pytest.fixture
+def batch(tmp_path):
+    for name in NAMES:
+        (tmp_path / (name + ".fast5")).write_bytes(b"")
+    (tmp_path / "notes.txt").write_bytes(b"not a read")
+    return str(tmp_path)
+
+
+@pytest.fixture
+def service():
+    service = BasecallService("stub", stub_length=50)
+    yield service
+    service.close()
+
+
+def test_batch_is_written_to_the_output_file(service, batch, tmp_path):
+    output = str(tmp_path / "batch.fasta")
+    assert service.call(batch, output) == 3
+    expected = [(name, StubBackend(length=50).sequence(name + ".fast5")) for name in NAMES]
+    assert list(read_sequences(output)) == expected
+
+
+def test_records_are_streamed_without_an_output_file(service, batch):
+    records = []
+    assert service.call(batch, fastq=True, on_record=lambda *record: records.append(record)) == 3
+    assert [name for name, sequence, quality in records] == NAMES
+    assert all(len(sequence) == len(quality) == 50 for name, sequence, quality in records)
+
+
+def test_a_failed_batch_leaves_the_service_running(service, batch, tmp_path):
+    with pytest.raises(BasecallError):
+        service.call(str(tmp_path / "missing"), str(tmp_path / "missing.fasta"))
+    assert service.alive()
+    assert service.call(batch, str(tmp_path / "batch.fasta")) == 3
+
+
+def test_a_dead_service_raises_basecall_error(service, batch):
+    service.process.kill()
+    service.process.wait()
+    with pytest.raises(BasecallError):
+        service.call(batch, on_record=lambda *record: None)
+
+
+def test_pool_restarts_a_dead_service_and_calls_the_batch_again(batch):
+    reports = []
+    pool = ServicePool("stub", stub_length=50, report=reports.append)
+    try:
+        first = pool.service()
+        first.process.kill()
+        first.process.wait()
+        records = []
+        assert pool.call(batch, on_record=lambda *record: records.append(record)) == 3
+        assert [record[0] for record in records] == NAMES
+        assert len(reports) == 1
+        assert pool.service() is not first and pool.service().alive()
+        assert pool.services == [pool.service()]
+    finally:
+        pool.close()
+
+
+def test_pool_does_not_retry_a_batch_the_backend_fails_on(tmp_path):
+    pool = ServicePool("stub", stub_length=50)
+    try:
+        service = pool.service()
+        with pytest.raises(BasecallError):
+            pool.call(str(tmp_path / "missing"), on_record=lambda *record: None)
+        assert pool.service() is service
+    finally:
+        pool.close()
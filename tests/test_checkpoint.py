@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from ont.checkpoint import ClassificationCheckpoint
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "run.checkpoint"), str(tmp_path / "run.tsv")
+
+
+def commit(checkpoint, output, text, *args, **kwargs):
+    output.write(text)
+    checkpoint.commit("reads.fasta", *args, output=output, **kwargs)
+
+
+def test_restart_carries_on_from_the_last_commit(paths):
+    log, results = paths
+    checkpoint = ClassificationCheckpoint(log)
+    with open(results, 'w') as output:
+        commit(checkpoint, output, "read_1\t562\n", 1, False, counts={562: (1, 100)})
+        commit(checkpoint, output, "read_2\t562\n", 2, False, counts={562: (1, 150)})
+        output.write("read_3\t9606\n")  # classified, then the run stopped before the next commit
+    checkpoint.close()
+
+    checkpoint = ClassificationCheckpoint(log)
+    assert checkpoint.records_done("reads.fasta") == 2
+    assert not checkpoint.is_finished("reads.fasta")
+    assert checkpoint.counts == {562: [2, 250]}
+    assert checkpoint.restore_outputs() == len("read_3\t9606\n")
+    with open(results) as output:
+        assert output.read() == "read_1\t562\nread_2\t562\n"
+    checkpoint.close()
+
+
+def test_loading_compacts_the_log_to_one_line_a_file(paths):
+    log, results = paths
+    checkpoint = ClassificationCheckpoint(log)
+    with open(results, 'w') as output:
+        for records in range(1, 6):
+            commit(checkpoint, output, "read\t562\n", records, records == 5, counts={562: (1, 10)})
+    checkpoint.close()
+    with open(log) as lines:
+        assert len(lines.readlines()) == 5
+
+    checkpoint = ClassificationCheckpoint(log)
+    checkpoint.close()
+    with open(log) as lines:
+        assert len(lines.readlines()) == 1
+    assert not os.path.exists(log + ".tmp")
+    checkpoint = ClassificationCheckpoint(log)
+    assert checkpoint.records_done("reads.fasta") == 5
+    assert checkpoint.is_finished("reads.fasta")
+    assert checkpoint.counts == {562: [5, 50]}
+    checkpoint.close()
+
+
+def test_failed_records_are_kept_until_retried(paths):
+    log, results = paths
+    checkpoint = ClassificationCheckpoint(log)
+    with open(results, 'w') as output:
+        commit(checkpoint, output, "", 3, False, failed=[0, 2])
+        commit(checkpoint, output, "", 5, True, failed=[4], retried=[0])
+    checkpoint.close()
+
+    checkpoint = ClassificationCheckpoint(log)
+    assert checkpoint.failed_records("reads.fasta") == [2, 4]
+    with open(results, 'a') as output:
+        checkpoint.commit("reads.fasta", 5, True, output, retried=[2, 4])
+    assert checkpoint.failed_records("reads.fasta") == []
+    checkpoint.close()
+    assert ClassificationCheckpoint(log).failed_records("reads.fasta") == []
+
+
+def test_a_partly_written_last_line_is_ignored(paths):
+    log, results = paths
+    checkpoint = ClassificationCheckpoint(log)
+    with open(results, 'w') as output:
+        commit(checkpoint, output, "read_1\t562\n", 1, False, counts={562: (1, 100)})
+    checkpoint.close()
+    with open(log, 'a') as lines:
+        lines.write("reads.fasta\t2\t0\t%s" % results)
+    checkpoint = ClassificationCheckpoint(log)
+    assert checkpoint.records_done("reads.fasta") == 1
+    checkpoint.close()
+
+
+def test_a_log_without_counts_waits_for_the_totals(paths):
+    log, results = paths
+    with open(results, 'w') as output:
+        output.write("read_1\t562\n")
+    with open(log, 'w') as lines:
+        lines.write("reads.fasta\t1\t0\t%s\t%d\n" % (results, os.path.getsize(results)))
+    checkpoint = ClassificationCheckpoint(log)
+    assert checkpoint.counts is None
+    checkpoint.record_counts({562: (1, 100)})
+    checkpoint.close()
+    assert ClassificationCheckpoint(log).counts == {562: [1, 100]}
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from ont import checksum
+from ont.checksum import ChecksumError, copy_verified, file_checksum, partial_name
+from ont.transport import LocalTransport
+
+
+@pytest.fixture
+def read(tmp_path):
+    source = tmp_path / "laptop"
+    source.mkdir()
+    (tmp_path / "server").mkdir()
+    path = source / "read_1.fast5"
+    path.write_bytes(b"ACGT" * 1000)
+    return str(path)
+
+
+def server(read):
+    return os.path.join(os.path.dirname(os.path.dirname(read)), "server")
+
+
+def test_copy_verified_copies_and_returns_checksum(read):
+    result = copy_verified(read, server(read), chunk_size=100)
+    copy = os.path.join(server(read), "read_1.fast5")
+    assert result == file_checksum(read, "crc32") == file_checksum(copy, "crc32")
+    assert os.listdir(server(read)) == ["read_1.fast5"]
+
+
+def test_checksum_mismatch_leaves_nothing_on_the_server(read, monkeypatch):
+    monkeypatch.setattr(checksum, "file_checksum", lambda path, algorithm, chunk_size: "crc32:00000000")
+    with pytest.raises(ChecksumError):
+        copy_verified(read, server(read))
+    assert os.listdir(server(read)) == []
+    assert os.path.getsize(read) == 4000
+
+
+def test_size_mismatch_leaves_nothing_on_the_server(read, monkeypatch):
+    getsize = os.path.getsize
+    monkeypatch.setattr(os.path, "getsize", lambda path: getsize(path) - 1)
+    with pytest.raises(ChecksumError):
+        copy_verified(read, server(read), read_back=False)
+    assert os.listdir(server(read)) == []
+
+
+def test_without_read_back_the_copy_is_not_read(read, monkeypatch):
+    def fail(*args):
+        raise AssertionError("read back")
+    monkeypatch.setattr(checksum, "file_checksum", fail)
+    assert copy_verified(read, server(read), read_back=False).startswith("crc32:")
+
+
+def test_failed_write_removes_the_partial_copy(read, monkeypatch):
+    def fail(descriptor):
+        assert os.path.exists(os.path.join(server(read), partial_name("read_1.fast5")))
+        raise OSError("disk full")
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError):
+        copy_verified(read, server(read))
+    assert os.listdir(server(read)) == []
+
+
+def test_local_transport_keeps_the_read_when_the_copy_fails(read, monkeypatch):
+    monkeypatch.setattr(checksum, "file_checksum", lambda path, algorithm, chunk_size: "crc32:00000000")
+    with pytest.raises(ChecksumError):
+        LocalTransport().move(read, server(read))
+    assert os.path.exists(read)
+    monkeypatch.undo()
+    assert LocalTransport().move(read, server(read)).startswith("crc32:")
+    assert not os.path.exists(read)
@@ -0,0 +1,45 @@
+from ont.disk_space import NORMAL, SERVER_FULL, TransferScheduler
+
+
+class Pool(object):
+    def __init__(self, limit):
+        self.limit = limit
+
+    def set_workers(self, workers):
+        self.limit = workers
+
+    def bytes_moved(self):
+        return 0
+
+
+def scheduler(pool, free, adapt):
+    return TransferScheduler(pool, ".", destination_free_space=lambda: free[0], workers=4, min_workers=1,
+                             max_workers=8, low_fraction=0, high_fraction=1, destination_reserve=1000,
+                             adapt=adapt, interval=3600)
+
+
+def test_transfers_pause_while_the_server_is_nearly_full():
+    for adapt in (True, False):
+        pool, free = Pool(4), [500]
+        transfers = scheduler(pool, free, adapt)
+        try:
+            transfers.sample()
+            assert (transfers.pace, pool.limit) == (SERVER_FULL, 0)
+            free[0] = 1500  # over the reserve, but not yet twice it
+            transfers.sample()
+            assert (transfers.pace, pool.limit) == (SERVER_FULL, 0)
+            free[0] = 2500
+            transfers.sample()
+            assert (transfers.pace, pool.limit) == (NORMAL, 4)
+        finally:
+            transfers.close()
+
+
+def test_unknown_server_space_never_pauses():
+    pool = Pool(4)
+    transfers = scheduler(pool, [None], False)
+    try:
+        transfers.sample()
+        assert (transfers.pace, pool.limit) == (NORMAL, 4)
+    finally:
+        transfers.close()
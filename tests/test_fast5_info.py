@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from ont.fast5_info import Fast5Info, Fast5InfoCache, is_short, read_fast5_info
+
+h5py = pytest.importorskip("h5py")
+
+
+def write_fast5(path, samples=4000, events=None):
+    with h5py.File(path, 'w') as handle:
+        handle.create_group("UniqueGlobalKey/channel_id").attrs.update(
+            {"channel_number": b"101", "sampling_rate": 4000.0})
+        read = handle.create_group("Raw/Reads/Read_77")
+        read.attrs.update({"read_number": 77, "start_mux": 2, "start_time": 8000, "duration": samples})
+        read.create_dataset("Signal", data=[0] * samples, dtype="i2")
+        if events is not None:
+            group = handle.create_group("Analyses/EventDetection_000/Reads/Read_77")
+            group.create_dataset("Events", data=[0.0] * events)
+    return str(path)
+
+
+def test_read_fast5_info(tmp_path):
+    info = read_fast5_info(write_fast5(tmp_path / "read.fast5", events=30))
+    assert info == Fast5Info(101, 77, 2, 2.0, 1.0, 4000, 30)
+
+
+def test_short_reads():
+    def info(samples, events):
+        return Fast5Info(1, 1, 1, 0.0, 0.0, samples, events)
+    assert is_short(info(4000, 30), 50)
+    assert not is_short(info(4000, 50), 50)
+    assert is_short(info(4000, 0), 0)
+    assert is_short(info(0, None), 50)
+    assert not is_short(info(10, None), 50)  # raw only: the length in events is not known
+    assert not is_short(None, 50)
+
+
+def test_cache_rereads_a_file_once_it_changes(tmp_path):
+    path = str(tmp_path / "read.fast5")
+    with open(path, 'wb') as handle:
+        handle.write(b"still being written")
+    cache = Fast5InfoCache()
+    assert cache.get(path) is None
+    assert cache.get(path) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    write_fast5(path, events=30)
+    os.utime(path, (1, 1))
+    assert cache.get(path).events == 30
+    assert cache.get(os.path.join(str(tmp_path), "missing.fast5")) is None
@@ -0,0 +1,38 @@
+import pytest
+
+from ont.fast5_names import ReadName, is_run_read, parse, parse_read_name
+
+MINKNOW_2016 = "user_20160601_FN1234_MN5678_sequencing_run_my_run_12345_ch101_read2077_strand.fast5"
+MINKNOW_1_4 = "host_20170401_FAF1234_MN5678_sequencing_run_my_run_51234_read_77_ch_12_strand.fast5"
+
+
+@pytest.mark.parametrize("name, expected", [
+    (MINKNOW_2016, ReadName("my_run", 101, 2077, "minknow_2016")),
+    (MINKNOW_1_4, ReadName("my_run", 12, 77, "minknow_1_4")),
+    ("sample_ch7_read9_strand.fast5", ReadName(None, 7, 9, "channel_read")),
+    ("ch7_read9.fast5", ReadName(None, 7, 9, "channel_read")),
+    ("sample_read_9_ch_7_strand.fast5", ReadName(None, 7, 9, "read_channel")),
+])
+def test_each_naming_scheme(name, expected):
+    assert parse(name) == expected
+    assert parse_read_name(name) == (expected.channel, expected.read)
+
+
+@pytest.mark.parametrize("name", [
+    "sequencing_summary.txt",
+    "." + MINKNOW_2016,
+    MINKNOW_2016[:-len(".fast5")] + ".partial",
+    "user_ch_read_strand.fast5",
+    "reads",
+])
+def test_anything_else_is_not_a_read(name):
+    assert parse(name) is None
+    assert parse_read_name(name) is None
+
+
+def test_run_names_are_matched_whole():
+    assert is_run_read(MINKNOW_2016, "my_run")
+    assert not is_run_read(MINKNOW_2016, "run")
+    assert not is_run_read(MINKNOW_2016.replace("my_run", "my_run_2"), "my_run")
+    assert is_run_read("sample_sequencing_run_my_run_ch7_read9.fast5", "my_run")
+    assert not is_run_read("sample_ch7_read9_strand.fast5", "my_run")
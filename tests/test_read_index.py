@@ -0,0 +1,50 @@
+import os
+
+from ont.read_index import ChannelIndex
+
+
+def name(channel, read):
+    return "user_20160601_FN1234_MN5678_sequencing_run_my_run_12345_ch%d_read%d_strand.fast5" % (channel, read)
+
+
+def test_reads_arriving_out_of_order_are_still_new():
+    index = ChannelIndex()
+    assert index.new_reads([name(1, 10), name(1, 3), name(1, 10), "notes.txt"]) == [name(1, 10), name(1, 3)]
+    assert index.new_reads([name(1, 3), name(1, 4), name(2, 3)]) == [name(1, 4), name(2, 3)]
+
+
+def test_channels_beyond_the_flowcell_are_kept():
+    index = ChannelIndex(channels=4)
+    assert index.new_reads([name(3000, 1)]) == [name(3000, 1)]
+    assert not index.is_new(3000, 1)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "run.index")
+    index = ChannelIndex()
+    index.add_existing([name(1, 1), name(512, 100000)])
+    index.save(path)
+    index.new_reads([name(7, 5)])
+    index.save(path)  # appended
+    loaded = ChannelIndex.load(path)
+    for channel, read in [(1, 1), (512, 100000), (7, 5)]:
+        assert not loaded.is_new(channel, read)
+    assert loaded.is_new(1, 2)
+    assert loaded._pairs() == index._pairs()
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_a_pair_cut_short_is_left_out_and_the_file_rewritten(tmp_path):
+    path = str(tmp_path / "run.index")
+    index = ChannelIndex()
+    index.new_reads([name(1, 1), name(2, 2)])
+    index.save(path)
+    with open(path, 'ab') as handle:
+        handle.write(b"\x01\x00")  # a crash part way through the next append
+    loaded = ChannelIndex.load(path)
+    assert loaded.is_new(3, 3)
+    assert not loaded.is_new(2, 2)
+    loaded.new_reads([name(3, 3)])
+    loaded.save(path)
+    assert ChannelIndex.load(path)._pairs() == loaded._pairs()
+    assert os.path.getsize(path) == len(loaded._pairs()) * loaded._pairs().itemsize
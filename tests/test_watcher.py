@@ -0,0 +1,22 @@
+import time
+
+from ont.watcher import DirectoryWatcher
+
+
+def run_watcher(directory, touch_for):
+    # Returns the seconds until the watcher gives up, calling touch() on each tick for touch_for seconds.
+    watcher = DirectoryWatcher(directory, watch=0.5, use_inotify=False, tick=0.05)
+    start = time.time()
+    for batch in watcher.batches():
+        assert batch == []
+        if time.time() - start < touch_for:
+            watcher.touch()
+    return time.time() - start
+
+
+def test_ticks_alone_do_not_keep_the_watcher_going(tmp_path):
+    assert run_watcher(str(tmp_path), 0) < 1.0
+
+
+def test_touch_starts_the_watch_period_again(tmp_path):
+    assert run_watcher(str(tmp_path), 1.0) > 1.3